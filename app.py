@@ -1,30 +1,58 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from sqlalchemy import func, distinct, cast, Date
-import json
-from datetime import datetime, timedelta
-from models import User, Match, UserMoreDetails, UserSelfDescription, Message, MatchRequest, MatchBatch
-from database import get_session
-from sqlalchemy.sql import or_, case
-import csv
-from io import StringIO
+import hmac
+import math
+from datetime import datetime
+from models import User, Message, Job
+from database import get_session, get_read_session, pool_stats
+from config import Config
+from stats import dashboard_stats, location_analytics, collect_live, DEFAULT_WINDOW_DAYS
+import rollups
+import listing
+import export
+import sms
+import profiles
+import outbound
+import partitions
+import sync
+import funnel
+import search
+import inbound
+import jobs
+import ranking
+from cache import response_cache
+# Moved to commands.py; re-exported for code that imports them from app
+from commands import ValidationError, get_help_message, validate_age_range  # noqa: F401
 import os
-import traceback
-import sys
-from sqlalchemy import Index
+import logging
+import metrics
+import database
+
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+metrics.init_app(app, {database.engine, database.read_engine})
+# Load the MATCH ranking attributes off the request path (see ranking.py)
+if ranking.WARM_ON_START:
+    ranking.store.load_in_background(database.SessionLocal)
 
 # Configure CORS - only allow requests from your React frontend
 CORS(app, resources={
     r"/api/*": {
         "origins": ["http://localhost:3000"],  # Your React app's URL
-        "methods": ["GET"],
-        "allow_headers": ["Content-Type"]
+        "methods": ["GET", "POST"],
+        "allow_headers": ["Content-Type", "Authorization"]
     }
 })
 
+# Longest timeline the dashboard may request
+MAX_WINDOW_DAYS = 366
+
 # Test route to verify server is running
 @app.route("/")
 def index():
@@ -41,14 +69,26 @@ def test_db():
                 "users_count": users_count
             })
     except Exception as e:
-        print(f"Database Error: {str(e)}")  # Print error to console
+        logger.exception("Database error")
         return jsonify({
             "status": "error",
             "message": f"Database error: {str(e)}"
         }), 500
-    
-class ValidationError(Exception):
-    pass
+
+@app.route("/api/penzi/pool-stats", methods=['GET'])
+def get_pool_stats():
+    return jsonify(pool_stats())
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint: request/SQL histograms plus connection pool gauges."""
+    pools = pool_stats()
+    gauges = [
+        (f"penzi_db_pool_{name}", f"Connection pool {name}",
+         [({"pool": pool}, stats[name]) for pool, stats in pools.items() if name in stats])
+        for name in ("in_use", "in_use_peak", "checkouts", "wait_seconds_total", "wait_seconds_max", "size", "overflow")
+    ]
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 def store_message(session, user_id, direction, message_text, phone_number=None):
     """Store a message in the database.
@@ -68,333 +108,426 @@ def store_message(session, user_id, direction, message_text, phone_number=None):
     session.add(message)
     return message
 
-def get_help_message():
-    """Returns the help message for invalid commands"""
-    return (
-        "Invalid command. Available commands:\n"
-        "1. PENZI (activate service)\n"
-        "2. START#name#age#gender#county#town\n"
-        "3. DETAILS#education#profession#status#religion#ethnicity\n"
-        "4. MYSELF description\n"
-        "5. MATCH#age-range#town\n"
-        "6. NEXT (for more matches)\n"
-        "7. Phone number (to get profile)\n"
-        "8. DESCRIBE phone_number\n"
-        "9. YES (to confirm interest)"
-    )
+def _replayed(response):
+    response = jsonify(response)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+def _throttled(error):
+    response = jsonify({"error": str(error), "retry_after": round(error.retry_after, 1)})
+    response.headers["Retry-After"] = str(max(1, math.ceil(error.retry_after)))
+    return response, 429
 
-def validate_age_range(age_range):
-    """Validate and parse age range string (e.g., '23-25')"""
+@app.route("/api/penzi/sms", methods=["POST"])
+def receive_sms():
+    """Handle one inbound SMS from the gateway and return the reply.
+
+    Accepts JSON or form data with phone_number/message (or the gateway
+    style from/text). The incoming message, the reply and any
+    notification sent to another user are stored in one transaction, and
+    the reply and notifications are queued for delivery by outbound.py.
+    Messages from unregistered numbers are answered but not stored.
+
+    A gateway retry (same message_id/id, see inbound.py) gets the original
+    response back; senders over their rate get a 429.
+    """
     try:
-        min_age, max_age = map(int, age_range.split('-'))
-        if min_age < 18 or max_age < min_age:
-            raise ValidationError("Invalid age range. Minimum age is 18 and maximum age must be greater than minimum.")
-        return min_age, max_age
-    except ValueError:
-        raise ValidationError("Invalid age range format. Use: min-max (e.g., 23-25)")
+        payload = request.get_json(silent=True) or request.form
+        phone_number = payload.get("phone_number") or payload.get("from")
+        message_text = payload.get("message", payload.get("text"))
+        if not phone_number or message_text is None:
+            return jsonify({"error": "phone_number and message are required"}), 400
+        key = inbound.idempotency_key(phone_number, message_text, payload.get("message_id") or payload.get("id"))
+
+        with get_session() as session:
+            inbound.admit(session, key, phone_number, message_text)
+            receipt = inbound.claim(session, key, phone_number)
+            conv = sms.handle(session, phone_number, message_text)
+            if conv.sender is not None:
+                store_message(session, conv.sender.id, 'incoming', message_text, phone_number)
+                store_message(session, conv.sender.id, 'outgoing', conv.reply, phone_number)
+            for user_id, text in conv.notifications:
+                store_message(session, user_id, 'outgoing', text)
+            outbound.enqueue(session, sms.outbound_rows(conv))
+            inbound.record(session, receipt, conv)
+
+            return jsonify({
+                "phone_number": conv.phone_number,
+                "user_id": conv.sender.id if conv.sender is not None else None,
+                "reply": conv.reply
+            })
+
+    except inbound.Duplicate as e:
+        return _replayed(e.response)
+    except inbound.Throttled as e:
+        return _throttled(e)
+    except Exception as e:
+        logger.exception("Error handling SMS")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/penzi/sms/async", methods=["POST"])
+async def receive_sms_async():
+    """Asyncio variant of receive_sms: overlaps the lookups each command needs.
+
+    Needs flask[async] and the async database drivers (see async_db).
+    """
+    try:
+        import async_sms
+    except ImportError as e:
+        return jsonify({"error": f"Async SMS handling unavailable: {e}"}), 501
+    try:
+        payload = request.get_json(silent=True) or request.form
+        phone_number = payload.get("phone_number") or payload.get("from")
+        message_text = payload.get("message", payload.get("text"))
+        if not phone_number or message_text is None:
+            return jsonify({"error": "phone_number and message are required"}), 400
+        key = inbound.idempotency_key(phone_number, message_text, payload.get("message_id") or payload.get("id"))
+        # In-process receipts only here; the database ones are checked when claiming
+        inbound.admit(None, key, phone_number, message_text)
+
+        conv = await async_sms.handle(phone_number, message_text, idempotency_key=key)
+        return jsonify({
+            "phone_number": conv.phone_number,
+            "user_id": conv.sender.id if conv.sender is not None else None,
+            "reply": conv.reply
+        })
+
+    except inbound.Duplicate as e:
+        return _replayed(e.response)
+    except inbound.Throttled as e:
+        return _throttled(e)
+    except Exception as e:
+        logger.exception("Error handling SMS")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/penzi/sms/batch", methods=["POST"])
+def receive_sms_batch():
+    """Handle a burst of inbound SMS: {"messages": [{"phone_number", "message", "message_id"}, ...]}."""
+    try:
+        payload = request.get_json(silent=True) or {}
+        items = payload.get("messages")
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "messages must be a non-empty list"}), 400
+        if len(items) > sms.MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {sms.MAX_BATCH_SIZE} messages per batch"}), 400
+        if not all(isinstance(item, dict) for item in items):
+            return jsonify({"error": "Each message must be an object"}), 400
+
+        with get_session() as session:
+            results = sms.handle_batch(session, items)
+            return jsonify({"results": results})
+
+    except Exception as e:
+        logger.exception("Error handling SMS batch")
+        return jsonify({"error": str(e)}), 500
 
-    
 @app.route("/api/penzi/location-analytics", methods=["GET"])
+@response_cache.cached(tags=("users", "messages"))
 def get_location_analytics():
+    """Location analytics, all-time or for ?from=&to= (same formats as /api/penzi/messages)."""
     try:
-        with get_session() as session:
-            # Get county distribution
-            county_distribution = (
-                session.query(
-                    User.county,
-                    func.count(User.id).label('count')
-                )
-                .group_by(User.county)
-                .all()
-            )
+        start = listing.parse_date_bound(request.args.get("from"))
+        end = listing.parse_date_bound(request.args.get("to"), end=True)
+        with get_read_session() as session:
+            if request.args.get("source") == "live":
+                return jsonify(location_analytics(session, start, end))
+            return jsonify(rollups.location_analytics(session, start, end))
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("Error in location analytics")
+        return jsonify({"error": str(e)}), 500
 
-            # Get top active counties
-            top_counties = (
-                session.query(
-                    User.county,
-                    func.count(distinct(User.id)).label('user_count'),
-                    func.count(distinct(Message.id)).label('message_count')
-                )
-                .outerjoin(Message, User.id == Message.user_id)
-                .group_by(User.county)
-                .order_by(func.count(distinct(User.id)).desc())
-                .limit(10)
-                .all()
-            )
+@app.route("/api/penzi/analytics/funnel", methods=["GET"])
+@response_cache.cached(tags=(), ttl=3600, vary=funnel.cache_day)
+def get_funnel_analytics():
+    """Conversion funnel and weekly retention by ?group_by=county|gender|age_band|signup_week.
 
-            # Get popular towns
-            popular_towns = (
-                session.query(
-                    User.town,
-                    User.county,
-                    func.count(User.id).label('count')
-                )
-                .group_by(User.town, User.county)
-                .order_by(func.count(User.id).desc())
-                .limit(10)
-                .all()
-            )
+    ?from=&to= select users by signup date; ?county= and ?gender= filter them.
+    """
+    try:
+        start = listing.parse_date_bound(request.args.get("from"))
+        end = listing.parse_date_bound(request.args.get("to"), end=True)
+        grouping = funnel.parse_grouping(request.args.get("group_by"))
+        weeks = funnel.parse_weeks(request.args.get("weeks"))
+        with get_read_session() as session:
+            return jsonify(funnel.funnel_analytics(
+                session, start, end,
+                county=request.args.get("county"),
+                gender=request.args.get("gender"),
+                grouping=grouping,
+                weeks=weeks
+            ))
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("Error in funnel analytics")
+        return jsonify({"error": str(e)}), 500
 
-            return jsonify({
-                "countyDistribution": [
-                    {"county": county, "count": count}
-                    for county, count in county_distribution
-                ],
-                "topCounties": [
-                    {
-                        "county": county,
-                        "userCount": user_count,
-                        "messageCount": message_count
-                    }
-                    for county, user_count, message_count in top_counties
-                ],
-                "popularTowns": [
-                    {
-                        "town": town,
-                        "county": county,
-                        "count": count
-                    }
-                    for town, county, count in popular_towns
-                ]
-            })
+@app.route("/api/penzi/search", methods=["GET"])
+@response_cache.cached(tags=("users", "messages"))
+def search_text():
+    """Ranked full-text search over messages and self-descriptions.
 
+    ?q= is required; ?kind=message|description, ?user_id=, ?direction=,
+    ?from=&to=, ?limit= and the ?after= cursor narrow and page the results.
+    """
+    try:
+        args = request.args
+        terms = search.parse_query(args.get("q"))
+        kind = search.parse_kind(args.get("kind"))
+        direction = args.get("direction")
+        if direction and direction not in ("incoming", "outgoing"):
+            raise ValueError("direction must be 'incoming' or 'outgoing'")
+        user_id = args.get("user_id")
+        if user_id is not None and not user_id.isdigit():
+            raise ValueError("user_id must be an integer")
+        with get_read_session() as session:
+            results, next_cursor = search.search(
+                session, terms,
+                kind=kind,
+                user_id=int(user_id) if user_id is not None else None,
+                direction=direction,
+                start=listing.parse_date_bound(args.get("from")),
+                end=listing.parse_date_bound(args.get("to"), end=True),
+                after=args.get("after"),
+                limit=listing.parse_limit(args.get("limit"))
+            )
+        return jsonify({"results": results, "next_cursor": next_cursor})
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error in location analytics: {str(e)}")
+        logger.exception("Error in search")
         return jsonify({"error": str(e)}), 500
 
+def _wants_archived():
+    return request.args.get("include_archived", "").lower() in ("1", "true", "yes")
+
+def _list_response(key, build_query, to_dict, archived=None, kind=None):
+    """Serve a keyset-paginated page, or the whole result as NDJSON with ?format=ndjson.
+
+    `archived(session, args)` yields older rows kept outside the table;
+    they are streamed ahead of the live rows (NDJSON only). The first
+    page also carries a `since` cursor for the head of `kind` (see sync.py).
+    """
+    args = request.args.to_dict()
+    listing.validate_args(args)
+
+    if args.get("format") == "ndjson":
+        # Checked before the stream starts; errors after the headers would truncate it
+        limit = listing.parse_stream_limit(args.get("limit"))
+
+        def generate():
+            with get_read_session() as session:
+                before = archived(session, args) if archived else ()
+                yield from listing.iter_ndjson(build_query(session, args), to_dict, limit, before)
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    if archived:
+        raise ValueError("include_archived requires format=ndjson")
+    limit = listing.parse_limit(args.get("limit"))
+    with get_read_session() as session:
+        # Taken before the page is read, so nothing written meanwhile is lost
+        since = sync.encode_position(sync.head(session, (kind,))) if kind and not args.get("after") else None
+        items, next_cursor = listing.fetch_page(build_query(session, args), limit, to_dict)
+        body = {key: items, "next_cursor": next_cursor}
+        if since is not None:
+            body["since"] = since
+        return jsonify(body)
+
+def _since_response(key, kind):
+    """Rows of `kind` created or changed after ?since=, honouring the list filters."""
+    args = request.args.to_dict()
+    listing.validate_args(args)
+    position = sync.decode_position(args["since"])
+    limit = listing.parse_limit(args.get("limit"))
+    with get_read_session() as session:
+        entries, has_more = sync.changes(session, kind, position, limit, args)
+    if entries:
+        position = entries[-1][1]
+    return jsonify({
+        key: [item for item, _ in entries],
+        "since": sync.encode_position(position),
+        "has_more": has_more
+    })
+
 @app.route("/api/penzi/users", methods=["GET"])
+@response_cache.cached(tags=("users",))
 def get_users():
     try:
-        print("Attempting to fetch users...")  # Debug log
-        with get_session() as session:
-            users = session.query(User).all()
-            user_count = len(users)
-            print(f"Found {user_count} users")  # Debug log
-            return jsonify({
-                "users": [{
-                    'id': user.id,
-                    'name': user.name,
-                    'age': user.age,
-                    'gender': user.gender,
-                    'county': user.county,
-                    'town': user.town,
-                    'created_at': user.created_at.isoformat()
-                } for user in users]
-            })
+        if "ids" in request.args:
+            user_ids = profiles.parse_ids(request.args["ids"])
+            with get_read_session() as session:
+                return jsonify({"users": [
+                    profiles.serialize(user) for user in profiles.load_profiles(session, user_ids)
+                ]})
+        if "since" in request.args:
+            return _since_response("users", "user")
+        return _list_response("users", listing.user_query, listing.user_row_to_dict, kind="user")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error in get_users: {str(e)}")  # Debug log
+        logger.exception("Error in get_users")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/penzi/messages", methods=["GET"])
 def get_messages():
     try:
-        # Add some debug logging
-        print("Fetching messages...")
-        with get_session() as session:
-            messages = session.query(Message).all()
-            print(f"Found {len(messages)} messages")
-            return jsonify({
-                "messages": [{
-                    'id': message.id,
-                    'direction': message.message_direction,
-                    'text': message.message_text,
-                    'created_at': message.created_at.isoformat()
-                } for message in messages]
-            })
+        if "since" in request.args:
+            return _since_response("messages", "message")
+        archived = None
+        if _wants_archived():
+            if request.args.get("county"):
+                return jsonify({"error": "include_archived cannot be combined with county"}), 400
+            archived = partitions.archived_for_listing
+        return _list_response("messages", listing.message_query, listing.message_row_to_dict, archived,
+                              kind="message")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error fetching messages: {str(e)}")
+        logger.exception("Error fetching messages")
         return jsonify({"error": "Failed to fetch messages"}), 500
 
+@app.route("/api/penzi/events", methods=["GET"])
+def stream_events():
+    """Server-sent events for new messages, users and match requests.
+
+    Resumes from ?since= or the Last-Event-ID header, otherwise starts at
+    the newest rows; ?types=message,user,match narrows the stream.
+    """
+    try:
+        cursor = request.args.get("since") or request.headers.get("Last-Event-ID")
+        position = sync.decode_position(cursor) if cursor else {}
+        kinds = sync.parse_kinds(request.args.get("types"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not sync.stream_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many open event streams"}), 503
+    response = Response(
+        sync.event_stream(get_read_session, position, kinds),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Runs when the stream ends or the client disconnects
+    response.call_on_close(sync.stream_slots.release)
+    return response
+
 @app.route("/api/penzi/dashboard/stats", methods=["GET"])
+@response_cache.cached(tags=("users", "messages", "matches"))
 def get_stats():
     try:
-        with get_session() as session:
-            today = datetime.now().date()
-            yesterday = today - timedelta(days=1)
-            
-            # Get daily stats for the last 7 days
-            timeline_labels = []
-            timeline_users = []
-            timeline_messages = []
-            timeline_matches = []
-
-            for i in range(6, -1, -1):  # 7 days, from oldest to newest
-                date = today - timedelta(days=i)
-                date_start = date
-                date_end = date + timedelta(days=1)
-                
-                daily_users = session.query(func.count(User.id)).filter(
-                    func.date(User.created_at) == date
-                ).scalar() or 0
-                
-                daily_messages = session.query(func.count(Message.id)).filter(
-                    Message.created_at >= date_start,
-                    Message.created_at < date_end
-                ).scalar() or 0
-                
-                daily_matches = session.query(func.count(Message.id)).filter(
-                    Message.created_at >= date_start,
-                    Message.created_at < date_end,
-                    Message.message_text.like('match%')
-                ).scalar() or 0
-
-                timeline_labels.append(date.strftime("%d %b"))
-                timeline_users.append(daily_users)
-                timeline_messages.append(daily_messages)
-                timeline_matches.append(daily_matches)
-
-            # Get gender distribution
-            gender_stats = session.query(
-                User.gender,
-                func.count(User.id).label('count')
-            ).group_by(User.gender).all()
-
-            gender_labels = [g[0] for g in gender_stats]
-            gender_data = [g[1] for g in gender_stats]
-
-            # Get age distribution
-            age_ranges = [
-                (18, 25, "18-25"),
-                (26, 35, "26-35"),
-                (36, 45, "36-45"),
-                (46, 55, "46-55"),
-                (56, 100, "56+")
-            ]
-
-            age_labels = []
-            age_data = []
-
-            for min_age, max_age, label in age_ranges:
-                count = session.query(func.count(User.id)).filter(
-                    User.age >= min_age,
-                    User.age <= max_age
-                ).scalar() or 0
-                age_labels.append(label)
-                age_data.append(count)
-
-            # Calculate main stats
-            total_users = session.query(func.count(User.id)).scalar()
-            users_yesterday = session.query(func.count(User.id)).filter(
-                func.date(User.created_at) < today
-            ).scalar() or 1
-
-            active_matches_today = session.query(func.count(Message.id)).filter(
-                Message.created_at >= today,
-                Message.message_text.like('match%')
-            ).scalar()
-            active_matches_yesterday = session.query(func.count(Message.id)).filter(
-                Message.created_at >= yesterday,
-                Message.created_at < today,
-                Message.message_text.like('match%')
-            ).scalar() or 1
-
-            messages_today = session.query(func.count(Message.id)).filter(
-                Message.created_at >= today
-            ).scalar()
-            messages_yesterday = session.query(func.count(Message.id)).filter(
-                Message.created_at >= yesterday,
-                Message.created_at < today
-            ).scalar() or 1
-
-            # Calculate percentage changes
-            users_change = ((total_users - users_yesterday) / users_yesterday * 100)
-            matches_change = ((active_matches_today - active_matches_yesterday) / active_matches_yesterday * 100)
-            messages_change = ((messages_today - messages_yesterday) / messages_yesterday * 100)
-
-            # Success rate calculation
-            total_matches = session.query(func.count(Message.id)).filter(
-                Message.message_text.like('match%')
-            ).scalar() or 1
-            successful_matches = session.query(func.count(Message.id)).filter(
-                Message.message_text.like('NEXT%')
-            ).scalar()
-            success_rate = (successful_matches / total_matches * 100)
-            success_rate_yesterday = ((successful_matches - 1) / total_matches * 100) if successful_matches > 0 else 0
-            success_change = success_rate - success_rate_yesterday
+        days = request.args.get("days", DEFAULT_WINDOW_DAYS, type=int)
+        if days < 1 or days > MAX_WINDOW_DAYS:
+            return jsonify({"error": f"days must be between 1 and {MAX_WINDOW_DAYS}"}), 400
 
-            return jsonify({
-                "totalUsers": total_users,
-                "activeMatches": active_matches_today,
-                "messagesToday": messages_today,
-                "successRate": round(success_rate, 1),
-                "dailyChange": {
-                    "users": round(users_change, 1),
-                    "matches": round(matches_change, 1),
-                    "messages": round(messages_change, 1),
-                    "success": round(success_change, 1)
-                },
-                "charts": {
-                    "timeline": {
-                        "labels": timeline_labels,
-                        "datasets": {
-                            "users": timeline_users,
-                            "messages": timeline_messages,
-                            "matches": timeline_matches
-                        }
-                    },
-                    "gender": {
-                        "labels": gender_labels,
-                        "data": gender_data
-                    },
-                    "ageDistribution": {
-                        "labels": age_labels,
-                        "data": age_data
-                    }
-                }
-            })
+        with get_read_session() as session:
+            collect = collect_live if request.args.get("source") == "live" else rollups.collect
+            return jsonify(dashboard_stats(session, days=days, collect=collect))
 
     except Exception as e:
-        print(f"Error in dashboard stats: {str(e)}")
+        logger.exception("Error in dashboard stats")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/penziusers/export", methods=['GET'])
 def export_users():
     try:
+        args = request.args.to_dict()
+        output_format = args.get("format", "csv")
+        export.check_format(output_format)
+        columns = export.select_columns(args.get("columns"))
+        listing.validate_args(args)
+        compress = output_format == "csv" and args.get("gzip", "").lower() in ("1", "true", "yes")
+
+        def generate():
+            with get_read_session() as session:
+                rows = export.iter_rows(export.export_query(session, columns, args))
+                if output_format == "parquet":
+                    yield from export.iter_parquet(rows, columns)
+                elif compress:
+                    yield from export.gzip_chunks(export.iter_csv(rows, columns))
+                else:
+                    yield from export.iter_csv(rows, columns)
+
+        filename = f"users-{datetime.now().strftime('%Y-%m-%d')}"
+        if output_format == "parquet":
+            filename, mimetype = f"{filename}.parquet", "application/vnd.apache.parquet"
+        elif compress:
+            filename, mimetype = f"{filename}.csv.gz", "application/gzip"
+        else:
+            filename, mimetype = f"{filename}.csv", "text/csv"
+
+        output = Response(stream_with_context(generate()), mimetype=mimetype)
+        output.headers["Content-Disposition"] = f"attachment; filename={filename}"
+        return output
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except export.ExportUnavailable as e:
+        return jsonify({"error": str(e)}), 501
+    except Exception as e:
+        logger.exception("Error exporting users")
+        return jsonify({"error": str(e)}), 500
+
+def _jobs_unauthorized():
+    """An error response unless the request carries the JOBS_API_TOKEN bearer token."""
+    if not Config.JOBS_API_TOKEN:
+        return jsonify({"error": "The jobs API is disabled; set JOBS_API_TOKEN"}), 403
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), Config.JOBS_API_TOKEN.encode()):
+        response = jsonify({"error": "Missing or invalid bearer token"})
+        response.headers["WWW-Authenticate"] = "Bearer"
+        return response, 401
+    return None
+
+@app.route("/api/penzi/jobs", methods=["POST"])
+def submit_job():
+    """Queue a background job (see jobs.py) and return it with 202.
+
+    Takes JSON {"name": ..., "params": {...}} with an Authorization:
+    Bearer JOBS_API_TOKEN header; only jobs.API_JOBS may be queued here.
+    Poll the returned job at /api/penzi/jobs/<id> until its status is
+    succeeded or failed.
+    """
+    unauthorized = _jobs_unauthorized()
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        payload = request.get_json(silent=True) or {}
+        if not payload.get("name"):
+            return jsonify({"error": "name is required"}), 400
+        if payload["name"] not in jobs.API_JOBS:
+            return jsonify({"error": f"Only these jobs may be submitted here: {', '.join(jobs.API_JOBS)}"}), 403
         with get_session() as session:
-            # Get all users with their details
-            users = session.query(User).all()
-            
-            # Create a StringIO object to write CSV data
-            si = StringIO()
-            writer = csv.writer(si)
-            
-            # Write headers
-            writer.writerow([
-                'ID', 'Name', 'Age', 'Gender', 'County', 'Town', 
-                'Education', 'Profession', 'Marital Status', 
-                'Religion', 'Ethnicity', 'Description', 'Joined Date'
-            ])
-            
-            # Write user data
-            for user in users:
-                # Get additional details
-                details = session.query(UserMoreDetails).filter_by(user_id=user.id).first()
-                description = session.query(UserSelfDescription).filter_by(user_id=user.id).first()
-                
-                writer.writerow([
-                    user.id,
-                    user.name,
-                    user.age,
-                    user.gender,
-                    user.county,
-                    user.town,
-                    details.level_of_education if details else '',
-                    details.profession if details else '',
-                    details.marital_status if details else '',
-                    details.religion if details else '',
-                    details.ethnicity if details else '',
-                    description.description if description else '',
-                    user.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                ])
-            
-            # Create the response
-            output = make_response(si.getvalue())
-            output.headers["Content-Disposition"] = f"attachment; filename=users-{datetime.now().strftime('%Y-%m-%d')}.csv"
-            output.headers["Content-type"] = "text/csv"
-            return output
-            
+            job = jobs.submit(session, payload["name"], payload.get("params"))
+            response = jsonify(jobs.serialize(job))
+            response.headers["Location"] = f"/api/penzi/jobs/{job.id}"
+        return response, 202
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"Error exporting users: {str(e)}")
+        logger.exception("Error submitting job")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/penzi/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    unauthorized = _jobs_unauthorized()
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        # The primary, so a poll never sees a status older than the last one
+        with get_session() as session:
+            job = session.get(Job, job_id)
+            if job is None:
+                return jsonify({"error": "Job not found"}), 404
+            return jsonify(jobs.serialize(job))
+
+    except Exception as e:
+        logger.exception("Error in get_job")
         return jsonify({"error": str(e)}), 500
 
 @app.errorhandler(404)
@@ -406,94 +539,33 @@ def server_error(e):
     return jsonify({"error": "Internal server error"}), 500
 
 @app.route('/api/penzi/users/<int:user_id>', methods=['GET'])
+@response_cache.cached(tags=("users",))
 def get_user_details(user_id):
     try:
-        with get_session() as session:
-            user = session.query(User).filter(User.id == user_id).first()
+        with get_read_session() as session:
+            user = profiles.load_profile(session, user_id)
             if not user:
                 return jsonify({"error": "User not found"}), 404
+            return jsonify(profiles.serialize(user))
 
-            print(f"Found {len(messages)} messages for user")
-
-            # Initialize data containers
-            registration_data = {}
-            details_data = {}
-            description = None
-
-            # Process all messages to extract information
-            for message in messages:
-                text = message.message_text.lower()
-                print(f"Processing message: {text[:50]}...")  # Log first 50 chars
-
-                # Process START message
-                if text.startswith('start#'):
-                    parts = message.message_text.split('#')
-                    if len(parts) >= 6:
-                        registration_data = {
-                            'name': parts[1],
-                            'age': parts[2],
-                            'gender': parts[3],
-                            'county': parts[4],
-                            'town': parts[5].strip()
-                        }
-                        print(f"Extracted registration data: {registration_data}")
-
-                # Process DETAILS message
-                elif text.startswith('details#'):
-                    parts = message.message_text.split('#')
-                    if len(parts) >= 6:
-                        details_data = {
-                            'education': parts[1],
-                            'profession': parts[2],
-                            'marital_status': parts[3],
-                            'religion': parts[4],
-                            'ethnicity': parts[5].strip()
-                        }
-                        print(f"Extracted details data: {details_data}")
-
-                # Process MYSELF message
-                elif text.startswith('myself'):
-                    description = message.message_text.replace('MYSELF', '', 1).strip()
-                    print(f"Extracted description: {description}")
-
-                'id': user.id,
-                'name': registration_data.get('name', user.name),
-                'age': int(registration_data.get('age', user.age)),
-                'gender': registration_data.get('gender', user.gender),
-                'county': registration_data.get('county', user.county),
-                'town': registration_data.get('town', user.town),
-                'created_at': user.created_at.isoformat() if user.created_at else None,
-                'details': {
-                    'education': details_data.get('education'),
-                    'profession': details_data.get('profession'),
-                    'marital_status': details_data.get('marital_status'),
-                    'religion': details_data.get('religion'),
-                    'ethnicity': details_data.get('ethnicity')
-                },
-                'description': description
-            }
-            
-            print(f"Final user data being returned: {user_data}")
-            return jsonify(user_data)
-            
     except Exception as e:
-        print(f"Error in get_user_details: {str(e)}")
-        print(f"Exception type: {type(e)}")
-        import traceback
-        print(traceback.format_exc())
+        logger.exception("Error in get_user_details")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/penzi/users/<int:user_id>/messages', methods=['GET'])
 def get_user_messages(user_id):
     try:
-        print(f"Fetching messages for user_id: {user_id}")
-        with get_session() as session:
+        logger.debug("Fetching messages for user_id %s", user_id)
+        with get_read_session() as session:
             messages = session.query(Message).filter(
                 Message.user_id == user_id
             ).order_by(Message.created_at.desc()).all()
+            if _wants_archived():
+                # Archived months are older than anything left in the table
+                messages += reversed(list(partitions.archived_messages(session, user_id=user_id)))
             
-            print(f"Found {len(messages)} messages")
-            
+            logger.debug("Found %d messages for user_id %s", len(messages), user_id)
+
             formatted_messages = [{
                 'id': message.id,
                 'message_text': message.message_text,
@@ -501,11 +573,10 @@ def get_user_messages(user_id):
                 'created_at': message.created_at.isoformat(),
                 'user_id': message.user_id
             } for message in messages]
-            
-            print(f"Returning {len(formatted_messages)} formatted messages")
+
             return jsonify({"messages": formatted_messages})
             
     except Exception as e:
-        print(f"Error fetching messages: {str(e)}")
+        logger.exception("Error fetching messages")
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,66 @@
+"""Async engine and sessions for the asyncio SMS path.
+
+Needs SQLAlchemy's asyncio extra (greenlet) plus aiomysql for MySQL or
+aiosqlite for SQLite. Sessions are built on SessionLocal's Session class,
+so the flush/commit hooks in rollups, matching and cache run for async
+writes exactly as they do for get_session().
+"""
+from contextlib import asynccontextmanager
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+from config import Config
+from database import SessionLocal, engine_options
+
+ASYNC_DRIVERS = {"mysql": "aiomysql", "sqlite": "aiosqlite"}
+
+_sessionmaker = None
+
+
+def async_url(url):
+    """`url` with its driver swapped for the asyncio one, e.g. mysql+pymysql -> mysql+aiomysql."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def make_async_engine(url=None, config=Config, pooled=True):
+    """Async engine for `url` (default: the configured database).
+
+    Pass pooled=False when every call runs on a fresh event loop, as in
+    Flask's async views: pooled connections are bound to the loop that
+    opened them.
+    """
+    url = async_url(url or config.SQLALCHEMY_DATABASE_URI)
+    options = engine_options(url, config, pooled=pooled)
+    if not pooled:
+        options["poolclass"] = NullPool
+    return create_async_engine(url, **options)
+
+
+def make_sessionmaker(async_engine):
+    return async_sessionmaker(
+        async_engine,
+        sync_session_class=SessionLocal.class_,
+        autoflush=False,
+        expire_on_commit=False
+    )
+
+
+def get_sessionmaker():
+    """Sessionmaker for Flask's async views, created on first use."""
+    global _sessionmaker
+    if _sessionmaker is None:
+        _sessionmaker = make_sessionmaker(make_async_engine(pooled=False))
+    return _sessionmaker
+
+
+@asynccontextmanager
+async def get_async_session(sessionmaker=None):
+    """Async counterpart of database.get_session(): commits on success, rolls back on error."""
+    sessionmaker = sessionmaker or get_sessionmaker()
+    async with sessionmaker() as session:
+        async with session.begin():
+            yield session
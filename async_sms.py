@@ -0,0 +1,100 @@
+"""Asyncio variant of the inbound SMS path.
+
+The command handlers in sms are reused as they are and run inside the
+transaction through AsyncSession.run_sync. What the async path adds is
+that the lookups a command needs before it can run are issued
+concurrently, each on its own connection:
+
+    every command    the sender
+    NEXT             + the sender's latest match batch
+    DESCRIBE / 07..  + the profile being asked about
+    MATCH            then the town and county candidate searches together
+
+The results are merged into the transaction's session and handed to the
+handler as Conversation.prefetched, so a message waits for the slowest
+lookup instead of the sum of them.
+"""
+import asyncio
+from datetime import datetime
+from models import User, MatchBatch
+from commands import parse, ValidationError, MatchCommand, Next, ProfileRequest, Describe
+from matching import OPPOSITE_GENDER
+from async_db import get_async_session, get_sessionmaker
+import matching
+import inbound
+import outbound
+import profiles
+import sms
+
+
+async def _lookup(sessionmaker, fn, *args):
+    """Run the sync query function fn(session, *args) on a connection of its own."""
+    async with sessionmaker() as session:
+        return await session.run_sync(fn, *args)
+
+
+def _load_user(session, phone_number):
+    return profiles.profile_query(session).filter(User.phone_number == phone_number).first()
+
+
+def _latest_batch(session, phone_number):
+    return (
+        session.query(MatchBatch)
+        .join(User, MatchBatch.user_id == User.id)
+        .filter(User.phone_number == phone_number)
+        .order_by(MatchBatch.id.desc())
+        .first()
+    )
+
+
+async def prefetch(sessionmaker, phone_number, command):
+    """The sender plus whatever `command` will look up, gathered concurrently."""
+    lookups = {"sender": _lookup(sessionmaker, _load_user, phone_number)}
+    if isinstance(command, (ProfileRequest, Describe)):
+        lookups["target"] = _lookup(sessionmaker, _load_user, sms.normalize_phone(command.phone_number))
+    elif isinstance(command, Next):
+        lookups["batch"] = _lookup(sessionmaker, _latest_batch, phone_number)
+    found = dict(zip(lookups, await asyncio.gather(*lookups.values())))
+
+    sender = found["sender"]
+    if isinstance(command, MatchCommand) and sender is not None:
+        gender = OPPOSITE_GENDER.get(sender.gender, "Female")
+        by_town, by_county = await asyncio.gather(*(
+            _lookup(sessionmaker, matching.candidate_ids, gender,
+                    command.min_age, command.max_age, location_column, command.location,
+                    matching.POOL_SIZE)
+            for location_column in (User.town, User.county)
+        ))
+        # Same precedence as matching.find_candidates: town first, then county; ranked in sms._match
+        found["candidates"] = by_town or by_county
+    return found
+
+
+def _handle_prefetched(session, phone_number, message_text, found, idempotency_key=None):
+    receipt = inbound.claim(session, idempotency_key, phone_number)
+    merged = {
+        name: session.merge(value, load=False) if isinstance(value, (User, MatchBatch)) else value
+        for name, value in found.items()
+    }
+    sender = merged.pop("sender")
+    conv = sms.handle(session, phone_number, message_text, sender=sender, prefetched=merged)
+    sms.store_rows(session, sms.message_rows(conv, message_text, datetime.utcnow()))
+    outbound.enqueue(session, sms.outbound_rows(conv))
+    inbound.record(session, receipt, conv)
+    return conv
+
+
+async def handle(phone_number, message_text, sessionmaker=None, idempotency_key=None):
+    """Handle one inbound SMS and store its messages; returns the Conversation.
+
+    Raises inbound.Duplicate if `idempotency_key` was already handled.
+    """
+    phone_number = sms.normalize_phone(phone_number)
+    try:
+        command = parse(message_text)
+    except ValidationError:
+        command = None  # sms.handle() produces the error reply
+    sessionmaker = sessionmaker or get_sessionmaker()
+    found = await prefetch(sessionmaker, phone_number, command)
+    async with get_async_session(sessionmaker) as session:
+        return await session.run_sync(_handle_prefetched, phone_number, message_text, found, idempotency_key)
@@ -0,0 +1,4 @@
+"""Benchmarks and load generators for the Penzi backend.
+
+Run from the repository root, e.g. ``python -m benchmarks.bench_stats``.
+"""
@@ -0,0 +1,96 @@
+"""Per-message cost of SMS command parsing and dispatch.
+
+Measures commands.parse() alone and sms.handle() (parse + dispatch with
+the handler's queries) against an in-memory SQLite database:
+
+    python -m benchmarks.bench_commands --messages 20000
+"""
+import argparse
+import random
+import time
+from sqlalchemy import create_engine, insert
+from sqlalchemy.pool import StaticPool
+from database import SessionLocal
+from models import Base, User
+from commands import parse, ValidationError
+import sms
+from benchmarks.common import COUNTIES, TOWNS
+
+
+def sample_messages(rng, users, count):
+    """A realistic inbound mix: mostly MATCH/NEXT/profile lookups from registered users."""
+    templates = [
+        (1, lambda: "PENZI"),
+        (1, lambda: "start#Jane Doe#24#Female#Nairobi#Kasarani"),
+        (1, lambda: "details#degree#nurse#single#christian#kikuyu"),
+        (1, lambda: "MYSELF fun, outgoing and kind"),
+        (3, lambda: f"match#{rng.randint(18, 30)}-{rng.randint(31, 45)}#{rng.choice(TOWNS[rng.choice(COUNTIES)])}"),
+        (4, lambda: "NEXT"),
+        (2, lambda: f"07{rng.randint(0, users - 1):08d}"),
+        (2, lambda: f"DESCRIBE 07{rng.randint(0, users - 1):08d}"),
+        (1, lambda: "YES"),
+        (1, lambda: "hello there"),
+    ]
+    weights = [weight for weight, _ in templates]
+    makers = [maker for _, maker in templates]
+    return [
+        (f"07{rng.randint(0, users - 1):08d}", rng.choices(makers, weights)[0]())
+        for _ in range(count)
+    ]
+
+
+def bench_parse(messages):
+    started = time.perf_counter()
+    for _, text in messages:
+        try:
+            parse(text)
+        except ValidationError:
+            pass
+    return time.perf_counter() - started
+
+
+def bench_dispatch(session_factory, messages, flush_every=100):
+    session = session_factory()
+    started = time.perf_counter()
+    for n, (phone_number, text) in enumerate(messages, 1):
+        sms.handle(session, phone_number, text)
+        if n % flush_every == 0:
+            session.rollback()
+    session.rollback()
+    elapsed = time.perf_counter() - started
+    session.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        rows = []
+        for i in range(args.users):
+            county = rng.choice(COUNTIES)
+            rows.append({
+                "name": f"user{i}", "phone_number": f"+2547{i:08d}", "age": rng.randint(18, 60),
+                "gender": rng.choice(["Male", "Female"]), "county": county, "town": rng.choice(TOWNS[county]),
+            })
+        conn.execute(insert(User), rows)
+
+    messages = sample_messages(rng, args.users, args.messages)
+    # The production session factory, so its flush hooks are part of the cost
+    SessionLocal.configure(bind=engine)
+    for name, elapsed in (
+        ("parse", bench_parse(messages)),
+        ("parse+dispatch", bench_dispatch(SessionLocal, messages)),
+    ):
+        per_message = elapsed / len(messages)
+        print(f"{name:15s} {per_message * 1e6:9.1f}us/msg {1 / per_message:12.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""EXPLAIN output and latency of the MATCH candidate search.
+
+Seeds a users table (1M rows by default), then runs random
+MATCH#age-range#town searches without and with the composite indexes:
+
+    python -m benchmarks.bench_match --users 1000000
+"""
+import argparse
+import os
+import random
+import time
+from sqlalchemy import text
+from models import User
+from matching import candidate_query, find_candidates
+from migrations import create_index, has_index, model_index
+from benchmarks.common import BENCH_DIR, COUNTIES, TOWNS, make_engine, seed, session_scope
+
+INDEX_NAMES = ("ix_users_gender_town_age", "ix_users_gender_county_age")
+
+
+def explain(session, query):
+    dialect = session.bind.dialect
+    compiled = query.statement.compile(
+        dialect=dialect, compile_kwargs={"literal_binds": True}
+    )
+    prefix = "EXPLAIN QUERY PLAN" if dialect.name == "sqlite" else "EXPLAIN"
+    return [tuple(row) for row in session.execute(text(f"{prefix} {compiled}"))]
+
+
+def run_searches(session, searches):
+    timings = []
+    for gender, min_age, max_age, town in searches:
+        requester = User(gender="Male" if gender == "Female" else "Female")
+        started = time.perf_counter()
+        find_candidates(session, requester, min_age, max_age, town)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="database URL (default: local SQLite file)")
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--searches", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = make_engine(args.url, path=os.path.join(BENCH_DIR, "penzi_match.sqlite"))
+    seed(engine, users=args.users, messages=0)
+
+    rng = random.Random(11)
+    searches = []
+    for _ in range(args.searches):
+        county = rng.choice(COUNTIES)
+        min_age = rng.randint(18, 50)
+        searches.append((rng.choice(["Male", "Female"]), min_age, min_age + rng.randint(2, 10),
+                         rng.choice(TOWNS[county])))
+
+    with session_scope(engine) as session:
+        sample = candidate_query(session, "Female", 23, 25, User.town, "Naivasha")
+        for label, setup in (("without indexes", "drop"), ("with indexes", "create")):
+            with engine.begin() as connection:
+                for name in INDEX_NAMES:
+                    if setup == "drop":
+                        if has_index(connection, "users", name):
+                            on_table = " ON users" if connection.dialect.name == "mysql" else ""
+                            connection.execute(text(f"DROP INDEX {name}{on_table}"))
+                    else:
+                        create_index(connection, model_index(User, name))
+            session.commit()  # start a fresh transaction that sees the schema change
+            p50, p95 = run_searches(session, searches)
+            print(f"== {label}: p50={p50 * 1000:.2f}ms p95={p95 * 1000:.2f}ms")
+            for row in explain(session, sample):
+                print("   ", row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Latency of MATCH candidate ranking.
+
+Fills a ranking.AttributeStore with random profiles (1M users by default)
+and times scoring plus top-k selection of random candidate pools, with
+NumPy and with a per-candidate Python loop for comparison:
+
+    python -m benchmarks.bench_rank --users 1000000 --pool 50000
+"""
+import argparse
+import random
+import time
+import numpy as np
+import ranking
+from benchmarks.common import EDUCATION, PROFESSIONS, MARITAL_STATUSES, RELIGIONS, ETHNICITIES
+
+VOCABULARIES = {
+    "level_of_education": EDUCATION,
+    "profession": PROFESSIONS,
+    "marital_status": MARITAL_STATUSES,
+    "religion": RELIGIONS,
+    "ethnicity": ETHNICITIES,
+}
+
+
+def fill_store(users, rng):
+    """A store of `users` random profiles, written straight into its rows."""
+    store = ranking.AttributeStore()
+    store._grow(users)
+    rows = store.rows
+    for field, name in enumerate(ranking.FIELDS):
+        codes = np.array([store.code(field, value) for value in VOCABULARIES[name]], dtype=np.int16)
+        rows[:, field] = codes[rng.integers(0, len(codes), len(store))]
+    levels = np.array([ranking.EDUCATION_LEVELS.get(value, -1) for value in EDUCATION], dtype=np.int16)
+    # Interned codes start after OTHER, in vocabulary order
+    rows[:, ranking.EDUCATION_LEVEL] = levels[rows[:, ranking.EDUCATION] - ranking.OTHER - 1]
+    rows[:, ranking.AGE] = rng.integers(18, 70, len(store))
+    rows[:, ranking.FLAGS] = (ranking.LOADED
+                              | (rng.random(len(store)) < 0.8) * ranking.HAS_DETAILS
+                              | (rng.random(len(store)) < 0.6) * ranking.HAS_DESCRIPTION)
+    return store
+
+
+def python_rank(store, profile, ids, min_age, max_age, limit):
+    """The same scores computed one candidate at a time."""
+    middle = (min_age + max_age) / 2
+    half_width = max((max_age - min_age) / 2, 1)
+    level = profile["education_level"]
+    scored = []
+    for user_id in ids.tolist():
+        row = store.rows[user_id].tolist()
+        score = 0.0
+        for name in ranking.EXACT_MATCH_FIELDS:
+            field = ranking.FIELDS.index(name)
+            code = profile["codes"][field]
+            if code not in (ranking.UNKNOWN, ranking.OTHER) and row[field] == code:
+                score += ranking.WEIGHTS[name]
+        candidate_level = row[ranking.EDUCATION_LEVEL]
+        if level >= 0 and candidate_level >= 0:
+            score += ranking.WEIGHTS["education"] * (1 - abs(candidate_level - level) / ranking.MAX_EDUCATION_GAP)
+        if row[ranking.FLAGS] & ranking.HAS_DETAILS:
+            score += ranking.WEIGHTS["has_details"]
+        if row[ranking.FLAGS] & ranking.HAS_DESCRIPTION:
+            score += ranking.WEIGHTS["has_description"]
+        score -= ranking.WEIGHTS["age"] * abs(row[ranking.AGE] - middle) / half_width
+        scored.append((-score, user_id))
+    scored.sort()
+    return [user_id for _, user_id in scored[:limit]]
+
+
+def numpy_rank(store, profile, ids, min_age, max_age, limit):
+    known, scores = ranking.score(store, profile, ids, min_age, max_age)
+    return ranking.top_k(known, scores, limit)
+
+
+def time_runs(rank, store, searches, limit):
+    timings = []
+    for profile, ids, min_age, max_age in searches:
+        started = time.perf_counter()
+        rank(store, profile, ids, min_age, max_age, limit)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--pool", type=int, default=50000)
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--python-searches", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    store = fill_store(args.users, rng)
+    picker = random.Random(7)
+    searches = []
+    for _ in range(args.searches):
+        requester = {name: picker.choice(values) for name, values in VOCABULARIES.items()}
+        profile = {
+            "codes": [store.code(field, requester[name]) for field, name in enumerate(ranking.FIELDS)],
+            "education_level": ranking.EDUCATION_LEVELS.get(requester["level_of_education"], -1),
+        }
+        min_age = picker.randint(18, 50)
+        ids = rng.choice(args.users, size=min(args.pool, args.users), replace=False).astype(np.int64)
+        searches.append((profile, ids, min_age, min_age + picker.randint(2, 10)))
+
+    profile, ids, min_age, max_age = searches[0]
+    expected = python_rank(store, profile, ids, min_age, max_age, args.limit)
+    ranked = numpy_rank(store, profile, ids, min_age, max_age, args.limit).tolist()
+    # float32 scores may order near-ties differently from Python floats
+    agreement = len(set(expected) & set(ranked)) / len(expected)
+    print(f"== {args.users} users, pool of {len(ids)}, top {args.limit} "
+          f"(top-k overlap with Python: {agreement:.1%})")
+
+    for label, rank, runs in (("numpy", numpy_rank, searches),
+                              ("python loop", python_rank, searches[:args.python_searches])):
+        p50, p95 = time_runs(rank, store, runs, args.limit)
+        print(f"   {label}: p50={p50 * 1000:.2f}ms p95={p95 * 1000:.2f}ms ({len(runs)} searches)")
+
+
+if __name__ == "__main__":
+    main()
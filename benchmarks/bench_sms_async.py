@@ -0,0 +1,94 @@
+"""Inbound SMS throughput: sync sessions on threads vs the asyncio path.
+
+Replays the same message mix through sms.handle() on a thread pool (one
+transaction per message, as the Flask sync workers do) and through
+async_sms.handle() with the same number of messages in flight:
+
+    python -m benchmarks.bench_sms_async --concurrency 32 --messages 2000
+    python -m benchmarks.bench_sms_async --url mysql+pymysql://user:pw@host/penzi_bench
+
+SQLite serializes writers, so run it against MySQL to see how the async
+path behaves when lookups wait on the network.
+"""
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from database import SessionLocal
+from async_db import make_async_engine, make_sessionmaker
+from benchmarks.common import make_engine, seed
+from benchmarks.bench_commands import sample_messages
+import async_sms
+import sms
+
+
+def run_sync(engine, messages, concurrency):
+    session_factory = sessionmaker(bind=engine, class_=SessionLocal.class_, autoflush=False)
+
+    def handle_one(message):
+        phone_number, text = message
+        session = session_factory()
+        try:
+            conv = sms.handle(session, phone_number, text)
+            sms.store_rows(session, sms.message_rows(conv, text, datetime.utcnow()))
+            session.commit()
+        except Exception:
+            session.rollback()
+            return False
+        finally:
+            session.close()
+        return True
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        succeeded = sum(pool.map(handle_one, messages))
+    return succeeded, time.perf_counter() - started
+
+
+async def run_async(url, messages, concurrency):
+    async_engine = make_async_engine(url)
+    async_sessionmaker = make_sessionmaker(async_engine)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def handle_one(message):
+        phone_number, text = message
+        async with slots:
+            try:
+                await async_sms.handle(phone_number, text, async_sessionmaker)
+            except Exception:
+                return False
+            return True
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(handle_one(message) for message in messages))
+    elapsed = time.perf_counter() - started
+    await async_engine.dispose()
+    return sum(results), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="database URL (default: SQLite file under bench_data/)")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    engine = make_engine(args.url)
+    seed(engine, users=args.users, messages=10000)
+    url = engine.url.render_as_string(hide_password=False)
+
+    rng = random.Random(11)
+    messages = sample_messages(rng, args.users, args.messages)
+    for mode, (succeeded, elapsed) in (
+        ("sync", run_sync(engine, messages, args.concurrency)),
+        ("async", asyncio.run(run_async(url, messages, args.concurrency))),
+    ):
+        print(f"{mode:6s} {succeeded:6d}/{len(messages)} ok {elapsed:8.2f}s {succeeded / elapsed:10.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Query count and latency of the dashboard stats engine.
+
+Compares the grouped engine in stats.py against the previous
+per-day / per-bucket COUNT pattern on a seeded database:
+
+    python -m benchmarks.bench_stats --messages 1000000
+"""
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import User, Message
+from stats import dashboard_stats, AGE_RANGES
+from benchmarks.common import make_engine, seed, session_scope, timed, QueryCounter
+
+
+def legacy_stats(session, days=7):
+    """The COUNT-per-cell query pattern get_stats used before stats.py."""
+    today = datetime.now().date()
+    yesterday = today - timedelta(days=1)
+    for i in range(days - 1, -1, -1):
+        day = today - timedelta(days=i)
+        session.query(func.count(User.id)).filter(func.date(User.created_at) == day).scalar()
+        session.query(func.count(Message.id)).filter(
+            Message.created_at >= day, Message.created_at < day + timedelta(days=1)).scalar()
+        session.query(func.count(Message.id)).filter(
+            Message.created_at >= day, Message.created_at < day + timedelta(days=1),
+            Message.message_text.like('match%')).scalar()
+    session.query(User.gender, func.count(User.id)).group_by(User.gender).all()
+    for min_age, max_age, _ in AGE_RANGES:
+        session.query(func.count(User.id)).filter(User.age >= min_age, User.age <= max_age).scalar()
+    session.query(func.count(User.id)).scalar()
+    session.query(func.count(User.id)).filter(func.date(User.created_at) < today).scalar()
+    session.query(func.count(Message.id)).filter(
+        Message.created_at >= today, Message.message_text.like('match%')).scalar()
+    session.query(func.count(Message.id)).filter(
+        Message.created_at >= yesterday, Message.created_at < today,
+        Message.message_text.like('match%')).scalar()
+    session.query(func.count(Message.id)).filter(Message.created_at >= today).scalar()
+    session.query(func.count(Message.id)).filter(
+        Message.created_at >= yesterday, Message.created_at < today).scalar()
+    session.query(func.count(Message.id)).filter(Message.message_text.like('match%')).scalar()
+    session.query(func.count(Message.id)).filter(Message.message_text.like('NEXT%')).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="database URL (default: local SQLite file)")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--days", type=int, default=7, help="dashboard window length")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = make_engine(args.url)
+    seed(engine, users=args.users, messages=args.messages)
+
+    with session_scope(engine) as session:
+        for name, fn in (
+            ("legacy", lambda: legacy_stats(session, days=args.days)),
+            ("grouped", lambda: dashboard_stats(session, days=args.days)),
+        ):
+            with QueryCounter(engine) as counter:
+                fn()
+            _, best, mean = timed(fn, repeat=args.repeat)
+            print(f"{name:8s} queries={counter.count:3d} best={best * 1000:8.1f}ms mean={mean * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import os
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import sessionmaker
+from models import Base, User, Message, UserMoreDetails, UserSelfDescription, MatchRequest, MatchBatch
+
+BENCH_DIR = "bench_data"
+DEFAULT_DB_PATH = os.path.join(BENCH_DIR, "penzi_bench.sqlite")
+
+# Population in thousands (2019 census), used to weight where seeded users live
+COUNTY_POPULATION = {
+    "Nairobi": 4397, "Kiambu": 2418, "Nakuru": 2162, "Kakamega": 1868, "Bungoma": 1671,
+    "Meru": 1545, "Kilifi": 1453, "Machakos": 1421, "Kisii": 1266, "Mombasa": 1208,
+    "Kisumu": 1155, "Uasin Gishu": 1163, "Nyeri": 759, "Kajiado": 1117,
+}
+COUNTIES = list(COUNTY_POPULATION)
+TOWNS = {
+    "Nairobi": ["Westlands", "Kasarani", "Embakasi", "Langata", "Kibra"],
+    "Kiambu": ["Thika", "Ruiru", "Kikuyu", "Limuru"],
+    "Nakuru": ["Nakuru", "Naivasha", "Molo", "Gilgil"],
+    "Kakamega": ["Kakamega", "Mumias"],
+    "Bungoma": ["Bungoma", "Webuye", "Kimilili"],
+    "Meru": ["Meru", "Maua", "Nkubu"],
+    "Kilifi": ["Kilifi", "Malindi", "Watamu"],
+    "Machakos": ["Machakos", "Athi River", "Kangundo"],
+    "Kisii": ["Kisii", "Ogembo"],
+    "Mombasa": ["Nyali", "Likoni", "Changamwe"],
+    "Kisumu": ["Kisumu", "Maseno", "Ahero"],
+    "Uasin Gishu": ["Eldoret", "Burnt Forest"],
+    "Nyeri": ["Nyeri", "Karatina", "Othaya"],
+    "Kajiado": ["Kitengela", "Ngong", "Kajiado"],
+}
+EDUCATION = ["primary", "secondary", "certificate", "diploma", "degree", "masters"]
+PROFESSIONS = ["teacher", "nurse", "driver", "farmer", "accountant", "engineer", "trader", "student"]
+MARITAL_STATUSES = ["single", "single", "single", "divorced", "widowed"]
+RELIGIONS = ["christian", "christian", "christian", "muslim", "hindu", "other"]
+ETHNICITIES = ["kikuyu", "luhya", "kalenjin", "luo", "kamba", "kisii", "mijikenda", "meru", "maasai"]
+DESCRIPTIONS = ["fun and outgoing", "quiet, kind and loyal", "chocolate, lovely, sexy", "God fearing and hardworking"]
+MESSAGE_TEXTS = [
+    "PENZI", "start#Jane Doe#24#Female#Nairobi#Kasarani",
+    "details#degree#nurse#single#christian#kikuyu",
+    "MYSELF fun and outgoing", "match#23-25#Nakuru", "NEXT",
+    "DESCRIBE 0722010203", "YES", "You are now registered for dating.",
+]
+
+
+def pick_county(rng):
+    return rng.choices(COUNTIES, weights=[COUNTY_POPULATION[county] for county in COUNTIES])[0]
+
+
+def make_engine(url=None, path=DEFAULT_DB_PATH):
+    """Create an engine for benchmarking, defaulting to a local SQLite file."""
+    if url is None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = f"sqlite:///{path}"
+    return create_engine(url)
+
+
+class QueryCounter:
+    """Counts statements executed on an engine while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+@contextmanager
+def session_scope(engine):
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+        session.commit()
+    finally:
+        session.close()
+
+
+def seed(engine, users=10000, messages=1000000, days=30, chunk=20000, rng=None,
+         details=0.0, descriptions=0.0, match_requests=0):
+    """Create the schema and fill it with synthetic users and messages.
+
+    Optionally also gives a `details` / `descriptions` fraction of users a
+    profile and creates `match_requests` MATCH searches, each with its
+    match batch. Skips seeding when the database already holds users, so
+    repeated runs reuse the same file. User i gets phone number
+    +2547XXXXXXXX with i zero-padded to eight digits, and lives in a county
+    drawn by population.
+    """
+    rng = rng or random.Random(42)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if conn.exec_driver_sql("SELECT COUNT(*) FROM users").scalar():
+            return False
+
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        rows = []
+        for i in range(users):
+            county = pick_county(rng)
+            rows.append({
+                "name": f"user{i}",
+                "phone_number": f"+2547{i:08d}",
+                "age": rng.randint(18, 70),
+                "gender": rng.choice(["Male", "Female"]),
+                "county": county,
+                "town": rng.choice(TOWNS[county]),
+                "created_at": now - timedelta(seconds=rng.randint(0, days * 86400)),
+            })
+        for offset in range(0, users, chunk):
+            conn.execute(insert(User), rows[offset:offset + chunk])
+
+        for offset in range(0, messages, chunk):
+            conn.execute(insert(Message), [{
+                "user_id": rng.randint(1, users),
+                "message_direction": rng.choice(["incoming", "outgoing"]),
+                "message_text": rng.choice(MESSAGE_TEXTS),
+                "created_at": now - timedelta(seconds=rng.randint(0, days * 86400)),
+            } for _ in range(min(chunk, messages - offset))])
+        seed_profiles(conn, rng, users, details, descriptions)
+        seed_match_requests(conn, rng, rows, match_requests, now, days)
+    print(f"Seeded {users} users / {messages} messages in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+def seed_profiles(conn, rng, users, details, descriptions):
+    """Details and descriptions for a random `details` / `descriptions` fraction of users."""
+    detail_rows = [{
+        "user_id": user_id,
+        "level_of_education": rng.choice(EDUCATION),
+        "profession": rng.choice(PROFESSIONS),
+        "marital_status": rng.choice(MARITAL_STATUSES),
+        "religion": rng.choice(RELIGIONS),
+        "ethnicity": rng.choice(ETHNICITIES),
+    } for user_id in range(1, users + 1) if rng.random() < details]
+    description_rows = [
+        {"user_id": user_id, "description": rng.choice(DESCRIPTIONS)}
+        for user_id in range(1, users + 1) if rng.random() < descriptions
+    ]
+    if detail_rows:
+        conn.execute(insert(UserMoreDetails), detail_rows)
+    if description_rows:
+        conn.execute(insert(UserSelfDescription), description_rows)
+
+
+def seed_match_requests(conn, rng, user_rows, count, now, days):
+    """MATCH searches by random users, each with a batch of real candidate ids."""
+    # matching imports database, which reads DATABASE_URL at import time
+    from matching import MAX_CANDIDATES, OPPOSITE_GENDER, pack_ids
+    by_location = {}
+    for user_id, row in enumerate(user_rows, 1):
+        by_location.setdefault((row["gender"], row["town"]), []).append((row["age"], user_id))
+    for _ in range(count):
+        user_id = rng.randint(1, len(user_rows))
+        requester = user_rows[user_id - 1]
+        min_age = rng.randint(18, 45)
+        max_age = min_age + rng.randint(2, 10)
+        town = rng.choice(TOWNS[pick_county(rng)])
+        gender = OPPOSITE_GENDER.get(requester["gender"], "Female")
+        candidates = sorted(
+            (age, candidate_id) for age, candidate_id in by_location.get((gender, town), [])
+            if min_age <= age <= max_age
+        )[:MAX_CANDIDATES]
+        created_at = now - timedelta(seconds=rng.randint(0, days * 86400))
+        request_id = conn.execute(insert(MatchRequest).values(
+            user_id=user_id, age_range=f"{min_age}-{max_age}", county=town,
+            status="active" if candidates else "no_matches", created_at=created_at
+        )).inserted_primary_key[0]
+        if candidates:
+            ids = [candidate_id for _, candidate_id in candidates]
+            conn.execute(insert(MatchBatch).values(
+                request_id=request_id, user_id=user_id, total_matches=len(ids),
+                matches_shown=min(len(ids), rng.randint(0, 9)), match_data="",
+                candidate_ids=pack_ids(ids), created_at=created_at
+            ))
+
+
+def timed(fn, repeat=5):
+    """Run fn `repeat` times and return (last result, best seconds, mean seconds)."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return result, min(timings), sum(timings) / len(timings)
@@ -0,0 +1,361 @@
+"""Fixed-concurrency load test of every route and the SMS flow.
+
+Seeds (or reuses) a dataset with benchmarks.seed, copies it to a scratch
+file so one run's SMS writes never leak into the next, then replays a
+request mix generated from --seed on --concurrency threads, each with
+its own test client. Reports latency percentiles, throughput and SQL
+statements per request (from the X-SQL-Queries header) per scenario as
+JSON with sorted keys, so results from two commits can be diffed:
+
+    python -m benchmarks.load run --requests 5000 --concurrency 8 --out before.json
+    python -m benchmarks.load compare before.json after.json
+
+Statements run by the async driver or while an NDJSON response streams
+happen outside the request's accounting and are not counted; the events
+scenario times the stream up to its first batch of events. SQLite
+allows one writer at a time, so at higher concurrency some SMS writes
+fail with "database is locked" and are reported as 500s; use --url with
+a MySQL database for write-heavy comparisons.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from benchmarks.common import BENCH_DIR, COUNTIES, TOWNS, pick_county, make_engine
+from benchmarks.seed import add_arguments, dataset_path
+
+SCRATCH_PATH = os.path.join(BENCH_DIR, "load-run.sqlite")
+PERCENTILES = (50, 95, 99)
+BATCH_SIZE = 10
+COMPARED = ("p50_ms", "p95_ms", "p99_ms", "queries_mean")
+# SSE responses never end on their own; read this many chunks (the retry
+# line and the first batch of events), then disconnect
+STREAM_CHUNKS = {"events": 2}
+# Enables the jobs API for the run; sent with every request
+JOBS_TOKEN = "load-test"
+STATUS_JOBS = 20  # queued before the run for job_status to read
+
+
+def phone(user_id):
+    """Phone number of seeded user `user_id` (see benchmarks.common.seed), in local form."""
+    return f"07{user_id - 1:08d}"
+
+
+def _match_text(rng):
+    min_age = rng.randint(18, 45)
+    return f"match#{min_age}-{min_age + rng.randint(2, 8)}#{rng.choice(TOWNS[pick_county(rng)])}"
+
+
+def _sms_text(rng, users):
+    """One of the commands a registered user sends."""
+    return rng.choice((
+        _match_text(rng), "NEXT", phone(rng.randint(1, users)),
+        f"DESCRIBE {phone(rng.randint(1, users))}", "YES",
+    ))
+
+
+def _sms(rng, users, text):
+    return "POST", "/api/penzi/sms", {"phone_number": phone(rng.randint(1, users)), "message": text}
+
+
+def _register(rng, users, index):
+    county = pick_county(rng)
+    text = "start#Load Test#{}#{}#{}#{}".format(
+        rng.randint(18, 60), rng.choice(["Male", "Female"]), county, rng.choice(TOWNS[county]))
+    return "POST", "/api/penzi/sms", {"phone_number": f"08{index:08d}", "message": text}
+
+
+def _batch(rng, users):
+    messages = [
+        {"phone_number": phone(rng.randint(1, users)), "message": _sms_text(rng, users)}
+        for _ in range(BATCH_SIZE)
+    ]
+    return "POST", "/api/penzi/sms/batch", {"messages": messages}
+
+
+def _since(days):
+    return (date.today() - timedelta(days=days)).isoformat()
+
+
+# Words from the seeded messages and descriptions (see benchmarks.common)
+SEARCH_TERMS = ("fun", "kind", "loyal", "hardworking", "nurse", "christian", "registered", "outgoing")
+
+
+def _search(rng):
+    terms = "+".join(rng.sample(SEARCH_TERMS, rng.randint(1, 2)))
+    return "GET", f"/api/penzi/search?q={terms}&limit=20", None
+
+
+def _since_cursor(position):
+    # Imported here: sync reads DATABASE_URL, which run() sets first
+    from sync import encode_position
+    return encode_position(position)
+
+
+def _users_since(rng, days):
+    changed_after = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    return "GET", f"/api/penzi/users?since={_since_cursor({'user': [changed_after, 0]})}&limit=100", None
+
+
+def _events(rng, users):
+    # Starts behind the head so the first poll delivers a full batch of events
+    cursor = _since_cursor({"message": rng.randint(0, users)})
+    return "GET", f"/api/penzi/events?types=message&since={cursor}", None
+
+
+# (name, weight, builder(rng, users, index) -> (method, path, json body or None))
+SCENARIOS = [
+    ("index", 1, lambda rng, users, i: ("GET", "/", None)),
+    ("test_db", 1, lambda rng, users, i: ("GET", "/test-db", None)),
+    ("pool_stats", 1, lambda rng, users, i: ("GET", "/api/penzi/pool-stats", None)),
+    ("metrics", 1, lambda rng, users, i: ("GET", "/metrics", None)),
+    ("users_page", 8, lambda rng, users, i: ("GET", "/api/penzi/users?limit=100", None)),
+    ("users_filtered", 6, lambda rng, users, i: (
+        "GET", f"/api/penzi/users?county={pick_county(rng)}&gender={rng.choice(['Male', 'Female'])}&limit=100",
+        None)),
+    ("users_by_ids", 4, lambda rng, users, i: (
+        "GET", "/api/penzi/users?ids=" + ",".join(str(rng.randint(1, users)) for _ in range(10)), None)),
+    ("user_detail", 10, lambda rng, users, i: ("GET", f"/api/penzi/users/{rng.randint(1, users)}", None)),
+    ("user_messages", 6, lambda rng, users, i: (
+        "GET", f"/api/penzi/users/{rng.randint(1, users)}/messages?limit=50", None)),
+    ("messages_page", 6, lambda rng, users, i: ("GET", "/api/penzi/messages?limit=100", None)),
+    ("messages_filtered", 4, lambda rng, users, i: (
+        "GET", f"/api/penzi/messages?direction=incoming&from={_since(rng.randint(1, 14))}&limit=100", None)),
+    ("messages_ndjson", 1, lambda rng, users, i: (
+        "GET", f"/api/penzi/messages?format=ndjson&from={_since(1)}&limit=1000", None)),
+    ("dashboard_stats", 6, lambda rng, users, i: (
+        "GET", f"/api/penzi/dashboard/stats?days={rng.choice([7, 30])}", None)),
+    ("dashboard_stats_live", 1, lambda rng, users, i: ("GET", "/api/penzi/dashboard/stats?source=live", None)),
+    ("location_analytics", 4, lambda rng, users, i: ("GET", "/api/penzi/location-analytics", None)),
+    ("location_analytics_live", 1, lambda rng, users, i: (
+        "GET", "/api/penzi/location-analytics?source=live", None)),
+    ("users_since", 4, lambda rng, users, i: _users_since(rng, rng.randint(1, 14))),
+    ("events", 1, lambda rng, users, i: _events(rng, users)),
+    ("funnel", 2, lambda rng, users, i: (
+        "GET", f"/api/penzi/analytics/funnel?group_by={rng.choice(['county', 'gender', 'age_band', 'signup_week'])}",
+        None)),
+    ("search", 4, lambda rng, users, i: _search(rng)),
+    ("search_descriptions", 2, lambda rng, users, i: (
+        "GET", f"/api/penzi/search?q={rng.choice(SEARCH_TERMS)}&kind=description&limit=20", None)),
+    ("jobs_submit", 1, lambda rng, users, i: (
+        "POST", "/api/penzi/jobs", {"name": "warm_dashboard_stats"})),
+    ("job_status", 2, lambda rng, users, i: ("GET", f"/api/penzi/jobs/{rng.randint(1, STATUS_JOBS)}", None)),
+    ("export_csv", 1, lambda rng, users, i: ("GET", f"/api/penziusers/export?county={rng.choice(COUNTIES)}", None)),
+    ("sms_register", 2, lambda rng, users, i: _register(rng, users, i)),
+    ("sms_match", 8, lambda rng, users, i: _sms(rng, users, _match_text(rng))),
+    ("sms_next", 8, lambda rng, users, i: _sms(rng, users, "NEXT")),
+    ("sms_profile", 4, lambda rng, users, i: _sms(rng, users, phone(rng.randint(1, users)))),
+    ("sms_describe", 4, lambda rng, users, i: _sms(rng, users, f"DESCRIBE {phone(rng.randint(1, users))}")),
+    ("sms_yes", 2, lambda rng, users, i: _sms(rng, users, "YES")),
+    ("sms_batch", 2, lambda rng, users, i: _batch(rng, users)),
+    ("sms_async", 2, lambda rng, users, i: (
+        "POST", "/api/penzi/sms/async", {"phone_number": phone(rng.randint(1, users)), "message": _match_text(rng)})),
+]
+
+
+def build_plan(count, users, rng_seed):
+    """The same `count` requests, in the same order, for a given seed."""
+    rng = random.Random(rng_seed)
+    weights = [weight for _, weight, _ in SCENARIOS]
+    plan = []
+    for index in range(count):
+        name, _, builder = rng.choices(SCENARIOS, weights=weights)[0]
+        plan.append((name,) + builder(rng, users, index))
+    return plan
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, wall_seconds):
+    latencies = sorted(seconds * 1000 for _, _, seconds, _ in samples)
+    queries = [count for _, _, _, count in samples if count is not None]
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for _, status, _, _ in samples if status >= 500),
+        "statuses": {str(status): sum(1 for _, s, _, _ in samples if s == status)
+                     for status in sorted({status for _, status, _, _ in samples})},
+        "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "queries_mean": round(sum(queries) / len(queries), 2) if queries else None,
+        "queries_max": max(queries) if queries else None,
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[f"p{p}_ms"] = round(value, 2) if value is not None else None
+    return summary
+
+
+def run_plan(app, plan, concurrency):
+    """Replay `plan` on `concurrency` threads; returns (samples, wall seconds)."""
+    local = threading.local()
+
+    def send(item):
+        name, method, path, body = item
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body,
+                               headers={"Authorization": f"Bearer {JOBS_TOKEN}"})
+        if name in STREAM_CHUNKS:
+            chunks = iter(response.response)
+            for _ in range(STREAM_CHUNKS[name]):
+                next(chunks, None)
+            response.close()
+        else:
+            response.get_data()
+        elapsed = time.perf_counter() - started
+        queries = response.headers.get("X-SQL-Queries")
+        return name, response.status_code, elapsed, int(queries) if queries is not None else None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(send, plan))
+    return samples, time.perf_counter() - started
+
+
+def git_revision():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return sha + ("-dirty" if dirty else "")
+
+
+def run(args):
+    # Seed in a child process: the app reads DATABASE_URL when it is first
+    # imported, and seeding would import it with the dataset's URL
+    seed_command = [sys.executable, "-m", "benchmarks.seed", "--users", str(args.users),
+                    "--messages", str(args.messages), "--days", str(args.days), "--seed", str(args.seed)]
+    if args.url:
+        # Runs against the given database directly; its SMS writes persist
+        subprocess.run(seed_command + ["--url", args.url], check=True)
+        engine = make_engine(args.url)
+    else:
+        subprocess.run(seed_command, check=True)
+        # A stale WAL from the previous run would be replayed onto the fresh copy
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(SCRATCH_PATH + suffix):
+                os.remove(SCRATCH_PATH + suffix)
+        shutil.copyfile(dataset_path(args.users, args.messages, args.days, args.seed), SCRATCH_PATH)
+        engine = make_engine(path=SCRATCH_PATH)
+        # Lets readers run alongside the single SQLite writer
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+    os.environ["DATABASE_URL"] = engine.url.render_as_string(hide_password=False)
+    os.environ.pop("READ_REPLICA_URL", None)
+    # Failed requests are counted in the report; keep their tracebacks off the console
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    # Submitted jobs stay queued; no runner is started
+    os.environ["JOBS_API_TOKEN"] = JOBS_TOKEN
+    if args.no_cache:
+        os.environ["CACHE_MAX_ENTRIES"] = "0"
+    from app import app
+    import jobs
+    from database import get_session
+    from models import Job
+    with get_session() as session:
+        if session.query(Job.id).count() < STATUS_JOBS:
+            for _ in range(STATUS_JOBS):
+                jobs.submit(session, "warm_dashboard_stats")
+
+    if args.warmup:
+        run_plan(app, build_plan(args.warmup, args.users, args.seed + 1), args.concurrency)
+    plan = build_plan(args.requests, args.users, args.seed)
+    samples, wall_seconds = run_plan(app, plan, args.concurrency)
+
+    by_scenario = {}
+    for sample in samples:
+        by_scenario.setdefault(sample[0], []).append(sample)
+    result = {
+        "meta": {
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "database": engine.dialect.name,
+            "users": args.users,
+            "messages": args.messages,
+            "days": args.days,
+            "seed": args.seed,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "cache": not args.no_cache,
+        },
+        "overall": summarize(samples, wall_seconds),
+        "scenarios": {name: summarize(rows, wall_seconds) for name, rows in by_scenario.items()},
+    }
+    output = json.dumps(result, indent=2, sort_keys=True) + "\n"
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    sys.stdout.write(output)
+
+
+def _change(before, after):
+    if before is None or after is None:
+        return "n/a"
+    if not before:
+        return "new" if after else "+0%"
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"before {before['meta'].get('git')}  after {after['meta'].get('git')}")
+    print(f"{'scenario':24s}" + "".join(f"  {column:>26s}" for column in COMPARED))
+    rows = [("overall", before["overall"], after["overall"])] + [
+        (name, before["scenarios"].get(name, {}), after["scenarios"].get(name, {}))
+        for name in sorted(set(before["scenarios"]) | set(after["scenarios"]))
+    ]
+    for name, old, new in rows:
+        cells = []
+        for column in COMPARED:
+            old_value, new_value = old.get(column), new.get(column)
+            cells.append(f"{old_value} -> {new_value} ({_change(old_value, new_value)})")
+        print(f"{name:24s}" + "".join(f"  {cell:>26s}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seed if needed and run the request mix")
+    add_arguments(run_parser)
+    run_parser.add_argument("--requests", type=int, default=2000)
+    run_parser.add_argument("--warmup", type=int, default=200, help="unrecorded requests run first")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    run_parser.add_argument("--out", help="also write the JSON result here")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Before/after query plans for every endpoint.
+
+Calls each endpoint through the Flask test client against a seeded
+database, captures the SELECTs it issues, and prints their EXPLAIN
+output without and then with the indexes added by migration 0007:
+
+    python -m benchmarks.query_plans
+    python -m benchmarks.query_plans --url mysql+pymysql://user:pw@host/penzi_bench
+
+SQLite plans that contain "SCAN <table>" (MySQL: type ALL) read the whole
+table and are marked with "!".
+"""
+import argparse
+import os
+import time
+from sqlalchemy import event
+from benchmarks.common import BENCH_DIR, make_engine, seed
+
+ENDPOINTS = [
+    ("GET", "/api/penzi/users?limit=100"),
+    ("GET", "/api/penzi/users?county=Nairobi&gender=Female&limit=100"),
+    ("GET", "/api/penzi/users?ids=1,2,3"),
+    ("GET", "/api/penzi/users/1"),
+    ("GET", "/api/penzi/users/1/messages"),
+    ("GET", "/api/penzi/messages?limit=100"),
+    ("GET", "/api/penzi/messages?direction=incoming&from=2026-01-01&limit=100"),
+    ("GET", "/api/penzi/dashboard/stats?source=live"),
+    ("GET", "/api/penzi/dashboard/stats"),
+    ("GET", "/api/penzi/location-analytics?source=live"),
+    ("GET", "/api/penzi/location-analytics"),
+    ("GET", "/api/penziusers/export?county=Nairobi"),
+    ("POST", "/api/penzi/sms"),
+]
+SMS_PAYLOAD = {"phone_number": "0700000001", "message": "match#23-30#Nakuru"}
+
+
+def capture(engine, client, method, path):
+    """SELECT statements (with parameters) issued while serving one request."""
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", on_execute)
+    try:
+        started = time.perf_counter()
+        if method == "POST":
+            response = client.post(path, json=SMS_PAYLOAD)
+        else:
+            response = client.get(path)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(engine, "before_cursor_execute", on_execute)
+    return response.status_code, elapsed, statements
+
+
+def explain(connection, statement, parameters):
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        return [(row[-1], "SCAN " in row[-1] and "USING" not in row[-1]) for row in rows]
+    result = connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+    columns = list(result.keys())
+    plans = []
+    for row in result:
+        row = dict(zip(columns, row))
+        plans.append((f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']}",
+                      row["type"] == "ALL"))
+    return plans
+
+
+def set_indexes(engine, present):
+    from migrations import HOT_QUERY_INDEXES, create_index, has_index, model_index
+    with engine.begin() as connection:
+        for model, index_names in HOT_QUERY_INDEXES.items():
+            for name in index_names:
+                index = model_index(model, name)
+                if present:
+                    create_index(connection, index)
+                elif has_index(connection, model.__tablename__, name):
+                    index.drop(bind=connection)
+
+
+def report(engine, client, response_cache):
+    for method, path in ENDPOINTS:
+        response_cache.backend.clear()
+        status, elapsed, statements = capture(engine, client, method, path)
+        print(f"\n{method} {path} -> {status} in {elapsed * 1000:.1f}ms, {len(statements)} SELECT(s)")
+        with engine.connect() as connection:
+            for statement, parameters in statements:
+                print("  " + " ".join(statement.split())[:150])
+                for line, full_scan in explain(connection, statement, parameters):
+                    print(f"    {'!' if full_scan else ' '} {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="database URL (default: local SQLite file)")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    engine = make_engine(args.url, path=os.path.join(BENCH_DIR, "penzi_plans.sqlite"))
+    seed(engine, users=args.users, messages=args.messages)
+    # The app builds its engine from DATABASE_URL at import time
+    os.environ["DATABASE_URL"] = engine.url.render_as_string(hide_password=False)
+    from app import app
+    from cache import response_cache
+    import database
+
+    client = app.test_client()
+    for label, present in (("WITHOUT 0007 indexes", False), ("WITH 0007 indexes", True)):
+        set_indexes(database.engine, present)
+        print(f"\n===== {label} =====")
+        report(database.engine, client, response_cache)
+
+
+if __name__ == "__main__":
+    main()
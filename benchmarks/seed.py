@@ -0,0 +1,69 @@
+"""Seed a benchmark database with a realistic, reproducible dataset.
+
+Users are spread over counties by population, a share of them have
+details and descriptions, and some have MATCH searches with batches.
+County/town ids, their counters, daily_stats and the search documents
+are rebuilt afterwards so the rollup-backed and search endpoints see the
+same data as the live ones. The same --seed always gives the same rows
+(ids, created_at offsets, profiles):
+
+    python -m benchmarks.seed --users 20000 --messages 500000
+    python -m benchmarks.seed --url mysql+pymysql://user:pw@host/penzi_bench
+"""
+import argparse
+import os
+import random
+from benchmarks.common import BENCH_DIR, make_engine, seed, session_scope
+
+DEFAULTS = {"users": 20000, "messages": 200000, "days": 60, "seed": 42}
+DETAILS_SHARE = 0.6
+DESCRIPTIONS_SHARE = 0.4
+MATCH_REQUESTS_PER_USER = 0.05
+# Bumped when seeded rows change shape, so stale dataset files are not reused
+DATASET_VERSION = 3
+
+
+def dataset_path(users, messages, days, rng_seed):
+    """Seeded SQLite file for one set of volumes, reused across runs."""
+    return os.path.join(BENCH_DIR, f"dataset-v{DATASET_VERSION}-{users}u-{messages}m-{days}d-s{rng_seed}.sqlite")
+
+
+def seed_dataset(engine, users, messages, days, rng_seed):
+    """Fill `engine`'s database unless it already has users; returns True if it seeded."""
+    seeded = seed(
+        engine, users=users, messages=messages, days=days, rng=random.Random(rng_seed),
+        details=DETAILS_SHARE, descriptions=DESCRIPTIONS_SHARE,
+        match_requests=int(users * MATCH_REQUESTS_PER_USER)
+    )
+    if seeded:
+        # Imported here so benchmarks.load can import this module before
+        # it points DATABASE_URL at the database under test
+        import locations
+        import rollups
+        import search
+        with session_scope(engine) as session:
+            locations.backfill(session)
+            rollups.backfill(session)
+            search.backfill(session.connection())
+    return seeded
+
+
+def add_arguments(parser):
+    parser.add_argument("--url", help="database URL (default: a SQLite file under bench_data/)")
+    parser.add_argument("--users", type=int, default=DEFAULTS["users"])
+    parser.add_argument("--messages", type=int, default=DEFAULTS["messages"])
+    parser.add_argument("--days", type=int, default=DEFAULTS["days"], help="spread of created_at")
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    engine = make_engine(args.url, path=dataset_path(args.users, args.messages, args.days, args.seed))
+    if not seed_dataset(engine, args.users, args.messages, args.days, args.seed):
+        print(f"{engine.url} already seeded")
+
+
+if __name__ == "__main__":
+    main()
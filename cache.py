@@ -0,0 +1,219 @@
+"""Response cache for the read-heavy admin endpoints.
+
+Responses are stored under a key built from the endpoint, its query
+arguments and the current generation of every tag the endpoint depends
+on ("users", "messages", ...). Writes invalidate by bumping a tag's
+generation, which orphans every key that included it; the orphans then
+age out through TTL/LRU eviction. This works the same for the in-process
+backend and a shared Redis backend, with no key scans.
+
+Each cached body carries an ETag, so a dashboard polling with
+If-None-Match gets a 304 without the endpoint being recomputed.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response
+from sqlalchemy import event
+from models import User, Message, UserMoreDetails, UserSelfDescription, Match, MatchRequest, MatchBatch
+from database import SessionLocal
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_ENTRIES = 1024
+CLEAR_BATCH_SIZE = 500
+
+# Tags invalidated when rows of these models are written
+MODEL_TAGS = {
+    User: "users",
+    UserMoreDetails: "users",
+    UserSelfDescription: "users",
+    Message: "messages",
+    Match: "matches",
+    MatchRequest: "matches",
+    MatchBatch: "matches",
+}
+
+
+class InProcessBackend:
+    """Thread-safe LRU dict with per-entry expiry."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        # Counters live outside the LRU so eviction can never reset them
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires_at = self.clock() + ttl if ttl else None
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """Shared backend over any redis-py compatible client.
+
+    Only get/set(ex=)/delete/incr, and scan_iter for clear(), are used,
+    so a local fake implementing those calls is enough for tests. Values are stored as JSON.
+    Eviction is left to Redis; use maxmemory-policy volatile-lru so the
+    generation counters, which have no TTL, are never evicted.
+    """
+
+    def __init__(self, client, prefix="penzi:cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        return int(self.client.incr(self.prefix + key))
+
+    def clear(self):
+        """Delete every cached response under the prefix; like the in-process clear, counters stay."""
+        counters = self.prefix + "gen:"
+        keys = []
+        for key in self.client.scan_iter(match=self.prefix + "*", count=CLEAR_BATCH_SIZE):
+            if not (key.decode() if isinstance(key, bytes) else key).startswith(counters):
+                keys.append(key)
+            if len(keys) >= CLEAR_BATCH_SIZE:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generation(self, tag):
+        return self.backend.counter(f"gen:{tag}")
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr(f"gen:{tag}")
+
+    def make_key(self, endpoint, args, tags, extra=""):
+        generations = ",".join(f"{tag}={self.generation(tag)}" for tag in sorted(tags))
+        query = "&".join(f"{name}={value}" for name, value in sorted(args.items(multi=True)))
+        return hashlib.sha1(f"{endpoint}?{query}|{generations}|{extra}".encode()).hexdigest()
+
+    def cached(self, tags, ttl=DEFAULT_TTL, vary=None):
+        """Cache a JSON view's successful responses, honouring If-None-Match.
+
+        `vary()`, if given, is added to the key; e.g. the current day for
+        views that only change daily and so depend on no tags.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                # Streams, and deltas that must not outlive the rows they skipped as unsettled
+                if request.args.get("format") == "ndjson" or "since" in request.args:
+                    return view(*args, **kwargs)
+                key = self.make_key(request.path, request.args, tags, vary() if vary else "")
+                entry = self.backend.get(key)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    body = response.get_data(as_text=True)
+                    entry = {
+                        "body": body,
+                        "etag": hashlib.md5(body.encode()).hexdigest(),
+                        "mimetype": response.mimetype,
+                    }
+                    self.backend.set(key, entry, ttl)
+
+                if request.if_none_match.contains(entry["etag"]):
+                    response = make_response("", 304)
+                else:
+                    response = make_response(entry["body"], 200)
+                    response.mimetype = entry["mimetype"]
+                response.set_etag(entry["etag"])
+                response.headers["Cache-Control"] = f"private, max-age={ttl}"
+                return response
+            return wrapper
+        return decorator
+
+
+def _backend_from_env():
+    url = os.environ.get("CACHE_REDIS_URL")
+    if url:
+        import redis
+        return RedisBackend(redis.Redis.from_url(url))
+    return InProcessBackend(int(os.environ.get("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+
+
+response_cache = ResponseCache(_backend_from_env())
+
+
+def mark_written(session, *tags):
+    """Invalidate `tags` when `session` commits, for writes the ORM does not see (bulk inserts)."""
+    session.info.setdefault("cache_tags", set()).update(tags)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_written_tags(session, flush_context):
+    written = {MODEL_TAGS.get(type(obj)) for obj in list(session.new) + list(session.dirty) + list(session.deleted)}
+    written.discard(None)
+    if written:
+        mark_written(session, *written)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_written_tags(session):
+    tags = session.info.pop("cache_tags", None)
+    if tags:
+        response_cache.invalidate(*tags)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_written_tags(session):
+    session.info.pop("cache_tags", None)
@@ -0,0 +1,184 @@
+"""SMS command grammar.
+
+Every command the service understands is one alternative of a single
+precompiled regex; the name of the alternative that matched selects the
+builder that turns it into a typed command object.
+"""
+import re
+from typing import NamedTuple
+
+# SMS command keywords, in the order they are offered to users
+COMMANDS = ("PENZI", "START", "DETAILS", "MYSELF", "MATCH", "NEXT", "DESCRIBE", "YES")
+
+OTHER = "OTHER"
+
+GENDERS = {"male": "Male", "female": "Female"}
+
+_PREFIXES = tuple((name.lower(), name) for name in COMMANDS)
+
+
+class ValidationError(Exception):
+    pass
+
+
+class Penzi(NamedTuple):
+    pass
+
+
+class Start(NamedTuple):
+    name: str
+    age: int
+    gender: str
+    county: str
+    town: str
+
+
+class Details(NamedTuple):
+    education: str
+    profession: str
+    marital_status: str
+    religion: str
+    ethnicity: str
+
+
+class Myself(NamedTuple):
+    description: str
+
+
+class MatchCommand(NamedTuple):
+    min_age: int
+    max_age: int
+    location: str
+
+
+class Next(NamedTuple):
+    pass
+
+
+class ProfileRequest(NamedTuple):
+    phone_number: str
+
+
+class Describe(NamedTuple):
+    phone_number: str
+
+
+class Yes(NamedTuple):
+    pass
+
+
+_FIELD = r"\s*([^#]+?)\s*"
+_PHONE = r"(\+?\d[\d ]{8,15})"
+
+# (alternative name, pattern) -- order matters only for readability,
+# the alternatives are mutually exclusive
+_GRAMMAR = [
+    ("PENZI", r"penzi"),
+    ("START", "start" + "#".join([""] + [_FIELD] * 5)),
+    ("DETAILS", "details" + "#".join([""] + [_FIELD] * 5)),
+    ("MYSELF", r"myself\s+(.+)"),
+    ("MATCH", r"match#\s*(\d+)\s*-\s*(\d+)\s*#" + _FIELD),
+    ("NEXT", r"next"),
+    ("DESCRIBE", r"describe\s+" + _PHONE),
+    ("YES", r"yes"),
+    ("PROFILE", _PHONE),
+]
+
+_PATTERN = re.compile(
+    r"^\s*(?:" + "|".join(f"(?P<{name}>{pattern})" for name, pattern in _GRAMMAR) + r")\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+
+# Index of each alternative's own group; its fields are the groups after it
+_GROUP_INDEX = _PATTERN.groupindex
+
+
+def _fields(match, name, count):
+    start = _GROUP_INDEX[name] + 1
+    return match.group(*range(start, start + count)) if count > 1 else (match.group(start),)
+
+
+def _build_start(match):
+    name, age, gender, county, town = _fields(match, "START", 5)
+    if not age.isdigit():
+        raise ValidationError("Invalid age. Use a number, e.g. start#John Doe#26#Male#Nakuru#Naivasha")
+    if int(age) < 18:
+        raise ValidationError("You must be at least 18 years old to register.")
+    if gender.lower() not in GENDERS:
+        raise ValidationError("Invalid gender. Use Male or Female.")
+    return Start(name, int(age), GENDERS[gender.lower()], county, town)
+
+
+def _build_match(match):
+    min_age, max_age, location = _fields(match, "MATCH", 3)
+    min_age, max_age = validate_age_range(f"{min_age}-{max_age}")
+    return MatchCommand(min_age, max_age, location)
+
+
+def _normalize_phone(value):
+    return value.replace(" ", "")
+
+
+_BUILDERS = {
+    "PENZI": lambda match: Penzi(),
+    "START": _build_start,
+    "DETAILS": lambda match: Details(*_fields(match, "DETAILS", 5)),
+    "MYSELF": lambda match: Myself(_fields(match, "MYSELF", 1)[0].strip()),
+    "MATCH": _build_match,
+    "NEXT": lambda match: Next(),
+    "DESCRIBE": lambda match: Describe(_normalize_phone(_fields(match, "DESCRIBE", 1)[0])),
+    "YES": lambda match: Yes(),
+    "PROFILE": lambda match: ProfileRequest(_normalize_phone(_fields(match, "PROFILE", 1)[0])),
+}
+
+
+def parse(message_text):
+    """Parse an inbound SMS into a typed command.
+
+    Raises ValidationError with a user-facing message when the text is not
+    a valid command.
+    """
+    match = _PATTERN.match(message_text)
+    if match is None:
+        raise ValidationError(get_help_message())
+    return _BUILDERS[match.lastgroup](match)
+
+
+def classify(message_text):
+    """Return the command keyword a message starts with, or OTHER.
+
+    Matches case-insensitively on the leading keyword, the same way the
+    analytics queries used `LIKE 'match%'`, so counts stay comparable.
+    """
+    lowered = message_text[:10].lower()
+    for prefix, name in _PREFIXES:
+        if lowered.startswith(prefix):
+            return name
+    return OTHER
+
+
+def get_help_message():
+    """Returns the help message for invalid commands"""
+    return (
+        "Invalid command. Available commands:\n"
+        "1. PENZI (activate service)\n"
+        "2. START#name#age#gender#county#town\n"
+        "3. DETAILS#education#profession#status#religion#ethnicity\n"
+        "4. MYSELF description\n"
+        "5. MATCH#age-range#town\n"
+        "6. NEXT (for more matches)\n"
+        "7. Phone number (to get profile)\n"
+        "8. DESCRIBE phone_number\n"
+        "9. YES (to confirm interest)"
+    )
+
+
+def validate_age_range(age_range):
+    """Validate and parse age range string (e.g., '23-25')"""
+    try:
+        min_age, max_age = map(int, age_range.split('-'))
+        if min_age < 18 or max_age < min_age:
+            raise ValidationError("Invalid age range. Minimum age is 18 and maximum age must be greater than minimum.")
+        return min_age, max_age
+    except ValueError:
+        raise ValidationError("Invalid age range format. Use: min-max (e.g., 23-25)")
@@ -1,11 +1,29 @@
 import os
 
 class Config:
-    DB_USERNAME = "root"  
-    DB_PASSWORD = "Lotty%40488"  
-    DB_HOST = "localhost"
-    DB_NAME = "Penzi_db"
+    DB_USERNAME = os.environ.get("DB_USERNAME", "root")
+    DB_PASSWORD = os.environ.get("DB_PASSWORD", "Lotty%40488")
+    DB_HOST = os.environ.get("DB_HOST", "localhost")
+    DB_NAME = os.environ.get("DB_NAME", "Penzi_db")
+
+    # DATABASE_URL overrides the URI assembled from the DB_* settings
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL",
+        f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+    )
+    # Optional replica for read-only endpoints; defaults to the primary
+    READ_REPLICA_URL = os.environ.get("READ_REPLICA_URL")
+
+    # Connection pool tuning (ignored for SQLite)
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # below MySQL wait_timeout
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    DB_ISOLATION_LEVEL = os.environ.get("DB_ISOLATION_LEVEL")  # e.g. READ COMMITTED
+
+    # Bearer token for the /api/penzi/jobs endpoints; unset disables them
+    JOBS_API_TOKEN = os.environ.get("JOBS_API_TOKEN")
 
-    SQLALCHEMY_DATABASE_URI = f"mysql+mysqlconnector://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.urandom(24)
@@ -0,0 +1,205 @@
+"""Streaming user export for /api/penziusers/export.
+
+Users, their details and self description come from one outer-joined
+query walked with yield_per, and are written out in chunks as CSV
+(optionally gzipped) or Parquet, so neither the rows nor the file are
+ever held in memory in full. write_csv_file() writes the same CSV to
+disk, for the nightly export job (see jobs.py).
+"""
+import csv
+import io
+import os
+import zlib
+from models import User, UserMoreDetails, UserSelfDescription
+from listing import parse_date_bound
+
+CHUNK_SIZE = 1000
+
+# (key, header, column) in default output order
+COLUMNS = [
+    ("id", "ID", User.id),
+    ("name", "Name", User.name),
+    ("age", "Age", User.age),
+    ("gender", "Gender", User.gender),
+    ("county", "County", User.county),
+    ("town", "Town", User.town),
+    ("education", "Education", UserMoreDetails.level_of_education),
+    ("profession", "Profession", UserMoreDetails.profession),
+    ("marital_status", "Marital Status", UserMoreDetails.marital_status),
+    ("religion", "Religion", UserMoreDetails.religion),
+    ("ethnicity", "Ethnicity", UserMoreDetails.ethnicity),
+    ("description", "Description", UserSelfDescription.description),
+    ("joined", "Joined Date", User.created_at),
+]
+_BY_KEY = {key: (key, header, column) for key, header, column in COLUMNS}
+
+FORMATS = ("csv", "parquet")
+
+
+class ExportUnavailable(Exception):
+    """Raised when an output format needs an optional dependency that is missing."""
+
+
+def select_columns(value):
+    """Resolve a comma-separated `columns` argument; raises ValueError."""
+    if not value:
+        return list(COLUMNS)
+    keys = [key.strip() for key in value.split(",") if key.strip()]
+    unknown = [key for key in keys if key not in _BY_KEY]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}. Available: {', '.join(_BY_KEY)}")
+    return [_BY_KEY[key] for key in keys]
+
+
+def export_query(session, columns, args):
+    """One query for all selected columns, joining detail tables only when needed."""
+    tables = {column.class_ for _, _, column in columns}
+    query = session.query(User.id, *[column for _, _, column in columns])
+    order = [User.id]
+    if UserMoreDetails in tables:
+        query = query.outerjoin(UserMoreDetails, UserMoreDetails.user_id == User.id)
+        order.append(UserMoreDetails.id)
+    if UserSelfDescription in tables:
+        query = query.outerjoin(UserSelfDescription, UserSelfDescription.user_id == User.id)
+        order.append(UserSelfDescription.id)
+
+    if args.get("county"):
+        query = query.filter(User.county == args["county"])
+    start = parse_date_bound(args.get("from"))
+    end = parse_date_bound(args.get("to"), end=True)
+    if start is not None:
+        query = query.filter(User.created_at >= start)
+    if end is not None:
+        query = query.filter(User.created_at < end)
+    return query.order_by(*order)
+
+
+def iter_rows(query):
+    """Yield one tuple of selected values per user.
+
+    Several details/description rows for a user would repeat it in the
+    join; like the old per-user `.first()` lookups, the first one wins.
+    """
+    last_id = None
+    for row in query.execution_options(stream_results=True).yield_per(CHUNK_SIZE):
+        if row[0] == last_id:
+            continue
+        last_id = row[0]
+        yield row[1:]
+
+
+def iter_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for _, header, _ in columns])
+    joined = [i for i, (key, _, _) in enumerate(columns) if key == "joined"]
+    for n, row in enumerate(rows, 1):
+        values = ['' if value is None else value for value in row]
+        for i in joined:
+            values[i] = row[i].strftime('%Y-%m-%d %H:%M:%S') if row[i] else ''
+        writer.writerow(values)
+        if n % CHUNK_SIZE == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write_csv_file(path, rows, columns, compress=True):
+    """Write rows to `path` as CSV, gzipped if `compress`; returns the number of rows.
+
+    The file is written under a temporary name and renamed into place, so
+    `path` never holds a partial export.
+    """
+    written = 0
+
+    def counted(rows):
+        nonlocal written
+        for row in rows:
+            written += 1
+            yield row
+
+    chunks = iter_csv(counted(rows), columns)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(partial, path)
+    return written
+
+
+class _Drain(io.RawIOBase):
+    """Write-only sink that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.pending = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b"".join(self.pending)
+        self.pending = []
+        return data
+
+
+def iter_parquet(rows, columns):
+    """Write row groups of CHUNK_SIZE users, yielding bytes as each is flushed.
+
+    Needs pyarrow; call check_format("parquet") first.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"id": pa.int64(), "age": pa.int32(), "joined": pa.timestamp("s")}
+    schema = pa.schema([(key, types.get(key, pa.string())) for key, _, _ in columns])
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+
+    def write(batch):
+        writer.write_table(pa.Table.from_pylist(
+            [dict(zip(schema.names, row)) for row in batch], schema=schema
+        ))
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CHUNK_SIZE:
+            write(batch)
+            batch = []
+            yield sink.take()
+    if batch:
+        write(batch)
+    writer.close()
+    yield sink.take()
+
+
+def check_format(output_format):
+    """Validate the requested format before the response starts streaming."""
+    if output_format not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+    if output_format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ExportUnavailable("Parquet export requires pyarrow")
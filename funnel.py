@@ -0,0 +1,213 @@
+"""Conversion funnel and weekly retention for /api/penzi/analytics/funnel.
+
+One grouped query pulls a row per (user, command, day) the user sent
+that command on, joined to the user's county, gender, age and signup
+day. Everything after that is NumPy over those columns: the first day
+each user sent each command, which funnel stages they reached in order,
+and which weeks after signing up they were active in.
+
+Only whole days before today are counted, so a result never changes for
+the rest of the day and is cached per day rather than per write.
+Archived message months (see partitions.py) are not read.
+"""
+from datetime import datetime, time, timedelta
+import numpy as np
+from sqlalchemy import func, and_
+from models import User, Message
+from stats import AGE_RANGES, as_date
+
+# Funnel stages in order. PENZI is counted but not part of the ordered
+# chain: a PENZI sent before registering has no user to attribute it to,
+# so the chain starts at registration (START).
+STAGES = ("PENZI", "START", "DETAILS", "MYSELF", "MATCH", "NEXT", "YES")
+CHAIN_START = STAGES.index("START")
+
+GROUPINGS = ("county", "gender", "age_band", "signup_week")
+DEFAULT_WEEKS = 8
+MAX_WEEKS = 52
+
+NOT_REACHED = np.iinfo(np.int64).max
+
+
+def parse_weeks(value):
+    if value is None:
+        return DEFAULT_WEEKS
+    try:
+        weeks = int(value)
+    except ValueError:
+        raise ValueError("weeks must be an integer")
+    if weeks < 1 or weeks > MAX_WEEKS:
+        raise ValueError(f"weeks must be between 1 and {MAX_WEEKS}")
+    return weeks
+
+
+def parse_grouping(value):
+    if value and value not in GROUPINGS:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUPINGS)}")
+    return value or None
+
+
+def cache_day():
+    """Cache key component: results only change when the day does."""
+    return datetime.utcnow().date().isoformat()
+
+
+def _day_numbers(values):
+    """Days since the epoch for DATE() results (dates or ISO strings)."""
+    days = np.array([as_date(value).isoformat() for value in values], dtype="datetime64[D]")
+    return days.astype(np.int64)
+
+
+def _week_start(days):
+    # 1970-01-01 was a Thursday; weeks start on Monday
+    return days - (days + 3) % 7
+
+
+def _day_label(day_number):
+    return str(np.datetime64(int(day_number), "D"))
+
+
+def load_columns(session, start=None, end=None, county=None, gender=None):
+    """Pull the funnel's columns in one grouped query.
+
+    Users are selected by signup time in [start, end); their incoming
+    messages before `end` are grouped by command and day. Users who never
+    sent a message appear once with a null command.
+    """
+    signup_day = func.date(User.created_at)
+    message_day = func.date(Message.created_at)
+    query = (
+        session.query(User.id, User.county, User.gender, User.age, signup_day,
+                      Message.command, message_day)
+        .outerjoin(Message, and_(
+            Message.user_id == User.id,
+            Message.message_direction == "incoming",
+            Message.created_at < end
+        ))
+        .filter(User.created_at < end)
+        .group_by(User.id, User.county, User.gender, User.age, signup_day, Message.command, message_day)
+    )
+    if start is not None:
+        query = query.filter(User.created_at >= start)
+    if county:
+        query = query.filter(User.county == county)
+    if gender:
+        query = query.filter(User.gender == gender)
+
+    rows = query.all()
+    if not rows:
+        return None
+    user_ids, counties, genders, ages, signup_days, commands, days = zip(*rows)
+    active = np.array([day is not None for day in days])
+    message_days = np.full(len(rows), -1, dtype=np.int64)
+    message_days[active] = _day_numbers([day for day in days if day is not None])
+    return {
+        "user_id": np.array(user_ids, dtype=np.int64),
+        "county": np.array(counties, dtype=object),
+        "gender": np.array(genders, dtype=object),
+        "age": np.array(ages, dtype=np.int64),
+        "signup_day": _day_numbers(signup_days),
+        "command": np.array(commands, dtype=object),
+        "day": message_days,
+        "active": active,
+    }
+
+
+def _group_keys(columns, first_row, grouping):
+    if grouping is None:
+        return np.full(len(first_row), "all", dtype=object)
+    if grouping == "signup_week":
+        weeks = _week_start(columns["signup_day"][first_row])
+        return np.array([_day_label(week) for week in weeks], dtype=object)
+    if grouping == "age_band":
+        ages = columns["age"][first_row]
+        labels = np.full(len(first_row), "other", dtype=object)
+        for min_age, max_age, label in AGE_RANGES:
+            labels[(ages >= min_age) & (ages <= max_age)] = label
+        return labels
+    return columns[grouping][first_row].astype(str)
+
+
+def compute(columns, grouping=None, weeks=DEFAULT_WEEKS):
+    """Funnel counts per group and the weekly retention matrix per signup cohort."""
+    user_ids, first_row, user_index = np.unique(columns["user_id"], return_index=True, return_inverse=True)
+    signup_day = columns["signup_day"][first_row]
+
+    # first[u, s]: first day user u sent stage s (registration counts as START)
+    first = np.full((len(user_ids), len(STAGES)), NOT_REACHED, dtype=np.int64)
+    stage = np.full(len(user_index), -1)
+    for number, name in enumerate(STAGES):
+        stage[columns["command"] == name] = number
+    sent = columns["active"] & (stage >= 0)
+    np.minimum.at(first, (user_index[sent], stage[sent]), columns["day"][sent])
+    first[:, CHAIN_START] = np.minimum(first[:, CHAIN_START], signup_day)
+
+    sent_any = first != NOT_REACHED
+    in_order = sent_any.copy()
+    for number in range(CHAIN_START + 1, len(STAGES)):
+        in_order[:, number] = (in_order[:, number - 1] & sent_any[:, number]
+                               & (first[:, number] >= first[:, number - 1]))
+
+    keys, group_index = np.unique(_group_keys(columns, first_row, grouping), return_inverse=True)
+    sent_counts = np.zeros((len(keys), len(STAGES)), dtype=np.int64)
+    chain_counts = np.zeros((len(keys), len(STAGES)), dtype=np.int64)
+    np.add.at(sent_counts, group_index, sent_any)
+    np.add.at(chain_counts, group_index, in_order)
+
+    groups = []
+    for key, sent_row, chain_row in zip(keys, sent_counts, chain_counts):
+        registered = int(chain_row[CHAIN_START])
+        groups.append({
+            "key": str(key),
+            "users": registered,
+            "stages": [
+                {
+                    "stage": name,
+                    "users": int(sent_row[number]),
+                    "converted": int(chain_row[number]) if number >= CHAIN_START else None,
+                    "rate": (round(int(chain_row[number]) / registered, 4)
+                             if number >= CHAIN_START and registered else None),
+                }
+                for number, name in enumerate(STAGES)
+            ],
+        })
+
+    # Retention: share of each signup-week cohort active n weeks after signing up
+    cohort_week = _week_start(signup_day)
+    cohorts, cohort_index, sizes = np.unique(cohort_week, return_inverse=True, return_counts=True)
+    active = columns["active"]
+    offset = (columns["day"][active] - cohort_week[user_index[active]]) // 7
+    in_window = (offset >= 0) & (offset < weeks)
+    user_weeks = np.unique(user_index[active][in_window] * weeks + offset[in_window])
+    active_users = np.zeros((len(cohorts), weeks), dtype=np.int64)
+    np.add.at(active_users, (cohort_index[user_weeks // weeks], user_weeks % weeks), 1)
+    rates = np.round(active_users / sizes[:, None], 4)
+
+    return {
+        "groups": groups,
+        "retention": {
+            "cohorts": [_day_label(week) for week in cohorts],
+            "sizes": sizes.tolist(),
+            "active": active_users.tolist(),
+            "rates": rates.tolist(),
+        },
+    }
+
+
+def funnel_analytics(session, start=None, end=None, county=None, gender=None,
+                     grouping=None, weeks=DEFAULT_WEEKS, today=None):
+    """The /api/penzi/analytics/funnel payload for signups in [start, end)."""
+    today_start = datetime.combine(today or datetime.utcnow().date(), time.min)
+    end = min(end, today_start) if end is not None else today_start
+    columns = load_columns(session, start, end, county, gender)
+    if columns is None:
+        result = {"groups": [], "retention": {"cohorts": [], "sizes": [], "active": [], "rates": []}}
+    else:
+        result = compute(columns, grouping, weeks)
+    return {
+        "stages": list(STAGES),
+        "group_by": grouping,
+        "weeks": weeks,
+        "through": (end - timedelta(days=1)).date().isoformat(),
+        **result,
+    }
@@ -0,0 +1,236 @@
+"""Guards in front of the inbound SMS handlers: retry dedup and per-sender throttling.
+
+Gateways retry deliveries they did not see acknowledged. Every handled
+SMS leaves a receipt holding its reply, keyed on the gateway's message
+id or, when the gateway sends none, on the sender and text. A retry
+finds the receipt and gets the same response back without the command
+running again, so a retried MATCH does not search or store anything
+twice.
+
+Without a message id a retry cannot be told from the user sending the
+same text again, so text keys are used only for commands whose repeat
+would get the same answer (not NEXT, which a user repeats to get the
+following page), and only within DEDUP_WINDOW_SECONDS of the receipt
+being created: a later delivery takes the receipt over and runs.
+
+The receipt is claimed before the command runs, in the same transaction,
+under a unique key: a concurrent retry blocks on that key until the
+first delivery commits, then replays its receipt. Recent receipts are
+also kept in a bounded in-process LRU so most retries never reach the
+database.
+
+Senders are throttled with a token bucket each, plus a stricter one for
+MATCH, which runs the candidate search. Throttled messages get no
+receipt, so the gateway's retry is handled normally once tokens free up.
+
+Receipts only need to outlive the gateway's retries; drop old ones with:
+
+    python inbound.py prune --days 7
+"""
+import argparse
+import hashlib
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import event, select, delete
+from sqlalchemy.exc import IntegrityError
+from models import InboundReceipt
+from database import SessionLocal, get_session
+from cache import InProcessBackend
+from commands import COMMANDS, OTHER, classify
+from ratelimit import KeyedTokenBuckets
+import phones
+
+DEDUP_WINDOW_SECONDS = int(os.environ.get("INBOUND_DEDUP_WINDOW_SECONDS", 30))
+RECENT_MAX_ENTRIES = 10000
+RECENT_TTL = 3600
+# Commands deduplicated by text when the gateway sends no message id
+TEXT_DEDUP_COMMANDS = frozenset(COMMANDS + (OTHER,)) - {"NEXT"}
+# Prefix marking text keys, which only hold within the dedup window
+TEXT_KEY_PREFIX = "t"
+RETENTION_DAYS = 7
+DELETE_CHUNK_SIZE = 10000
+
+SENDER_RATE = float(os.environ.get("INBOUND_SENDER_RATE", 0.5))  # messages per second
+SENDER_BURST = int(os.environ.get("INBOUND_SENDER_BURST", 10))
+MATCH_RATE = float(os.environ.get("INBOUND_MATCH_RATE", 1 / 30))
+MATCH_BURST = int(os.environ.get("INBOUND_MATCH_BURST", 3))
+
+recent = InProcessBackend(RECENT_MAX_ENTRIES)
+sender_buckets = KeyedTokenBuckets(SENDER_RATE, SENDER_BURST)
+match_buckets = KeyedTokenBuckets(MATCH_RATE, MATCH_BURST)
+
+
+class Duplicate(Exception):
+    """The message was already handled; `response` is what it got."""
+
+    def __init__(self, response):
+        super().__init__("Duplicate delivery")
+        self.response = response
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many messages, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def idempotency_key(phone_number, message_text, message_id=None):
+    """Receipt key for one delivery, or None when it cannot be deduplicated."""
+    phone_number = phones.normalize(phone_number)
+    if message_id:
+        return hashlib.sha256(f"id|{phone_number}|{message_id}".encode()).hexdigest()
+    if DEDUP_WINDOW_SECONDS > 0 and classify(message_text) in TEXT_DEDUP_COMMANDS:
+        raw = f"text|{phone_number}|{message_text.strip().lower()}"
+        return TEXT_KEY_PREFIX + hashlib.sha256(raw.encode()).hexdigest()[:63]
+    return None
+
+
+def _is_text_key(key):
+    return key.startswith(TEXT_KEY_PREFIX)
+
+
+def _window_start():
+    return datetime.utcnow() - timedelta(seconds=DEDUP_WINDOW_SECONDS)
+
+
+def _cache_ttl(key, created_at):
+    """How long a receipt can be replayed from the in-process cache."""
+    if not _is_text_key(key):
+        return RECENT_TTL
+    return (created_at - _window_start()).total_seconds() if created_at else DEDUP_WINDOW_SECONDS
+
+
+def _response(receipt):
+    return {"phone_number": receipt.phone_number, "user_id": receipt.user_id, "reply": receipt.reply}
+
+
+def find(session, keys):
+    """Responses already given for any of `keys`; returns {key: response}."""
+    found = {}
+    missing = []
+    for key in keys:
+        if key is None:
+            continue
+        response = recent.get(key)
+        if response is not None:
+            found[key] = response
+        else:
+            missing.append(key)
+    if missing and session is not None:
+        window_start = _window_start()
+        for receipt in session.query(InboundReceipt).filter(
+            InboundReceipt.idempotency_key.in_(missing), InboundReceipt.reply.is_not(None)
+        ):
+            key = receipt.idempotency_key
+            if _is_text_key(key) and receipt.created_at < window_start:
+                continue
+            found[key] = _response(receipt)
+            recent.set(key, found[key], _cache_ttl(key, receipt.created_at))
+    return found
+
+
+def throttle(phone_number, message_text):
+    """Raise Throttled if the sender is over their rate."""
+    phone_number = phones.normalize(phone_number)
+    wait = sender_buckets.try_acquire(phone_number)
+    if not wait and classify(message_text) == "MATCH":
+        wait = match_buckets.try_acquire(phone_number)
+    if wait:
+        raise Throttled(wait)
+
+
+def admit(session, key, phone_number, message_text):
+    """Raise Duplicate for a handled delivery or Throttled for a sender over their rate.
+
+    `session` may be None to consult only the in-process receipts.
+    """
+    found = find(session, [key])
+    if key in found:
+        raise Duplicate(found[key])
+    throttle(phone_number, message_text)
+
+
+def claim(session, key, phone_number):
+    """Insert the receipt for `key` before handling; raises Duplicate if it already exists.
+
+    A text key's receipt from before the dedup window is taken over
+    instead: the message is a new one that happens to repeat the text.
+    """
+    if key is None:
+        return None
+    phone_number = phones.normalize(phone_number)
+    receipt = InboundReceipt(idempotency_key=key, phone_number=phone_number, created_at=datetime.utcnow())
+    try:
+        with session.begin_nested():
+            session.add(receipt)
+    except IntegrityError:
+        # Committed by a concurrent delivery; a locking read sees it
+        existing = session.execute(
+            select(InboundReceipt).where(InboundReceipt.idempotency_key == key).with_for_update()
+        ).scalar_one()
+        if not (_is_text_key(key) and existing.created_at < _window_start()):
+            raise Duplicate(_response(existing))
+        existing.phone_number = phone_number
+        existing.user_id = None
+        existing.reply = None
+        existing.created_at = datetime.utcnow()
+        recent.delete(key)
+        return existing
+    return receipt
+
+
+def record(session, receipt, conv):
+    """Store the reply on a claimed receipt; it is cached in-process once the session commits."""
+    if receipt is None:
+        return
+    receipt.phone_number = conv.phone_number
+    receipt.user_id = conv.sender.id if conv.sender is not None else None
+    receipt.reply = conv.reply
+    session.info.setdefault("inbound_receipts", {})[receipt.idempotency_key] = (
+        _response(receipt), receipt.created_at
+    )
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _remember_receipts(session):
+    for key, (response, created_at) in session.info.pop("inbound_receipts", {}).items():
+        ttl = _cache_ttl(key, created_at)
+        if ttl > 0:
+            recent.set(key, response, ttl)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _forget_receipts(session):
+    session.info.pop("inbound_receipts", None)
+
+
+def prune(session, days=RETENTION_DAYS):
+    """Delete receipts older than `days`; returns how many were deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = InboundReceipt.__table__
+    deleted = 0
+    while True:
+        ids = [row_id for (row_id,) in session.execute(
+            select(table.c.id).where(table.c.created_at < cutoff).limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            return deleted
+        session.execute(delete(table).where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain inbound SMS receipts")
+    parser.add_argument("command", choices=["prune"])
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    args = parser.parse_args()
+
+    if args.command == "prune":
+        with get_session() as session:
+            deleted = prune(session, args.days)
+        print(f"Deleted {deleted} receipt(s) older than {args.days} day(s)")
+
+
+if __name__ == "__main__":
+    main()
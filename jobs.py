@@ -0,0 +1,444 @@
+"""Background jobs: maintenance and precomputation outside the request path.
+
+Jobs are rows in the jobs table. The app (POST /api/penzi/jobs) and the
+scheduler only insert them; a runner process claims queued jobs and
+runs them in a process pool, and their status is polled with
+GET /api/penzi/jobs/<id>:
+
+    python jobs.py run --workers 2          # scheduler + runner, until interrupted
+    python jobs.py run --no-schedule        # an extra runner
+    python jobs.py submit export_users --params '{"county": "Nakuru"}'
+    python jobs.py status                   # job counts by status
+
+Tasks are functions registered with @task and called as fn(session,
+**params) in a pool process, inside one get_session() transaction; what
+they return is stored as the job's JSON result. Parameters are checked
+when a job is submitted: no task takes a path (exports go to
+EXPORT_DIR), and retention-style parameters have lower bounds. Only the
+jobs in API_JOBS may be submitted over HTTP; the rest are CLI-only. Like
+the outbound queue, a runner claims jobs with a lease that it renews
+while they run, so a job left behind by a crashed runner is picked up
+again once the lease runs out, up to MAX_ATTEMPTS times.
+
+SCHEDULE lists the periodic jobs. Run the scheduler in one runner only;
+it queues a periodic job when it is due and none of that name is still
+queued or running.
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, time as time_of_day
+from sqlalchemy import select, delete, func, or_, and_
+from models import Job
+from database import SessionLocal, get_session
+import database
+import export
+import inbound
+import listing
+import matching
+import outbound
+import partitions
+import ranking
+import rollups
+import search
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 300
+RETENTION_DAYS = 7
+DELETE_CHUNK_SIZE = 10000
+EXPORT_DIR = os.environ.get("JOBS_EXPORT_DIR", "exports")
+
+# Jobs POST /api/penzi/jobs may queue; destructive maintenance stays CLI-only
+API_JOBS = ("export_users", "warm_dashboard_stats")
+
+# Cached views warmed by warm_dashboard_stats, as the dashboard requests them
+WARM_PATHS = ("/api/penzi/dashboard/stats", "/api/penzi/analytics/funnel")
+
+TASKS = {}
+_CHECKS = {}
+
+
+def task(name, check=None):
+    """Register a job function under `name`.
+
+    `check(**params)`, if given, validates parameters when the job is
+    submitted and raises ValueError for bad ones.
+    """
+    def register(fn):
+        TASKS[name] = fn
+        if check is not None:
+            _CHECKS[name] = check
+        return fn
+    return register
+
+
+def _check_at_least(name, value, minimum):
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise ValueError(f"{name} must be an integer of at least {minimum}")
+
+
+def _check_days(days=1):
+    _check_at_least("days", days, 1)
+
+
+class Periodic:
+    """A job queued every `every`, or daily at `at` (a datetime.time, UTC)."""
+
+    def __init__(self, name, every=None, at=None, params=None):
+        self.name = name
+        self.every = every
+        self.at = at
+        self.params = params or {}
+
+    def is_due(self, last_created_at, now):
+        if self.at is not None:
+            today_at = datetime.combine(now.date(), self.at)
+            return now >= today_at and (last_created_at is None or last_created_at < today_at)
+        return last_created_at is None or now - last_created_at >= self.every
+
+
+SCHEDULE = (
+    Periodic("prune_match_batches", every=timedelta(hours=1)),
+    Periodic("warm_dashboard_stats", every=timedelta(minutes=30)),
+    Periodic("prune_inbound_receipts", every=timedelta(days=1)),
+    Periodic("prune_outbound_messages", every=timedelta(days=1)),
+    Periodic("prune_jobs", every=timedelta(days=1)),
+    Periodic("export_users", at=time_of_day(2, 0)),
+)
+
+
+@task("prune_match_batches", check=_check_days)
+def prune_match_batches(session, days=matching.BATCH_RETENTION_DAYS):
+    return {"deleted": matching.prune_batches(session, days)}
+
+
+@task("prune_inbound_receipts", check=_check_days)
+def prune_inbound_receipts(session, days=inbound.RETENTION_DAYS):
+    return {"deleted": inbound.prune(session, days)}
+
+
+@task("prune_outbound_messages", check=_check_days)
+def prune_outbound_messages(session, days=outbound.RETENTION_DAYS):
+    return {"deleted": outbound.prune(session, days)}
+
+
+@task("prune_jobs", check=_check_days)
+def prune_jobs(session, days=RETENTION_DAYS):
+    return {"deleted": prune(session, days)}
+
+
+@task("warm_dashboard_stats")
+def warm_dashboard_stats(session):
+    """Request the dashboard's cached views so the next visitor is served from the cache.
+
+    Only useful with the shared Redis cache backend; the in-process one
+    would be warmed in this process, where no request ever reads it.
+    """
+    from cache import response_cache, RedisBackend
+    if not isinstance(response_cache.backend, RedisBackend):
+        return {"skipped": "response cache is per-process; set CACHE_REDIS_URL to warm it"}
+    from app import app
+    client = app.test_client()
+    return {"warmed": {path: client.get(path).status_code for path in WARM_PATHS}}
+
+
+def _check_export(county=None, start=None, end=None, columns=None, compress=True):
+    export.select_columns(columns)
+    listing.parse_date_bound(start)
+    listing.parse_date_bound(end, end=True)
+
+
+@task("export_users", check=_check_export)
+def export_users(session, county=None, start=None, end=None, columns=None, compress=True):
+    """Write the user export (as /api/penziusers/export serves it) to a dated CSV file in EXPORT_DIR."""
+    selected = export.select_columns(columns)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    filename = f"users-{datetime.utcnow():%Y-%m-%d}.csv" + (".gz" if compress else "")
+    path = os.path.join(EXPORT_DIR, filename)
+    query = export.export_query(session, selected, {"county": county, "from": start, "to": end})
+    rows = export.write_csv_file(path, export.iter_rows(query), selected, compress)
+    return {"path": path, "rows": rows}
+
+
+@task("rollups_backfill")
+def rollups_backfill(session):
+    return {"rows": rollups.backfill(session)}
+
+
+@task("search_backfill")
+def search_backfill(session):
+    return {"documents": search.backfill(session.connection())}
+
+
+def _check_partitions(months_ahead=partitions.MONTHS_AHEAD):
+    _check_at_least("months_ahead", months_ahead, 1)
+
+
+@task("maintain_partitions", check=_check_partitions)
+def maintain_partitions(session, months_ahead=partitions.MONTHS_AHEAD):
+    return {"added": partitions.ensure_partitions(session.connection(), months_ahead)}
+
+
+def _check_archive(keep_months=partitions.KEEP_MONTHS):
+    _check_at_least("keep_months", keep_months, partitions.KEEP_MONTHS)
+
+
+@task("archive_messages", check=_check_archive)
+def archive_messages(session, keep_months=partitions.KEEP_MONTHS):
+    archived = partitions.archive_cold(session, keep_months)
+    return {"archived": [{"month": f"{entry.month:%Y-%m}", "rows": entry.row_count, "path": entry.path}
+                         for entry in archived]}
+
+
+def check_params(name, params):
+    """Validate a job before queueing it; raises ValueError."""
+    fn = TASKS.get(name)
+    if fn is None:
+        raise ValueError(f"Unknown job {name!r}. Available: {', '.join(sorted(TASKS))}")
+    if not isinstance(params, dict):
+        raise ValueError("params must be a JSON object")
+    try:
+        inspect.signature(fn).bind(None, **params)
+    except TypeError as e:
+        raise ValueError(f"Invalid params for {name}: {e}")
+    if name in _CHECKS:
+        _CHECKS[name](**params)
+
+
+def submit(session, name, params=None):
+    """Queue a job; returns the Job. Raises ValueError for an unknown job or bad params."""
+    params = params or {}
+    check_params(name, params)
+    job = Job(name=name, params=json.dumps(params), status=QUEUED)
+    session.add(job)
+    session.flush()
+    return job
+
+
+def serialize(job):
+    return {
+        'id': job.id,
+        'name': job.name,
+        'params': json.loads(job.params),
+        'status': job.status,
+        'attempts': job.attempts,
+        'result': json.loads(job.result) if job.result is not None else None,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def schedule_due(session, schedule=SCHEDULE, now=None):
+    """Queue the periodic jobs that are due; returns the Jobs queued."""
+    now = now or datetime.utcnow()
+    queued = []
+    for periodic in schedule:
+        pending = session.execute(
+            select(Job.id).where(Job.name == periodic.name, Job.status.in_((QUEUED, RUNNING))).limit(1)
+        ).first()
+        if pending is not None:
+            continue
+        last = session.execute(select(func.max(Job.created_at)).where(Job.name == periodic.name)).scalar()
+        if periodic.is_due(last, now):
+            queued.append(submit(session, periodic.name, periodic.params))
+    return queued
+
+
+def claim(session, limit, now=None):
+    """Lease up to `limit` queued jobs, or running ones whose runner stopped renewing them."""
+    now = now or datetime.utcnow()
+    jobs = (
+        session.query(Job)
+        .filter(or_(Job.status == QUEUED, and_(Job.status == RUNNING, Job.lease_expires_at < now)))
+        .order_by(Job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    claimed = []
+    for job in jobs:
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = FAILED
+            job.error = f"Runner lost the job {job.attempts} time(s)"
+            job.finished_at = now
+            continue
+        job.status = RUNNING
+        job.attempts += 1
+        job.started_at = now
+        job.lease_expires_at = now + timedelta(seconds=LEASE_SECONDS)
+        claimed.append(job)
+    return claimed
+
+
+def renew(session, job_ids, now=None):
+    now = now or datetime.utcnow()
+    if job_ids:
+        session.query(Job).filter(Job.id.in_(job_ids), Job.status == RUNNING).update(
+            {Job.lease_expires_at: now + timedelta(seconds=LEASE_SECONDS)}, synchronize_session=False
+        )
+
+
+def finish(session, job_id, result=None, error=None, now=None):
+    job = session.get(Job, job_id)
+    job.status = FAILED if error is not None else SUCCEEDED
+    job.result = json.dumps(result) if error is None else None
+    job.error = error
+    job.finished_at = now or datetime.utcnow()
+    job.lease_expires_at = None
+
+
+def prune(session, days=RETENTION_DAYS):
+    """Delete finished jobs older than `days`; returns how many were deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = Job.__table__
+    deleted = 0
+    while True:
+        ids = [row_id for (row_id,) in session.execute(
+            select(table.c.id)
+            .where(table.c.status.in_((SUCCEEDED, FAILED)), table.c.created_at < cutoff)
+            .limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            return deleted
+        session.execute(delete(table).where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+def _init_worker():
+    # Forked pool processes must not share the parent's pooled connections
+    database.engine.dispose(close=False)
+    database.read_engine.dispose(close=False)
+    # Tasks import the app only to warm caches; they never rank candidates
+    ranking.WARM_ON_START = False
+
+
+def execute(name, params):
+    """Run one job in a pool process; returns its result."""
+    with get_session() as session:
+        try:
+            return TASKS[name](session, **params)
+        except Exception:
+            logger.exception("Job %s failed", name)
+            raise
+
+
+class Runner:
+    def __init__(self, workers=2, schedule=SCHEDULE, session_factory=SessionLocal):
+        self.workers = workers
+        self.schedule = schedule
+        self.session_factory = session_factory
+        self.executor = self._new_pool()
+        self.running = {}  # job id -> Future
+        self.renewed_at = time.monotonic()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def _start(self, job_id, name, params):
+        logger.info("Starting job %s: %s", job_id, name)
+        try:
+            self.running[job_id] = self.executor.submit(execute, name, params)
+        except BrokenProcessPool:
+            # A pool process died (e.g. killed for memory); its jobs fail below
+            self.executor = self._new_pool()
+            self.running[job_id] = self.executor.submit(execute, name, params)
+
+    def tick(self):
+        """Queue due periodic jobs, record finished ones and start new ones; returns how many started."""
+        session = self.session_factory()
+        try:
+            if self.schedule:
+                for job in schedule_due(session, self.schedule):
+                    logger.info("Scheduled job %s: %s", job.id, job.name)
+                session.commit()
+
+            for job_id, future in list(self.running.items()):
+                if not future.done():
+                    continue
+                del self.running[job_id]
+                error = future.exception()
+                if error is None:
+                    finish(session, job_id, result=future.result())
+                else:
+                    finish(session, job_id, error=f"{type(error).__name__}: {error}")
+            session.commit()
+
+            if time.monotonic() - self.renewed_at >= LEASE_SECONDS / 4:
+                renew(session, list(self.running))
+                session.commit()
+                self.renewed_at = time.monotonic()
+
+            started = 0
+            free = self.workers - len(self.running)
+            if free > 0:
+                jobs = claim(session, free)
+                # Commit the lease before handing the jobs to the pool
+                submitted = [(job.id, job.name, json.loads(job.params)) for job in jobs]
+                session.commit()
+                for job_id, name, params in submitted:
+                    self._start(job_id, name, params)
+                    started += 1
+            return started
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def run(self, poll_interval=1.0):
+        try:
+            while True:
+                if not self.tick():
+                    time.sleep(poll_interval)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def job_counts(session):
+    return dict(session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background jobs")
+    parser.add_argument("command", choices=["run", "submit", "status"])
+    parser.add_argument("name", nargs="?", help="job to submit")
+    parser.add_argument("--params", default="{}", help="job parameters as a JSON object")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("JOBS_WORKERS", 2)))
+    parser.add_argument("--no-schedule", action="store_true", help="run jobs without queueing periodic ones")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if args.command == "submit":
+        if not args.name:
+            parser.error("submit needs a job name")
+        with get_session() as session:
+            job = submit(session, args.name, json.loads(args.params))
+            print(f"Queued job {job.id}: {job.name}")
+    elif args.command == "status":
+        session = SessionLocal()
+        try:
+            for status, count in sorted(job_counts(session).items()):
+                print(f"{status:10s} {count}")
+        finally:
+            session.close()
+    else:
+        Runner(args.workers, schedule=() if args.no_schedule else SCHEDULE).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Keyset pagination and NDJSON streaming for the admin list endpoints.
+
+Pages are ordered by (created_at, id) and continued with an opaque
+`after` cursor, so every page is a bounded index range scan no matter how
+deep into the table it is. Streaming mode walks the same query through a
+server-side cursor with yield_per, keeping memory flat.
+"""
+import base64
+import itertools
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from models import User, Message
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK_SIZE = 1000
+
+MESSAGE_COLUMNS = (Message.id, Message.message_direction, Message.message_text, Message.created_at)
+USER_COLUMNS = (User.id, User.name, User.age, User.gender, User.county, User.town, User.created_at, User.updated_at)
+
+
+def encode_cursor(created_at, row_id):
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode an `after` cursor into (created_at, id); raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, _, row_id = base64.urlsafe_b64decode(padded).decode().partition("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def parse_stream_limit(value):
+    """Optional ?limit= for NDJSON streams: a positive integer, no upper bound."""
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return limit
+
+
+def parse_date_bound(value, end=False):
+    """Parse a from/to bound; a bare date as `to` covers that whole day."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}. Use YYYY-MM-DD or an ISO timestamp")
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def validate_args(args):
+    """Parse every filter argument up front; raises ValueError on bad input.
+
+    Streaming responses build their query lazily, after headers are sent,
+    so bad input has to be rejected before the stream starts.
+    """
+    parse_date_bound(args.get("from"))
+    parse_date_bound(args.get("to"), end=True)
+    if args.get("after"):
+        decode_cursor(args["after"])
+    direction = args.get("direction")
+    if direction and direction not in ("incoming", "outgoing"):
+        raise ValueError("direction must be 'incoming' or 'outgoing'")
+
+
+def _apply_window(query, created_column, id_column, args):
+    start = parse_date_bound(args.get("from"))
+    end = parse_date_bound(args.get("to"), end=True)
+    if start is not None:
+        query = query.filter(created_column >= start)
+    if end is not None:
+        query = query.filter(created_column < end)
+
+    after = args.get("after")
+    if after:
+        created_at, row_id = decode_cursor(after)
+        query = query.filter(or_(
+            created_column > created_at,
+            and_(created_column == created_at, id_column > row_id)
+        ))
+    return query.order_by(created_column, id_column)
+
+
+def filter_messages(query, args):
+    """Apply the direction and county filters from request args."""
+    direction = args.get("direction")
+    if direction:
+        query = query.filter(Message.message_direction == direction)
+    county = args.get("county")
+    if county:
+        query = query.join(User, User.id == Message.user_id).filter(User.county == county)
+    return query
+
+
+def filter_users(query, args):
+    """Apply the county and gender filters from request args."""
+    county = args.get("county")
+    if county:
+        query = query.filter(User.county == county)
+    gender = args.get("gender")
+    if gender:
+        query = query.filter(User.gender == gender)
+    return query
+
+
+def message_query(session, args):
+    """Build the filtered, keyset-ordered messages query from request args."""
+    query = filter_messages(session.query(*MESSAGE_COLUMNS), args)
+    return _apply_window(query, Message.created_at, Message.id, args)
+
+
+def user_query(session, args):
+    """Build the filtered, keyset-ordered users query from request args."""
+    query = filter_users(session.query(*USER_COLUMNS), args)
+    return _apply_window(query, User.created_at, User.id, args)
+
+
+def message_row_to_dict(row):
+    return {
+        'id': row.id,
+        'direction': row.message_direction,
+        'text': row.message_text,
+        'created_at': row.created_at.isoformat()
+    }
+
+
+def user_row_to_dict(row):
+    return {
+        'id': row.id,
+        'name': row.name,
+        'age': row.age,
+        'gender': row.gender,
+        'county': row.county,
+        'town': row.town,
+        'created_at': row.created_at.isoformat(),
+        'updated_at': row.updated_at.isoformat() if row.updated_at else None
+    }
+
+
+def fetch_page(query, limit, to_dict):
+    """Return (items, next_cursor) for one page of a keyset query."""
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return [to_dict(row) for row in rows], next_cursor
+
+
+def iter_ndjson(query, to_dict, limit=None, before=()):
+    """Yield NDJSON lines from a server-side cursor, STREAM_CHUNK_SIZE rows at a time.
+
+    `before` rows (e.g. archived messages, which are older) are emitted
+    ahead of the query's and count towards `limit`.
+    """
+    if limit is not None:
+        query = query.limit(limit)
+    query = query.execution_options(stream_results=True).yield_per(STREAM_CHUNK_SIZE)
+    rows = itertools.chain(before, query)
+    if limit is not None:
+        rows = itertools.islice(rows, limit)
+    buffer = []
+    for row in rows:
+        buffer.append(json.dumps(to_dict(row)))
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield "\n".join(buffer) + "\n"
+            buffer = []
+    if buffer:
+        yield "\n".join(buffer) + "\n"
@@ -0,0 +1,172 @@
+"""County and town dimension tables.
+
+users.county and users.town keep the text the user registered with;
+users.county_id and users.town_id point at one row per distinct county
+in `counties` and per (county, town) in `towns`, assigned on flush.
+Those rows also carry all-time counters (users per county and town,
+messages per sender county) that rollups.py bumps in the same
+transaction as the writes they count, so location analytics reads a few
+dozen small rows instead of grouping users and messages.
+
+Assign ids and rebuild the counters for existing data with:
+
+    python locations.py backfill
+"""
+import argparse
+from collections import Counter
+from sqlalchemy import event, inspect, select, insert, update, bindparam, func
+from sqlalchemy.exc import IntegrityError
+from models import User, Message, County, Town
+from database import SessionLocal, get_session
+
+# (table, counter column) pairs, used as Counter keys with a row id
+COUNTY_USERS = (County.__table__, "user_count")
+COUNTY_MESSAGES = (County.__table__, "message_count")
+TOWN_USERS = (Town.__table__, "user_count")
+
+MAX_CACHED = 10000
+
+# (county, town) -> (county_id, town_id) for rows known to be committed
+_ids = {}
+
+
+def _get_or_create(connection, table, values):
+    """Id of the row matching `values`, inserting it first if needed; returns (id, created)."""
+    query = select(table.c.id).filter_by(**values)
+    row_id = connection.execute(query).scalar()
+    if row_id is not None:
+        return row_id, False
+    try:
+        with connection.begin_nested():
+            return connection.execute(insert(table).values(**values)).inserted_primary_key[0], True
+    except IntegrityError:
+        # Another transaction inserted it first; a locking read sees its commit
+        return connection.execute(query.with_for_update()).scalar_one(), False
+
+
+def resolve(session, county, town):
+    """(county_id, town_id) for a county and town name, creating the rows if needed.
+
+    Ids of rows created by this session are only shared with other
+    sessions once it commits.
+    """
+    key = (county, town)
+    ids = _ids.get(key) or session.info.get("new_locations", {}).get(key)
+    if ids is not None:
+        return ids
+    connection = session.connection()
+    county_id, county_created = _get_or_create(connection, County.__table__, {"name": county})
+    town_id, town_created = _get_or_create(connection, Town.__table__, {"county_id": county_id, "name": town})
+    ids = (county_id, town_id)
+    if county_created or town_created:
+        session.info.setdefault("new_locations", {})[key] = ids
+    else:
+        _remember(key, ids)
+    return ids
+
+
+def _remember(key, ids):
+    if len(_ids) >= MAX_CACHED:
+        _ids.clear()
+    _ids[key] = ids
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _assign_location_ids(session, flush_context, instances):
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User):
+            continue
+        if user in session.dirty:
+            state = inspect(user)
+            if not (state.attrs.county.history.has_changes() or state.attrs.town.history.has_changes()):
+                continue
+        user.county_id, user.town_id = resolve(session, user.county, user.town)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _publish_new_locations(session):
+    for key, ids in session.info.pop("new_locations", {}).items():
+        _remember(key, ids)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_new_locations(session):
+    session.info.pop("new_locations", None)
+
+
+def count_user(totals, county_id, town_id):
+    totals[(COUNTY_USERS, county_id)] += 1
+    totals[(TOWN_USERS, town_id)] += 1
+
+
+def count_message(totals, county_id):
+    totals[(COUNTY_MESSAGES, county_id)] += 1
+
+
+def apply_totals(connection, totals):
+    """Add a Counter of ((table, column), row id) -> n to the dimension counters."""
+    by_counter = {}
+    for (counter, row_id), n in totals.items():
+        if row_id is not None and n:
+            by_counter.setdefault(counter, []).append({"row_id": row_id, "n": n})
+    for (table, column), rows in by_counter.items():
+        # Same lock order in every transaction, so concurrent writers cannot deadlock
+        rows.sort(key=lambda row: row["row_id"])
+        connection.execute(
+            update(table)
+            .where(table.c.id == bindparam("row_id"))
+            .values({column: table.c[column] + bindparam("n")}),
+            rows
+        )
+
+
+def recount(session):
+    """Recompute every dimension counter from the users and messages tables."""
+    connection = session.connection()
+    connection.execute(update(County.__table__).values(user_count=0, message_count=0))
+    connection.execute(update(Town.__table__).values(user_count=0))
+
+    totals = Counter()
+    for county_id, town_id, n in (
+        session.query(User.county_id, User.town_id, func.count(User.id))
+        .group_by(User.county_id, User.town_id)
+    ):
+        totals[(COUNTY_USERS, county_id)] += n
+        totals[(TOWN_USERS, town_id)] += n
+    for county_id, n in (
+        session.query(User.county_id, func.count(Message.id))
+        .join(User, User.id == Message.user_id)
+        .group_by(User.county_id)
+    ):
+        totals[(COUNTY_MESSAGES, county_id)] += n
+    apply_totals(connection, totals)
+
+
+def backfill(session):
+    """Assign county_id/town_id to every user, then recount; returns the number of (county, town) pairs."""
+    users = User.__table__
+    pairs = session.query(User.county, User.town).distinct().all()
+    for county, town in pairs:
+        county_id, town_id = resolve(session, county, town)
+        session.execute(
+            update(users)
+            .where(users.c.county == county, users.c.town == town)
+            .values(county_id=county_id, town_id=town_id)
+        )
+    recount(session)
+    return len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the county/town dimension tables")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        with get_session() as session:
+            pairs = backfill(session)
+        print(f"Assigned {pairs} county/town pair(s) and rebuilt the counters")
+
+
+if __name__ == "__main__":
+    main()
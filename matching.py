@@ -0,0 +1,197 @@
+"""Candidate search for MATCH#age-range#town.
+
+The search selects only user ids with equality on gender and town (or
+county) and a range on age, which the composite indexes
+ix_users_gender_town_age / ix_users_gender_county_age answer as an
+index-only range scan. Up to POOL_SIZE of those ids are then ordered by
+profile compatibility with the requester (see ranking.py) and the best
+MAX_CANDIDATES kept. Profiles are fetched separately, a page at a time.
+
+A MatchBatch keeps the result as packed int32 ids (candidate_ids) with
+matches_shown as the cursor, so NEXT slices the next page out of the
+blob without decoding the rest. Batches are flagged stale when a
+candidate in their location changes its matching attributes and are
+rebuilt on the next NEXT. Batches older than BATCH_RETENTION_DAYS are
+deleted by prune_batches(), run periodically from jobs.py.
+"""
+import json
+import os
+import struct
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, select, update, delete
+from models import User, MatchRequest, MatchBatch
+from database import SessionLocal
+from commands import validate_age_range
+import ranking
+
+# Most candidates kept for one MATCH request
+MAX_CANDIDATES = 500
+# Most ids read from the index search and ranked for one MATCH request
+POOL_SIZE = int(os.environ.get("MATCH_POOL_SIZE", 5000))
+# NEXT stops working on a search this old
+BATCH_RETENTION_DAYS = int(os.environ.get("MATCH_BATCH_RETENTION_DAYS", 30))
+DELETE_CHUNK_SIZE = 1000
+
+OPPOSITE_GENDER = {"Male": "Female", "Female": "Male"}
+
+
+def candidate_query(session, gender, min_age, max_age, location_column, location, limit=MAX_CANDIDATES):
+    return (
+        session.query(User.id)
+        .filter(
+            User.gender == gender,
+            location_column == location,
+            User.age.between(min_age, max_age)
+        )
+        .order_by(User.age, User.id)
+        .limit(limit)
+    )
+
+
+def candidate_ids(session, gender, min_age, max_age, location_column, location, limit=MAX_CANDIDATES):
+    return [
+        user_id for (user_id,) in
+        candidate_query(session, gender, min_age, max_age, location_column, location, limit)
+    ]
+
+
+def rank(session, user, ids, min_age, max_age, limit=MAX_CANDIDATES):
+    """The best `limit` of a candidate pool for `user`, most compatible first."""
+    return ranking.rank(session, user, ids, min_age, max_age, limit)
+
+
+def find_candidates(session, user, min_age, max_age, location, limit=MAX_CANDIDATES):
+    """Ids of opposite-gender users aged min_age..max_age in `location`, best match first.
+
+    `location` is matched against town first and, when no town matches,
+    against county, so both MATCH#23-25#Naivasha and MATCH#23-25#Nakuru work.
+    """
+    gender = OPPOSITE_GENDER.get(user.gender, "Female")
+    for location_column in (User.town, User.county):
+        ids = candidate_ids(session, gender, min_age, max_age, location_column, location, POOL_SIZE)
+        if ids:
+            return rank(session, user, ids, min_age, max_age, limit)
+    return []
+
+
+def pack_ids(ids):
+    return struct.pack(f"<{len(ids)}i", *ids)
+
+
+def _legacy_ids(match_data):
+    """Candidate ids from a JSON match_data list of ids or profile dicts."""
+    ids = []
+    for entry in json.loads(match_data or "[]"):
+        if isinstance(entry, dict):
+            entry = entry.get("id", entry.get("user_id"))
+        if entry is not None:
+            ids.append(int(entry))
+    return ids
+
+
+def batch_ids(batch, start=0, count=None):
+    """Ids [start:start+count] of a batch, reading only that slice when packed."""
+    if batch.candidate_ids is None:
+        ids = _legacy_ids(batch.match_data)
+        return ids[start:] if count is None else ids[start:start + count]
+    available = max(len(batch.candidate_ids) // 4 - start, 0)
+    count = available if count is None else min(count, available)
+    return list(struct.unpack_from(f"<{count}i", batch.candidate_ids, start * 4))
+
+
+def create_batch(session, match_request, user, ids, shown):
+    batch = MatchBatch(
+        request_id=match_request.id,
+        user_id=user.id,
+        total_matches=len(ids),
+        matches_shown=shown,
+        match_data="",
+        candidate_ids=pack_ids(ids)
+    )
+    session.add(batch)
+    return batch
+
+
+def refresh_batch(session, batch):
+    """Re-run a stale batch's search, keeping the profiles already shown first."""
+    match_request = batch.match_request
+    min_age, max_age = validate_age_range(match_request.age_range)
+    shown = batch_ids(batch, 0, batch.matches_shown)
+    already = set(shown)
+    fresh = find_candidates(session, batch.user, min_age, max_age, match_request.county)
+    ids = shown + [user_id for user_id in fresh if user_id not in already]
+    batch.candidate_ids = pack_ids(ids)
+    batch.match_data = ""
+    batch.total_matches = len(ids)
+    batch.is_stale = False
+
+
+def lock_batch(session, batch_id):
+    """Re-read a batch inside the transaction, row-locked, so its cursor is current."""
+    return session.execute(
+        select(MatchBatch).where(MatchBatch.id == batch_id).with_for_update()
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def next_page(session, batch, page_size):
+    """Ids of the next page of a batch; advances the cursor.
+
+    `batch` must be row-locked in this transaction (see lock_batch), or
+    two concurrent NEXTs could read the same cursor.
+    """
+    if batch.is_stale:
+        refresh_batch(session, batch)
+    ids = batch_ids(batch, batch.matches_shown, page_size)
+    batch.matches_shown += len(ids)
+    return ids
+
+
+def prune_batches(session, days=BATCH_RETENTION_DAYS):
+    """Delete batches created more than `days` ago; returns how many were deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = MatchBatch.__table__
+    deleted = 0
+    while True:
+        # Oldest first: ids follow created_at, so each scan stops early on the primary key
+        ids = [row_id for (row_id,) in session.execute(
+            select(table.c.id).where(table.c.created_at < cutoff).order_by(table.c.id).limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            return deleted
+        session.execute(delete(table).where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+_MATCHING_ATTRIBUTES = ("gender", "age", "town", "county")
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _invalidate_batches(session, flush_context, instances):
+    locations = set()
+    for user in session.dirty:
+        if not isinstance(user, User):
+            continue
+        state = inspect(user)
+        if any(state.attrs[name].history.has_changes() for name in _MATCHING_ATTRIBUTES):
+            for name in ("town", "county"):
+                history = state.attrs[name].history
+                locations.update(history.added or ())
+                locations.update(history.deleted or ())
+                locations.update(history.unchanged or ())
+    for user in session.deleted:
+        if isinstance(user, User):
+            locations.update((user.town, user.county))
+    if locations:
+        mark_stale(session, locations)
+
+
+def mark_stale(session, locations):
+    """Flag every batch searched in one of `locations` (towns or counties) as stale."""
+    requests = select(MatchRequest.id).where(MatchRequest.county.in_(locations))
+    session.connection().execute(
+        update(MatchBatch.__table__)
+        .where(MatchBatch.request_id.in_(requests))
+        .values(is_stale=True)
+    )
@@ -0,0 +1,234 @@
+"""Request and SQL instrumentation.
+
+init_app() hooks a Flask app and the database engines so that every
+request records its latency, status, and the number and total time of
+the SQL statements it ran. Statements slower than SLOW_QUERY_SECONDS are
+logged with their parameters on the "penzi.sql.slow" logger.
+Streamed responses (NDJSON listings, exports, the events stream) are
+recorded when the server closes them, so their latency covers the whole
+body. Statements run by a stream_with_context generator count towards
+them, but the X-SQL-* headers are sent first and only count statements
+run before the body started; the events stream reads outside the
+request context and reports no SQL.
+Everything is exported at /metrics in the Prometheus text format.
+
+With PROFILING_ENABLED set, ?profile=1 on any route samples the request
+thread's stack while the view runs. It returns the samples as collapsed
+stacks ("frame;frame;frame count" per line), which flamegraph.pl and
+speedscope read directly, instead of the normal response.
+"""
+import bisect
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+
+slow_query_log = logging.getLogger("penzi.sql.slow")
+
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_MS", 200)) / 1000
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    """Prometheus-style histogram with one series per label tuple."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), count, total) for labels, (counts, count, total) in self._series.items()}
+        for labels, (counts, count, total) in sorted(series.items()):
+            base = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{{{_labels(base, bound)}}} {cumulative}")
+            lines.append(f"{self.name}_bucket{{{_labels(base, '+Inf')}}} {count}")
+            label_text = f"{{{','.join(base)}}}" if base else ""
+            lines.append(f"{self.name}_count{label_text} {count}")
+            lines.append(f"{self.name}_sum{label_text} {total}")
+        return lines
+
+
+def _labels(base, bound):
+    return ",".join(base + [f'le="{bound}"'])
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "penzi_http_request_duration_seconds", "Time to produce a response",
+    ("method", "route", "status"), LATENCY_BUCKETS
+)
+REQUEST_QUERIES = Histogram(
+    "penzi_http_request_sql_queries", "SQL statements executed per request",
+    ("route",), QUERY_COUNT_BUCKETS
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "penzi_http_request_sql_seconds", "Cumulative SQL time per request",
+    ("route",), LATENCY_BUCKETS
+)
+SLOW_QUERIES = Counter()
+_slow_queries_lock = threading.Lock()
+
+HISTOGRAMS = (REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_SQL_SECONDS)
+
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append((context, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish_query(conn, statement, parameters)
+
+
+def _handle_error(exception_context):
+    # A statement that raised never reaches after_cursor_execute
+    conn = exception_context.connection
+    started = conn.info.get("query_started") if conn is not None else None
+    if started and started[-1][0] is exception_context.execution_context:
+        _finish_query(conn, exception_context.statement, exception_context.parameters)
+
+
+def _finish_query(conn, statement, parameters):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()[1]
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        with _slow_queries_lock:
+            SLOW_QUERIES[_route_label() if has_request_context() else "background"] += 1
+        slow_query_log.warning("%.1fms %s params=%r", elapsed * 1000, " ".join(statement.split()), parameters)
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+class StackSampler:
+    """Samples one thread's stack on a background thread into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    if PROFILING_ENABLED and request.args.get("profile") == "1":
+        g.sampler = StackSampler(threading.get_ident()).start()
+
+
+def _finish_request(response):
+    if "request_started" not in g:
+        return response
+    route = _route_label()
+    if response.is_streamed:
+        # The body is produced after this hook; g outlives the request
+        response.call_on_close(functools.partial(
+            _record, g._get_current_object(), request.method, route, response.status_code
+        ))
+    else:
+        _record(g, request.method, route, response.status_code)
+    response.headers["X-SQL-Queries"] = str(g.sql_queries)
+    response.headers["X-SQL-Time-Ms"] = f"{g.sql_seconds * 1000:.1f}"
+
+    sampler = g.pop("sampler", None)
+    if sampler is not None:
+        sampler.stop()
+        return Response(sampler.collapsed(), mimetype="text/plain")
+    return response
+
+
+def _record(state, method, route, status):
+    REQUEST_SECONDS.observe(time.perf_counter() - state.request_started, method, route, status)
+    REQUEST_QUERIES.observe(state.sql_queries, route)
+    REQUEST_SQL_SECONDS.observe(state.sql_seconds, route)
+
+
+def render(extra_gauges=()):
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    lines.append("# HELP penzi_sql_slow_queries_total Statements slower than the slow-query threshold")
+    lines.append("# TYPE penzi_sql_slow_queries_total counter")
+    for route, count in sorted(SLOW_QUERIES.items()):
+        lines.append(f'penzi_sql_slow_queries_total{{route="{_escape(route)}"}} {count}')
+    for name, help_text, samples in extra_gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app, engines):
+    for engine in engines:
+        instrument_engine(engine)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
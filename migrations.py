@@ -0,0 +1,280 @@
+"""Schema migrations.
+
+Migrations are plain functions registered in order with @migration and
+recorded in the schema_migrations table once applied. Each one checks
+the live schema before changing it, so databases created by hand or by
+create_all() can be brought up to date safely.
+
+    python migrations.py upgrade     # apply pending migrations
+    python migrations.py status      # list applied / pending
+"""
+import argparse
+from datetime import datetime
+from sqlalchemy import inspect, text, select, update, bindparam, func, Table, Column, String, DateTime, MetaData
+from sqlalchemy.orm import Session
+from models import (Base, User, Message, MatchBatch, UserMoreDetails, UserSelfDescription, OutboundMessage,
+                    MessageArchive, County, Town, SearchDocument, InboundReceipt, Job, DailyStat)
+from commands import COMMANDS, OTHER
+import profiles
+import partitions
+import locations
+import phones
+import search
+import rollups
+from database import engine as default_engine
+
+MIGRATIONS = []
+
+_version_table = Table(
+    "schema_migrations", MetaData(),
+    Column("version", String(20), primary_key=True),
+    Column("description", String(200)),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def has_column(connection, table_name, column_name):
+    return any(column["name"] == column_name for column in inspect(connection).get_columns(table_name))
+
+
+def has_index(connection, table_name, index_name):
+    return any(index["name"] == index_name for index in inspect(connection).get_indexes(table_name))
+
+
+def add_column(connection, column):
+    """ALTER TABLE ... ADD COLUMN for a model Column, if it is missing."""
+    table_name = column.table.name
+    if has_column(connection, table_name, column.name):
+        return False
+    preparer = connection.dialect.identifier_preparer
+    ddl = f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column.name)} " \
+          f"{column.type.compile(dialect=connection.dialect)}"
+    if not column.nullable and column.server_default is not None:
+        ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+    connection.execute(text(ddl))
+    return True
+
+
+def create_index(connection, index):
+    """Create a model Index unless an index with that name already exists."""
+    if has_index(connection, index.table.name, index.name):
+        return False
+    index.create(bind=connection)
+    return True
+
+
+def model_index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+@migration("0001", "Create missing tables")
+def _create_tables(connection):
+    Base.metadata.create_all(bind=connection)
+
+
+@migration("0002", "Add users.phone_number")
+def _users_phone_number(connection):
+    add_column(connection, User.__table__.c.phone_number)
+
+
+@migration("0003", "Composite indexes for MATCH candidate search")
+def _match_search_indexes(connection):
+    create_index(connection, model_index(User, "ix_users_gender_town_age"))
+    create_index(connection, model_index(User, "ix_users_gender_county_age"))
+
+
+@migration("0004", "Packed candidate ids and staleness flag on match_batches")
+def _match_batch_candidate_ids(connection):
+    add_column(connection, MatchBatch.__table__.c.candidate_ids)
+    add_column(connection, MatchBatch.__table__.c.is_stale)
+
+
+@migration("0005", "One details/description row per user, backfilled from messages")
+def _materialized_profiles(connection):
+    for model, index_name in (
+        (UserMoreDetails, "uq_usermoredetails_user_id"),
+        (UserSelfDescription, "uq_userselfdescription_user_id"),
+    ):
+        table = model.__tablename__
+        # Keep the newest row per user; the derived table lets MySQL
+        # delete from the table it is selecting from
+        connection.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN "
+            f"(SELECT id FROM (SELECT MAX(id) AS id FROM {table} GROUP BY user_id) AS newest)"
+        ))
+        create_index(connection, model_index(model, index_name))
+    session = Session(bind=connection)
+    profiles.backfill_from_messages(session)
+    session.flush()
+
+
+@migration("0006", "Outbound SMS queue")
+def _outbound_queue(connection):
+    OutboundMessage.__table__.create(bind=connection, checkfirst=True)
+
+
+# Indexes added by 0007, by model (see benchmarks/query_plans.py)
+HOT_QUERY_INDEXES = {
+    Message: (
+        "ix_messages_created_at_id", "ix_messages_direction_created_at_id",
+        "ix_messages_user_id_created_at", "ix_messages_command_created_at",
+    ),
+    User: ("ix_users_created_at_id", "ix_users_county_town"),
+}
+
+
+@migration("0007", "messages.command and indexes for the listing/analytics query shapes")
+def _hot_query_indexes(connection):
+    add_column(connection, Message.__table__.c.command)
+    messages = Message.__table__
+    # Same rule as commands.classify(): case-insensitive leading keyword
+    for name in COMMANDS:
+        connection.execute(
+            update(messages)
+            .where(messages.c.command.is_(None), func.lower(messages.c.message_text).like(f"{name.lower()}%"))
+            .values(command=name)
+        )
+    connection.execute(update(messages).where(messages.c.command.is_(None)).values(command=OTHER))
+    for model, index_names in HOT_QUERY_INDEXES.items():
+        for name in index_names:
+            create_index(connection, model_index(model, name))
+
+
+@migration("0008", "Message archive manifest; monthly RANGE partitions on MySQL")
+def _partition_messages(connection):
+    MessageArchive.__table__.create(bind=connection, checkfirst=True)
+    # Rebuilds the messages table on MySQL; a no-op elsewhere
+    partitions.partition_messages(connection)
+
+
+@migration("0009", "County/town dimension tables with counters; users.county_id/town_id")
+def _location_dimensions(connection):
+    County.__table__.create(bind=connection, checkfirst=True)
+    Town.__table__.create(bind=connection, checkfirst=True)
+    add_column(connection, User.__table__.c.county_id)
+    add_column(connection, User.__table__.c.town_id)
+    session = Session(bind=connection)
+    locations.backfill(session)
+    session.flush()
+    create_index(connection, model_index(User, "ix_users_county_id_town_id"))
+
+
+@migration("0010", "users.updated_at for ?since= deltas and the events stream")
+def _users_updated_at(connection):
+    if add_column(connection, User.__table__.c.updated_at):
+        users = User.__table__
+        connection.execute(
+            update(users).values(updated_at=func.coalesce(users.c.created_at, func.now()))
+        )
+    create_index(connection, model_index(User, "ix_users_updated_at_id"))
+
+
+@migration("0011", "E.164 users.phone_number with a unique index")
+def _unique_phone_numbers(connection):
+    users = User.__table__
+    rows = connection.execute(
+        select(users.c.id, users.c.phone_number).where(users.c.phone_number.is_not(None))
+    ).all()
+    owners = {}
+    changed = []
+    for user_id, phone_number in rows:
+        normalized = phones.normalize(phone_number)
+        owners.setdefault(normalized, []).append(user_id)
+        if normalized != phone_number:
+            changed.append({"user_id": user_id, "phone": normalized})
+    duplicates = {phone_number: ids for phone_number, ids in owners.items() if len(ids) > 1}
+    if duplicates:
+        sample = "; ".join(f"{phone_number}: users {ids}" for phone_number, ids in list(duplicates.items())[:10])
+        raise RuntimeError(
+            f"{len(duplicates)} phone number(s) belong to more than one user, merge or clear them first: {sample}"
+        )
+    if changed:
+        connection.execute(
+            update(users).where(users.c.id == bindparam("user_id")).values(phone_number=bindparam("phone")),
+            changed
+        )
+    create_index(connection, model_index(User, "uq_users_phone_number"))
+
+
+@migration("0012", "search_documents with a FULLTEXT (MySQL) or FTS5 (SQLite) index")
+def _search_documents(connection):
+    SearchDocument.__table__.create(bind=connection, checkfirst=True)
+    # 0001 may have created it empty
+    if connection.execute(select(SearchDocument.id).limit(1)).first() is None:
+        search.backfill(connection)
+
+
+@migration("0013", "inbound_receipts for deduplicating gateway retries")
+def _inbound_receipts(connection):
+    InboundReceipt.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration("0014", "jobs table for the background job runner")
+def _jobs(connection):
+    Job.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration("0015", "Source message id on search_documents")
+def _search_document_message_ids(connection):
+    if add_column(connection, SearchDocument.__table__.c.message_id):
+        # Existing message documents have no message id; rebuild them
+        search.backfill(connection)
+
+
+@migration("0016", "Backfill daily_stats rollups from existing rows")
+def _daily_stats(connection):
+    DailyStat.__table__.create(bind=connection, checkfirst=True)
+    # A filled table is kept: it still counts months archived since
+    if connection.execute(select(DailyStat.id).limit(1)).first() is None:
+        session = Session(bind=connection)
+        rollups.backfill(session)
+        session.flush()
+
+
+def applied_versions(connection):
+    _version_table.create(bind=connection, checkfirst=True)
+    return {row.version for row in connection.execute(_version_table.select())}
+
+
+def upgrade(bind=None, target=None):
+    """Apply pending migrations up to and including `target`; returns the versions applied."""
+    applied = []
+    with (bind or default_engine).begin() as connection:
+        done = applied_versions(connection)
+    for version, description, fn in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        if version in done:
+            continue
+        with (bind or default_engine).begin() as connection:
+            fn(connection)
+            connection.execute(_version_table.insert().values(version=version, description=description))
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status"])
+    parser.add_argument("--target", help="stop after this version")
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        applied = upgrade(target=args.target)
+        print(f"Applied {len(applied)} migration(s): {', '.join(applied) or 'none'}")
+    else:
+        with default_engine.begin() as connection:
+            done = applied_versions(connection)
+        for version, description, _ in MIGRATIONS:
+            print(f"{version} {'applied' if version in done else 'pending':8s} {description}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean
+from sqlalchemy import event, DDL, Column, Integer, String, DateTime, Date, ForeignKey, Text, Boolean, LargeBinary, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from commands import classify
 
 Base = declarative_base()
 
@@ -10,11 +11,18 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
+    # E.164, e.g. +254712345678 (see phones.py)
+    phone_number = Column(String(20))
     age = Column(Integer, nullable=False)
     gender = Column(String(10), nullable=False)
     county = Column(String(50), nullable=False)
     town = Column(String(50), nullable=False)
+    # Dimension keys for county/town, assigned on flush (see locations.py)
+    county_id = Column(Integer, ForeignKey('counties.id'))
+    town_id = Column(Integer, ForeignKey('towns.id'))
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Also bumped when the user's details or description change (see sync.py)
+    updated_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
     messages = relationship("Message", back_populates="user")
@@ -23,6 +31,43 @@ class User(Base):
     match_requests = relationship("MatchRequest", back_populates="requesting_user")
     match_batches = relationship("MatchBatch", back_populates="user")
 
+    __table_args__ = (
+        # MATCH#age-range#town candidate search (see matching.py)
+        Index('ix_users_gender_town_age', 'gender', 'town', 'age'),
+        Index('ix_users_gender_county_age', 'gender', 'county', 'age'),
+        # Keyset listing / daily signups, and location analytics
+        Index('ix_users_created_at_id', 'created_at', 'id'),
+        Index('ix_users_county_town', 'county', 'town'),
+        Index('ix_users_county_id_town_id', 'county_id', 'town_id'),
+        # ?since= deltas and the events stream
+        Index('ix_users_updated_at_id', 'updated_at', 'id'),
+        # Sender and DESCRIBE lookups
+        Index('uq_users_phone_number', 'phone_number', unique=True),
+    )
+
+class County(Base):
+    __tablename__ = "counties"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False, unique=True)
+    # All-time counters, bumped on write (see rollups.py)
+    user_count = Column(Integer, nullable=False, default=0, server_default='0')
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+class Town(Base):
+    __tablename__ = "towns"
+
+    id = Column(Integer, primary_key=True)
+    county_id = Column(Integer, ForeignKey('counties.id'), nullable=False)
+    name = Column(String(50), nullable=False)
+    user_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    county = relationship("County")
+
+    __table_args__ = (
+        UniqueConstraint('county_id', 'name', name='uq_towns_county_id_name'),
+    )
+
 class Match(Base):
     __tablename__ = "matches"
 
@@ -51,6 +96,10 @@ class UserMoreDetails(Base):
     # Relationship
     user = relationship("User", back_populates="more_details")
 
+    __table_args__ = (
+        Index('uq_usermoredetails_user_id', 'user_id', unique=True),
+    )
+
 class UserSelfDescription(Base):
     __tablename__ = 'userselfdescription'
 
@@ -62,6 +111,13 @@ class UserSelfDescription(Base):
     # Relationship
     user = relationship("User", back_populates="self_description")
 
+    __table_args__ = (
+        Index('uq_userselfdescription_user_id', 'user_id', unique=True),
+    )
+
+def _classify_message(context):
+    return classify(context.get_current_parameters()["message_text"])
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -69,11 +125,21 @@ class Message(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     message_direction = Column(String(10), nullable=False)  # 'incoming' or 'outgoing'
     message_text = Column(Text, nullable=False)
+    # Leading command keyword (commands.classify), set on insert so analytics
+    # can filter on an indexed column instead of LIKE scans over message_text
+    command = Column(String(10), default=_classify_message)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationship
     user = relationship("User", back_populates="messages")
 
+    __table_args__ = (
+        Index('ix_messages_created_at_id', 'created_at', 'id'),
+        Index('ix_messages_direction_created_at_id', 'message_direction', 'created_at', 'id'),
+        Index('ix_messages_user_id_created_at', 'user_id', 'created_at'),
+        Index('ix_messages_command_created_at', 'command', 'created_at'),
+    )
+
 class MatchRequest(Base):
     __tablename__ = "match_requests"
 
@@ -95,11 +161,131 @@ class MatchBatch(Base):
     request_id = Column(Integer, ForeignKey('match_requests.id'), nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     total_matches = Column(Integer, nullable=False)
-    matches_shown = Column(Integer, nullable=False, default=0)
-    match_data = Column(Text, nullable=False)
+    matches_shown = Column(Integer, nullable=False, default=0)  # cursor into the candidate list
+    match_data = Column(Text, nullable=False)  # legacy JSON candidate list
+    candidate_ids = Column(LargeBinary)  # packed little-endian int32 user ids
+    is_stale = Column(Boolean, nullable=False, default=False, server_default='0')
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
     match_request = relationship("MatchRequest")
     user = relationship("User", back_populates="match_batches")
 
+class DailyStat(Base):
+    __tablename__ = "daily_stats"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    dimension = Column(String(20), nullable=False)  # e.g. 'messages', 'command', 'county'
+    bucket = Column(String(120), nullable=False, default='')
+    total = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('day', 'dimension', 'bucket', name='uq_daily_stats_day_dimension_bucket'),
+    )
+
+class OutboundMessage(Base):
+    __tablename__ = "outbound_messages"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))  # None for replies to unregistered numbers
+    phone_number = Column(String(20), nullable=False)
+    message_text = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    # When a pending row is due, or when a 'sending' worker's lease expires
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_outbound_messages_status_next_attempt', 'status', 'next_attempt_at'),
+        Index('ix_outbound_messages_phone_status', 'phone_number', 'status', 'id'),
+    )
+
+class MessageArchive(Base):
+    __tablename__ = "message_archives"
+
+    id = Column(Integer, primary_key=True)
+    month = Column(Date, nullable=False, unique=True)  # first day of the archived month
+    path = Column(String(255), nullable=False)  # gzipped NDJSON, one message per line
+    row_count = Column(Integer, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class InboundReceipt(Base):
+    """One handled inbound SMS, for replaying the reply to gateway retries (see inbound.py)."""
+    __tablename__ = "inbound_receipts"
+
+    id = Column(Integer, primary_key=True)
+    # sha256 of the gateway message id, or of sender + text + time window
+    idempotency_key = Column(String(64), nullable=False)
+    phone_number = Column(String(20), nullable=False)
+    user_id = Column(Integer)
+    reply = Column(Text)  # set once the message is handled, in the same transaction
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('uq_inbound_receipts_idempotency_key', 'idempotency_key', unique=True),
+        Index('ix_inbound_receipts_created_at', 'created_at'),
+    )
+
+class Job(Base):
+    """A background job run by jobs.py, queued from the scheduler or the API."""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False)  # key of jobs.TASKS
+    params = Column(Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = Column(String(20), nullable=False, default='queued')  # queued, running, succeeded, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    # While running, renewed by the runner; a job past it is picked up again
+    lease_expires_at = Column(DateTime)
+    result = Column(Text)  # JSON return value
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_jobs_status_id', 'status', 'id'),
+        Index('ix_jobs_name_created_at', 'name', 'created_at'),
+    )
+
+class SearchDocument(Base):
+    """Full-text search copy of a message or a self-description (see search.py)."""
+    __tablename__ = "search_documents"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # 'message' or 'description'
+    user_id = Column(Integer, nullable=False)
+    message_id = Column(Integer)  # messages.id; None for descriptions, which are one per user_id
+    direction = Column(String(10))  # message direction; None for descriptions
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_search_documents_kind_created_at', 'kind', 'created_at', 'id'),
+        Index('ix_search_documents_user_id_kind', 'user_id', 'kind'),
+        # SQLite gets an FTS5 table instead (see search.py)
+        Index('ft_search_documents_body', 'body', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
+# SQLite has no FULLTEXT indexes; an external-content FTS5 table over
+# search_documents.body, kept in step by triggers, plays that part
+SQLITE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_documents_fts "
+    "USING fts5(body, content='search_documents', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS search_documents_ai AFTER INSERT ON search_documents BEGIN "
+    "INSERT INTO search_documents_fts(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS search_documents_ad AFTER DELETE ON search_documents BEGIN "
+    "INSERT INTO search_documents_fts(search_documents_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS search_documents_au AFTER UPDATE ON search_documents BEGIN "
+    "INSERT INTO search_documents_fts(search_documents_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO search_documents_fts(rowid, body) VALUES (new.id, new.body); END",
+)
+for _statement in SQLITE_FTS_DDL:
+    event.listen(SearchDocument.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+event.listen(SearchDocument.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS search_documents_fts").execute_if(dialect="sqlite"))
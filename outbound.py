@@ -0,0 +1,269 @@
+"""Outbound SMS queue.
+
+The request path only inserts rows into outbound_messages (enqueue());
+a worker process drains the queue to an SMS gateway:
+
+    python outbound.py worker --rate 20          # run until interrupted
+    python outbound.py worker --once             # drain one batch and exit
+    python outbound.py status                    # queue depth by status
+    python outbound.py prune --days 30           # delete old sent/failed rows
+
+A worker claims due rows in batches by flipping them to 'sending' with a
+lease, so several workers can share the queue and rows from a crashed
+worker are picked up again once the lease runs out. Only the oldest
+unsent message per recipient is ever claimed, which keeps each
+recipient's messages in order across retries. Failed sends are retried
+with exponential backoff until MAX_ATTEMPTS, then left as 'failed'.
+
+A rate-limited worker claims no more than it can send in half a lease,
+and skips sending a batch whose lease ran out while it waited, so
+another worker that re-claimed the rows is the only one to send them.
+"""
+import argparse
+import importlib
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, exists, func, select, delete
+from sqlalchemy.orm import aliased
+from models import OutboundMessage
+from database import SessionLocal
+from ratelimit import TokenBucket
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2  # seconds before the first retry, doubled per attempt
+BACKOFF_MAX = 600
+LEASE_SECONDS = 60
+RETENTION_DAYS = 30
+DELETE_CHUNK_SIZE = 10000
+
+
+class Gateway:
+    """SMS gateway adapter. Subclasses implement send() or send_batch()."""
+
+    def send(self, phone_number, text):
+        raise NotImplementedError
+
+    def send_batch(self, messages):
+        """Send (phone_number, text) pairs; returns an error string or None for each."""
+        errors = []
+        for phone_number, text in messages:
+            try:
+                self.send(phone_number, text)
+                errors.append(None)
+            except Exception as e:
+                errors.append(str(e))
+        return errors
+
+
+class LogGateway(Gateway):
+    """Logs messages instead of sending them, for development."""
+
+    def send(self, phone_number, text):
+        logger.info("SMS to %s: %s", phone_number, text)
+
+
+GATEWAYS = {"log": LogGateway}
+
+
+def load_gateway(spec):
+    """A gateway by name ("log") or as "package.module:ClassName"."""
+    if spec in GATEWAYS:
+        return GATEWAYS[spec]()
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown gateway {spec!r}; use one of {sorted(GATEWAYS)} or module:Class")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def enqueue(session, rows):
+    """Queue outgoing SMS. `rows` are dicts with user_id, phone_number and message_text."""
+    if rows:
+        session.execute(insert(OutboundMessage), rows)
+
+
+def claim(session, limit=BATCH_SIZE, now=None):
+    """Lease up to `limit` due messages, at most one per recipient, oldest first."""
+    now = now or datetime.utcnow()
+    earlier = aliased(OutboundMessage)
+    blocked = exists().where(
+        earlier.phone_number == OutboundMessage.phone_number,
+        earlier.id < OutboundMessage.id,
+        earlier.status.in_((PENDING, SENDING))
+    )
+    batch = (
+        session.query(OutboundMessage)
+        .filter(
+            OutboundMessage.status.in_((PENDING, SENDING)),
+            OutboundMessage.next_attempt_at <= now,
+            ~blocked
+        )
+        .order_by(OutboundMessage.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for message in batch:
+        message.status = SENDING
+        message.next_attempt_at = now + timedelta(seconds=LEASE_SECONDS)
+    return batch
+
+
+def backoff(attempts, rng=random):
+    """Seconds to wait before retry number `attempts`, with jitter."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * (0.5 + rng.random() / 2)
+
+
+def record_results(batch, errors, now=None):
+    now = now or datetime.utcnow()
+    for message, error in zip(batch, errors):
+        if error is None:
+            message.status = SENT
+            message.sent_at = now
+            message.last_error = None
+            continue
+        message.attempts += 1
+        message.last_error = error
+        if message.attempts >= MAX_ATTEMPTS:
+            message.status = FAILED
+        else:
+            message.status = PENDING
+            message.next_attempt_at = now + timedelta(seconds=backoff(message.attempts))
+
+
+class Worker:
+    def __init__(self, gateway, limiter=None, session_factory=SessionLocal, batch_size=BATCH_SIZE):
+        self.gateway = gateway
+        self.limiter = limiter
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+
+    def claim_limit(self):
+        """Batch size, capped at what the rate limiter lets through in half a lease."""
+        if self.limiter is None:
+            return self.batch_size
+        return max(1, min(self.batch_size, int(self.limiter.rate * LEASE_SECONDS / 2)))
+
+    def drain_once(self):
+        """Claim, send and record one batch; returns the number of messages handled."""
+        session = self.session_factory()
+        try:
+            lease_ends = time.monotonic() + LEASE_SECONDS
+            batch = claim(session, self.claim_limit())
+            messages = [(message.phone_number, message.message_text) for message in batch]
+            ids = [message.id for message in batch]
+            # Commit the lease before talking to the gateway
+            session.commit()
+            if not ids:
+                return 0
+
+            if self.limiter is not None:
+                for _ in messages:
+                    self.limiter.acquire()
+            if time.monotonic() >= lease_ends:
+                # Another worker may have re-claimed the rows; they are sent by whoever holds the lease
+                logger.warning("Lease on %d message(s) expired before sending; leaving them", len(ids))
+                return 0
+            try:
+                errors = self.gateway.send_batch(messages)
+            except Exception as e:
+                errors = [str(e)] * len(messages)
+
+            batch = (
+                session.query(OutboundMessage)
+                .filter(OutboundMessage.id.in_(ids))
+                .order_by(OutboundMessage.id)
+                .all()
+            )
+            record_results(batch, errors)
+            session.commit()
+            return len(ids)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def run(self, poll_interval=1.0):
+        while True:
+            if not self.drain_once():
+                time.sleep(poll_interval)
+
+
+def queue_status(session):
+    return dict(
+        session.query(OutboundMessage.status, func.count(OutboundMessage.id))
+        .group_by(OutboundMessage.status)
+        .all()
+    )
+
+
+def prune(session, days=RETENTION_DAYS):
+    """Delete sent and failed messages older than `days`; returns how many were deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = OutboundMessage.__table__
+    deleted = 0
+    while True:
+        # next_attempt_at of a finished row is its last lease, close to when it was sent or given up;
+        # filtering on it uses ix_outbound_messages_status_next_attempt
+        ids = [row_id for (row_id,) in session.execute(
+            select(table.c.id)
+            .where(table.c.status.in_((SENT, FAILED)), table.c.next_attempt_at < cutoff)
+            .limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            return deleted
+        session.execute(delete(table).where(table.c.id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deliver queued outbound SMS")
+    parser.add_argument("command", choices=["worker", "status", "prune"])
+    parser.add_argument("--gateway", default=os.environ.get("OUTBOUND_GATEWAY", "log"))
+    parser.add_argument("--rate", type=float, default=float(os.environ.get("OUTBOUND_RATE", 10)),
+                        help="messages per second")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--once", action="store_true", help="drain one batch and exit")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS, help="prune: keep this many days")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if args.command == "status":
+        session = SessionLocal()
+        try:
+            for status, count in sorted(queue_status(session).items()):
+                print(f"{status:8s} {count}")
+        finally:
+            session.close()
+        return
+    if args.command == "prune":
+        session = SessionLocal()
+        try:
+            deleted = prune(session, args.days)
+        finally:
+            session.close()
+        print(f"Deleted {deleted} message(s) older than {args.days} day(s)")
+        return
+
+    worker = Worker(load_gateway(args.gateway), TokenBucket(args.rate), batch_size=args.batch_size)
+    if args.once:
+        print(f"Handled {worker.drain_once()} message(s)")
+    else:
+        worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""Monthly partitions and cold-month archiving for the messages table.
+
+On MySQL, migration 0008 converts messages to RANGE partitions by month
+on TO_DAYS(created_at). Date-bounded queries such as the dashboard's
+`created_at >= start` then prune to the recent partitions, and archiving a
+month drops its partition in constant time. Partitioned InnoDB tables
+cannot carry foreign keys and need the partition column in every unique
+key, so the conversion drops the user_id foreign key and widens the
+primary key to (id, created_at).
+
+SQLite has no partitioning. There the archive job deletes the month by
+created_at range instead, using ix_messages_created_at_id.
+
+An archived month is written to a gzipped NDJSON file and recorded in
+message_archives before its rows leave the table. archived_messages()
+reads archived months back for callers that ask for them. Their search
+documents are dropped with them (search covers live messages only).
+Rollups in daily_stats are not touched, so the dashboards keep their
+history.
+
+    python partitions.py maintain --months-ahead 3   # add future partitions (MySQL)
+    python partitions.py archive --keep-months 13    # archive months older than that
+    python partitions.py status
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+from datetime import date, datetime, time
+from typing import NamedTuple
+from sqlalchemy import inspect, text, select, delete, func
+from models import Message, MessageArchive
+from database import SessionLocal
+from cache import response_cache
+import listing
+import search
+
+ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", "archive")
+# Longer than the dashboard's longest window (MAX_WINDOW_DAYS), so live
+# stats never need archived rows
+KEEP_MONTHS = 13
+MONTHS_AHEAD = 3
+DELETE_CHUNK_SIZE = 5000
+READ_CHUNK_SIZE = 5000
+
+MAXVALUE_PARTITION = "pmax"
+
+
+class ArchivedMessage(NamedTuple):
+    id: int
+    user_id: int
+    message_direction: str
+    message_text: str
+    command: str
+    created_at: datetime
+
+
+ARCHIVE_COLUMNS = (
+    Message.id, Message.user_id, Message.message_direction,
+    Message.message_text, Message.command, Message.created_at
+)
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def _partition_month(name):
+    return datetime.strptime(name[1:], "%Y%m").date()
+
+
+def _partition_clause(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1)}'))"
+
+
+def _month_bounds(month):
+    return datetime.combine(month, time.min), datetime.combine(add_months(month, 1), time.min)
+
+
+def mysql_partitions(connection):
+    """The messages table's partition names, oldest first; empty if it is not partitioned."""
+    if connection.dialect.name != "mysql":
+        return []
+    rows = connection.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ))
+    return [name for (name,) in rows]
+
+
+def partition_messages(connection, months_ahead=MONTHS_AHEAD, today=None):
+    """Convert messages to monthly RANGE partitions. MySQL only; no-op if already done."""
+    if connection.dialect.name != "mysql" or mysql_partitions(connection):
+        return False
+    for foreign_key in inspect(connection).get_foreign_keys("messages"):
+        connection.execute(text(f"ALTER TABLE messages DROP FOREIGN KEY `{foreign_key['name']}`"))
+
+    this_month = month_start(today or date.today())
+    oldest = connection.execute(select(func.min(Message.created_at))).scalar()
+    first = month_start(oldest) if oldest else this_month
+    # The partition column joins the primary key, so it cannot stay NULL
+    connection.execute(
+        text("UPDATE messages SET created_at = :first WHERE created_at IS NULL"),
+        {"first": datetime.combine(first, time.min)}
+    )
+    connection.execute(text(
+        "ALTER TABLE messages MODIFY created_at DATETIME NOT NULL, "
+        "DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at)"
+    ))
+
+    months = []
+    month = first
+    while month <= add_months(this_month, months_ahead):
+        months.append(month)
+        month = add_months(month, 1)
+    clauses = [_partition_clause(month) for month in months]
+    clauses.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE")
+    connection.execute(text(
+        f"ALTER TABLE messages PARTITION BY RANGE (TO_DAYS(created_at)) ({', '.join(clauses)})"
+    ))
+    return True
+
+
+def ensure_partitions(connection, months_ahead=MONTHS_AHEAD, today=None):
+    """Split pmax so monthly partitions exist through `months_ahead` months from now."""
+    names = [name for name in mysql_partitions(connection) if name != MAXVALUE_PARTITION]
+    if not names:
+        return []
+    newest = _partition_month(names[-1])
+    last = add_months(month_start(today or date.today()), months_ahead)
+    months = []
+    month = add_months(newest, 1)
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    if months:
+        clauses = [_partition_clause(month) for month in months]
+        clauses.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN MAXVALUE")
+        connection.execute(text(
+            f"ALTER TABLE messages REORGANIZE PARTITION {MAXVALUE_PARTITION} INTO ({', '.join(clauses)})"
+        ))
+    return [partition_name(month) for month in months]
+
+
+def _write_archive(session, month, archive_dir):
+    """Write a month's rows to <archive_dir>/messages-YYYY-MM.ndjson.gz; returns (path, rows, sha256)."""
+    start, end = _month_bounds(month)
+    os.makedirs(archive_dir, exist_ok=True)
+    # Absolute, so read_archive() works from any working directory
+    path = os.path.join(os.path.abspath(archive_dir), f"messages-{month:%Y-%m}.ndjson.gz")
+    partial = path + ".partial"
+    query = (
+        session.query(*ARCHIVE_COLUMNS)
+        .filter(Message.created_at >= start, Message.created_at < end)
+        .order_by(Message.created_at, Message.id)
+        .execution_options(stream_results=True)
+        .yield_per(READ_CHUNK_SIZE)
+    )
+    count = 0
+    with gzip.open(partial, "wt", encoding="utf-8") as archive:
+        for row in query:
+            record = ArchivedMessage(*row)._asdict()
+            record["created_at"] = row.created_at.isoformat()
+            archive.write(json.dumps(record) + "\n")
+            count += 1
+
+    digest = hashlib.sha256()
+    with open(partial, "rb") as archive:
+        for block in iter(lambda: archive.read(1 << 20), b""):
+            digest.update(block)
+    os.replace(partial, path)
+    return path, count, digest.hexdigest()
+
+
+def _remove_month(session, month):
+    """Drop the month's partition (MySQL) or delete its rows in chunks."""
+    connection = session.connection()
+    start, end = _month_bounds(month)
+    names = mysql_partitions(connection)
+    if partition_name(month) in names:
+        # The first partition also holds anything older than its month
+        older = names[0] == partition_name(month) and session.query(Message.id).filter(
+            Message.created_at < start
+        ).first()
+        if not older:
+            connection.execute(text(f"ALTER TABLE messages DROP PARTITION {partition_name(month)}"))
+            return
+    while True:
+        ids = [row_id for (row_id,) in session.execute(
+            select(Message.id)
+            .where(Message.created_at >= start, Message.created_at < end)
+            .limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            break
+        session.execute(delete(Message.__table__).where(Message.id.in_(ids)))
+        session.commit()
+
+
+def archive_month(session, month, archive_dir=ARCHIVE_DIR):
+    """Move one month of messages to a compressed archive file; returns its MessageArchive.
+
+    Safe to re-run after a failure: a month already in the manifest is
+    only removed from the table if no rows were added to it since.
+    """
+    month = month_start(month)
+    entry = session.query(MessageArchive).filter(MessageArchive.month == month).first()
+    if entry is None:
+        path, count, digest = _write_archive(session, month, archive_dir)
+        if count == 0:
+            os.remove(path)
+            return None
+        entry = MessageArchive(month=month, path=path, row_count=count, sha256=digest)
+        session.add(entry)
+        session.commit()
+    else:
+        start, end = _month_bounds(month)
+        remaining = session.query(func.count(Message.id)).filter(
+            Message.created_at >= start, Message.created_at < end
+        ).scalar()
+        if remaining > entry.row_count:
+            raise RuntimeError(
+                f"{remaining} messages in {month:%Y-%m} but only {entry.row_count} archived; "
+                "delete the manifest entry and archive again"
+            )
+    _remove_month(session, month)
+    search.remove_messages(session, *_month_bounds(month))
+    session.commit()
+    response_cache.invalidate("messages")
+    return entry
+
+
+def archive_cold(session, keep_months=KEEP_MONTHS, archive_dir=ARCHIVE_DIR, today=None):
+    """Archive every month older than the last `keep_months` months."""
+    if keep_months <= 0:
+        raise ValueError("keep_months must be at least 1; the current month is still being written")
+    cutoff = add_months(month_start(today or date.today()), -keep_months)
+    oldest = session.query(func.min(Message.created_at)).scalar()
+    archived = []
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        entry = archive_month(session, month, archive_dir)
+        if entry is not None:
+            archived.append(entry)
+        month = add_months(month, 1)
+    return archived
+
+
+def read_archive(entry):
+    """ArchivedMessage rows of one archive file, oldest first."""
+    with gzip.open(entry.path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            record = json.loads(line)
+            record["created_at"] = datetime.fromisoformat(record["created_at"])
+            yield ArchivedMessage(**record)
+
+
+def archived_messages(session, start=None, end=None, user_id=None, direction=None, after=None):
+    """Archived messages in [start, end), ordered by (created_at, id) like the live listing.
+
+    `after` is a (created_at, id) keyset position, as decoded from a cursor.
+    """
+    entries = session.query(MessageArchive).order_by(MessageArchive.month)
+    if start is not None:
+        entries = entries.filter(MessageArchive.month >= month_start(start))
+    if end is not None:
+        entries = entries.filter(MessageArchive.month < end)
+    for entry in entries.all():
+        for row in read_archive(entry):
+            if start is not None and row.created_at < start:
+                continue
+            if end is not None and row.created_at >= end:
+                continue
+            if after is not None and (row.created_at, row.id) <= after:
+                continue
+            if user_id is not None and row.user_id != user_id:
+                continue
+            if direction is not None and row.message_direction != direction:
+                continue
+            yield row
+
+
+def archived_for_listing(session, args):
+    """archived_messages() for the /api/penzi/messages filters (from, to, direction, after).
+
+    Archived rows carry no user columns, so a county filter cannot apply.
+    """
+    after = listing.decode_cursor(args["after"]) if args.get("after") else None
+    return archived_messages(
+        session,
+        start=listing.parse_date_bound(args.get("from")),
+        end=listing.parse_date_bound(args.get("to"), end=True),
+        direction=args.get("direction"),
+        after=after
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition and archive the messages table")
+    parser.add_argument("command", choices=["maintain", "archive", "status"])
+    parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD)
+    parser.add_argument("--keep-months", type=int, default=KEEP_MONTHS)
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    args = parser.parse_args()
+    if args.keep_months < 1:
+        parser.error("--keep-months must be at least 1")
+
+    session = SessionLocal()
+    try:
+        if args.command == "maintain":
+            added = ensure_partitions(session.connection(), args.months_ahead)
+            session.commit()
+            print(f"Added {len(added)} partition(s): {', '.join(added) or 'none'}")
+        elif args.command == "archive":
+            archived = archive_cold(session, args.keep_months, args.archive_dir)
+            for entry in archived:
+                print(f"{entry.month:%Y-%m} {entry.row_count} rows -> {entry.path}")
+            print(f"Archived {len(archived)} month(s)")
+        else:
+            print("partitions:", ", ".join(mysql_partitions(session.connection())) or "none (not partitioned)")
+            for entry in session.query(MessageArchive).order_by(MessageArchive.month):
+                print(f"archived {entry.month:%Y-%m} {entry.row_count:8d} rows {entry.path}")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
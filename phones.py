@@ -0,0 +1,163 @@
+"""Phone numbers: E.164 normalization and the phone -> user id lookup.
+
+users.phone_number holds the E.164 form (+254712345678) under a unique
+index, so resolving a sender is one indexed probe. An in-process LRU
+cache of phone -> user id in front of it turns repeat senders into a
+primary-key load, usually an identity-map hit. Only committed
+registrations are cached: users created in a session are added when it
+commits, and a cached id whose row no longer carries that number is
+dropped and looked up again. Unregistered numbers are never cached, so a
+registration on another worker is seen immediately.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.util import identity_key
+from models import User
+from database import SessionLocal
+
+# Added to local (0712...) and bare subscriber (712...) numbers
+COUNTRY_CODE = os.environ.get("PHONE_COUNTRY_CODE", "254")
+SUBSCRIBER_DIGITS = 9
+
+DEFAULT_CACHE_SIZE = 100000
+
+_SEPARATORS = re.compile(r"[\s().-]")
+
+
+def normalize(phone_number):
+    """E.164 form of a phone number.
+
+    Accepts +254712345678, 00254712345678, 254712345678, 0712345678 and
+    712345678 (with spaces, dashes, dots or parentheses). Anything that is
+    not a plausible number, such as an alphanumeric sender id, is returned
+    without its separators.
+    """
+    cleaned = _SEPARATORS.sub("", phone_number)
+    if cleaned.startswith("+"):
+        digits = cleaned[1:]
+    elif cleaned.startswith("00"):
+        digits = cleaned[2:]
+    elif cleaned.startswith("0"):
+        digits = COUNTRY_CODE + cleaned[1:]
+    elif len(cleaned) == SUBSCRIBER_DIGITS:
+        digits = COUNTRY_CODE + cleaned
+    else:
+        digits = cleaned
+    if not digits.isdigit() or not 8 <= len(digits) <= 15:
+        return cleaned
+    return "+" + digits
+
+
+class PhoneCache:
+    """Thread-safe LRU dict of phone number -> user id."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, phone_number):
+        with self._lock:
+            user_id = self._entries.get(phone_number)
+            if user_id is not None:
+                self._entries.move_to_end(phone_number)
+            return user_id
+
+    def set(self, phone_number, user_id):
+        with self._lock:
+            self._entries[phone_number] = user_id
+            self._entries.move_to_end(phone_number)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, phone_number):
+        with self._lock:
+            self._entries.pop(phone_number, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+phone_cache = PhoneCache(int(os.environ.get("PHONE_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
+
+
+def resolve_users(session, phone_numbers):
+    """Map phone numbers (any accepted form) to their Users; returns {E.164: User}.
+
+    Cached numbers are loaded by primary key, the rest with one query on
+    the phone number index. Unregistered numbers are left out.
+    """
+    wanted = {normalize(phone_number) for phone_number in phone_numbers}
+    found = {}
+    cached = {}
+    for phone_number in wanted:
+        user_id = phone_cache.get(phone_number)
+        if user_id is not None:
+            cached[user_id] = phone_number
+
+    if cached:
+        missing = [user_id for user_id in cached
+                   if session.identity_map.get(identity_key(User, user_id)) is None]
+        if len(missing) > 1:
+            # One query for the batch; session.get() below then hits the identity map
+            session.query(User).filter(User.id.in_(missing)).all()
+        for user_id, phone_number in cached.items():
+            user = session.get(User, user_id)
+            if user is not None and user.phone_number == phone_number:
+                found[phone_number] = user
+            else:
+                phone_cache.discard(phone_number)
+
+    misses = wanted - set(found)
+    if misses:
+        uncommitted = session.info.get("registered_phones", {})
+        for user in session.query(User).filter(User.phone_number.in_(misses)):
+            found[user.phone_number] = user
+            if user.phone_number not in uncommitted:
+                phone_cache.set(user.phone_number, user.id)
+    return found
+
+
+def find_user(session, phone_number):
+    """The User registered with `phone_number`, or None."""
+    return resolve_users(session, [phone_number]).get(normalize(phone_number))
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_registrations(session, flush_context):
+    registered = session.info.setdefault("registered_phones", {})
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User):
+            continue
+        if user in session.dirty:
+            history = inspect(user).attrs.phone_number.history
+            if not history.has_changes():
+                continue
+            for old in history.deleted:
+                if old:
+                    registered.setdefault(old, None)
+        if user.phone_number:
+            registered[user.phone_number] = user.id
+    if not registered:
+        session.info.pop("registered_phones")
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _cache_registrations(session):
+    for phone_number, user_id in session.info.pop("registered_phones", {}).items():
+        if user_id is None:
+            phone_cache.discard(phone_number)
+        else:
+            phone_cache.set(phone_number, user_id)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_registrations(session):
+    session.info.pop("registered_phones", None)
@@ -0,0 +1,125 @@
+"""User profiles materialized in users, usermoredetails and userselfdescription.
+
+The DETAILS and MYSELF handlers write through update_details() and
+update_description(), which keep exactly one row per user in each table,
+so a profile is always a single eager-loaded query away instead of a
+replay of the user's message history.
+"""
+from sqlalchemy.orm import joinedload, load_only
+from models import User, UserMoreDetails, UserSelfDescription, Message
+from commands import parse, ValidationError, Details, Myself
+
+MAX_BATCH_IDS = 100
+
+
+def profile_query(session):
+    return session.query(User).options(
+        joinedload(User.more_details),
+        joinedload(User.self_description)
+    )
+
+
+def load_profile(session, user_id):
+    return profile_query(session).filter(User.id == user_id).first()
+
+
+def load_profiles(session, user_ids):
+    """Profiles for many users in one round trip, in the order of `user_ids`."""
+    users = {user.id: user for user in profile_query(session).filter(User.id.in_(user_ids))}
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
+def serialize(user):
+    details = user.more_details
+    description = user.self_description
+    return {
+        'id': user.id,
+        'name': user.name,
+        'age': user.age,
+        'gender': user.gender,
+        'county': user.county,
+        'town': user.town,
+        'created_at': user.created_at.isoformat() if user.created_at else None,
+        'details': {
+            'education': details.level_of_education if details else None,
+            'profession': details.profession if details else None,
+            'marital_status': details.marital_status if details else None,
+            'religion': details.religion if details else None,
+            'ethnicity': details.ethnicity if details else None
+        },
+        'description': description.description if description else None
+    }
+
+
+def parse_ids(value):
+    """Parse an `ids=1,2,3` argument; raises ValueError."""
+    try:
+        user_ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError("ids must be a comma-separated list of integers")
+    if not user_ids:
+        raise ValueError("ids must not be empty")
+    if len(user_ids) > MAX_BATCH_IDS:
+        raise ValueError(f"At most {MAX_BATCH_IDS} ids per request")
+    return list(dict.fromkeys(user_ids))
+
+
+def update_details(session, user, education, profession, marital_status, religion, ethnicity):
+    details = user.more_details
+    if details is None:
+        details = UserMoreDetails(user_id=user.id)
+        session.add(details)
+        user.more_details = details
+    details.level_of_education = education
+    details.profession = profession
+    details.marital_status = marital_status
+    details.religion = religion
+    details.ethnicity = ethnicity
+    return details
+
+
+def update_description(session, user, text):
+    description = user.self_description
+    if description is None:
+        description = UserSelfDescription(user_id=user.id, description=text)
+        session.add(description)
+        user.self_description = description
+    else:
+        description.description = text
+    return description
+
+
+def backfill_from_messages(session):
+    """Materialize DETAILS/MYSELF sent before profiles were written on update.
+
+    Replays incoming messages oldest first for users that have no details
+    or no description row yet, so the latest command wins as it did when
+    profiles were rebuilt from messages on every request.
+    """
+    users = (
+        profile_query(session)
+        # Only users.id: this runs from migration 0005, before later columns exist
+        .options(load_only(User.id))
+        .filter((~User.more_details.has()) | (~User.self_description.has()))
+        .all()
+    )
+    updated = 0
+    for user in users:
+        missing_details = user.more_details is None
+        missing_description = user.self_description is None
+        for (text,) in (
+            session.query(Message.message_text)
+            .filter(Message.user_id == user.id, Message.message_direction == 'incoming')
+            .order_by(Message.id)
+        ):
+            try:
+                command = parse(text)
+            except ValidationError:
+                continue
+            if isinstance(command, Details) and missing_details:
+                update_details(session, user, *command)
+                updated += 1
+            elif isinstance(command, Myself) and missing_description:
+                update_description(session, user, command.description)
+                updated += 1
+    return updated
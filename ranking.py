@@ -0,0 +1,308 @@
+"""Compatibility ranking of MATCH candidates.
+
+matching.find_candidates() pulls up to matching.POOL_SIZE ids from the
+indexed age/location search; rank() scores them against the requester
+and keeps the best MAX_CANDIDATES, best first, for the MatchBatch.
+
+Scoring reads candidate attributes from an in-process AttributeStore:
+one packed row of small integers per user, indexed by user id, with each
+distinct details value interned to a code (up to MAX_VOCABULARY per
+field; rarer values beyond that share OTHER, which matches nothing). Ranking a pool is a single
+gather of its rows followed by comparisons and small table lookups over
+the columns, with no per-candidate Python.
+
+The store is loaded on a background thread, started when the app is
+imported (or by the first MATCH); until it completes, pools are returned
+unranked in search order. After that, requests refresh it from
+users.updated_at (bumped when details or a description change, see
+sync.py) at most every REFRESH_SECONDS, each applying at most
+REFRESH_BATCH_SIZE changed users, so profile edits made on any worker
+reach the ranking within about that time and no request pays for a
+large catch-up.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select, and_, or_
+from sqlalchemy.orm import Session
+from models import User, UserMoreDetails, UserSelfDescription
+
+logger = logging.getLogger(__name__)
+
+REFRESH_SECONDS = 30
+REFRESH_BATCH_SIZE = 2000
+# Set to 0 for processes that never rank (e.g. job workers importing the app)
+WARM_ON_START = os.environ.get("RANKING_WARM_ON_START", "1").lower() in ("1", "true", "yes")
+# Rows updated this long before the last refresh started are read again,
+# to catch transactions that committed after it with earlier timestamps
+REFRESH_OVERLAP = timedelta(seconds=60)
+LOAD_CHUNK_SIZE = 50000
+
+# usermoredetails columns, interned; they are the first columns of a row
+FIELDS = ("level_of_education", "profession", "marital_status", "religion", "ethnicity")
+EDUCATION = FIELDS.index("level_of_education")
+# The other columns of a row
+EDUCATION_LEVEL = len(FIELDS)   # ordinal from EDUCATION_LEVELS, -1 if unknown
+AGE = EDUCATION_LEVEL + 1        # clipped to MAX_AGE
+FLAGS = AGE + 1                  # HAS_DETAILS | HAS_DESCRIPTION | LOADED
+COLUMNS = FLAGS + 1
+HAS_DETAILS = 1
+HAS_DESCRIPTION = 2
+LOADED = 4                       # unset for ids the store has not read yet
+MAX_AGE = 255
+
+# Interned codes; field values get OTHER once a field has MAX_VOCABULARY codes
+UNKNOWN = 0
+OTHER = 1
+MAX_VOCABULARY = 4096
+
+# Ordinal of each known education level; other values only match exactly
+EDUCATION_LEVELS = {
+    "primary": 0, "secondary": 1, "certificate": 2, "diploma": 3,
+    "degree": 4, "bachelors": 4, "masters": 5, "phd": 6,
+}
+MAX_EDUCATION_GAP = max(EDUCATION_LEVELS.values())
+
+# Score contributions; the age term is subtracted
+WEIGHTS = {
+    "religion": 3.0,
+    "education": 2.0,        # scaled by closeness of education levels
+    "marital_status": 1.5,
+    "ethnicity": 1.0,
+    "profession": 0.5,
+    "has_details": 1.0,
+    "has_description": 1.0,
+    "age": 2.0,              # per half-width of the requested range from its middle
+}
+EXACT_MATCH_FIELDS = ("religion", "marital_status", "ethnicity", "profession")
+
+_FLAG_SCORES = np.array([
+    WEIGHTS["has_details"] * bool(flags & HAS_DETAILS) + WEIGHTS["has_description"] * bool(flags & HAS_DESCRIPTION)
+    for flags in range(8)
+], dtype=np.float32)
+_AGES = np.arange(MAX_AGE + 1, dtype=np.float32)
+_LEVELS = np.arange(-1, MAX_EDUCATION_GAP + 1, dtype=np.float32)
+
+
+def _normalize(value):
+    return value.strip().lower() if value else ""
+
+
+class AttributeStore:
+    """Encoded attributes of every user: rows[user_id] is an int16 row of COLUMNS."""
+
+    def __init__(self):
+        self.rows = np.zeros((0, COLUMNS), dtype=np.int16)
+        # value -> code per field
+        self.vocabulary = [{"": UNKNOWN} for _ in FIELDS]
+        # (updated_at, user id) the next refresh reads after
+        self.watermark = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()  # held while refreshing
+        self._vocabulary_lock = threading.Lock()
+        self._loader = None
+        self._loader_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _intern(self, field, value):
+        vocabulary = self.vocabulary[field]
+        value = _normalize(value)
+        code = vocabulary.get(value)
+        if code is None:
+            if len(vocabulary) + 1 >= MAX_VOCABULARY:
+                return OTHER
+            # + 1 skips OTHER
+            code = vocabulary[value] = len(vocabulary) + 1
+        return code
+
+    def code(self, field, value):
+        """The code of `value`, interning it if it is new."""
+        with self._vocabulary_lock:
+            return self._intern(field, value)
+
+    def lookup(self, field, value):
+        """The code of `value` without interning it; OTHER if no user has it."""
+        with self._vocabulary_lock:
+            return self.vocabulary[field].get(_normalize(value), OTHER)
+
+    def _grow(self, max_id):
+        size = len(self)
+        if max_id < size:
+            return
+        rows = np.zeros((max(max_id + 1, size * 2, 1024), COLUMNS), dtype=np.int16)
+        rows[:size] = self.rows
+        rows[size:, EDUCATION_LEVEL] = -1
+        self.rows = rows
+
+    def apply(self, rows):
+        """Store (user_id, age, description id, *FIELDS values) rows; a None field means no details row."""
+        if not rows:
+            return
+        self._grow(max(row[0] for row in rows))
+        with self._vocabulary_lock:
+            encoded = np.array([
+                [self._intern(field, row[3 + field]) for field in range(len(FIELDS))]
+                + [EDUCATION_LEVELS.get(_normalize(row[3 + EDUCATION]), -1),
+                   min(max(row[1], 0), MAX_AGE),
+                   LOADED | (HAS_DETAILS if row[3] is not None else 0)
+                   | (HAS_DESCRIPTION if row[2] is not None else 0)]
+                for row in rows
+            ], dtype=np.int16)
+        self.rows[[row[0] for row in rows]] = encoded
+
+    def _query(self):
+        # apply() reads the leading columns; updated_at comes last
+        return (
+            select(User.id, User.age, UserSelfDescription.id,
+                   *(getattr(UserMoreDetails, name) for name in FIELDS), User.updated_at)
+            .outerjoin(UserMoreDetails, UserMoreDetails.user_id == User.id)
+            .outerjoin(UserSelfDescription, UserSelfDescription.user_id == User.id)
+        )
+
+    def load(self, session):
+        """Load every user."""
+        started = datetime.utcnow()
+        result = session.execute(self._query().execution_options(yield_per=LOAD_CHUNK_SIZE))
+        for rows in result.partitions():
+            self.apply(rows)
+        self.watermark = (started - REFRESH_OVERLAP, 0)
+        self.refreshed_at = time.monotonic()
+
+    def refresh(self, session, limit=None):
+        """Apply up to `limit` (REFRESH_BATCH_SIZE) users updated after the watermark; True once caught up."""
+        limit = limit or REFRESH_BATCH_SIZE
+        started = datetime.utcnow()
+        updated_at, user_id = self.watermark
+        rows = session.execute(
+            self._query()
+            .where(or_(User.updated_at > updated_at, and_(User.updated_at == updated_at, User.id > user_id)))
+            .order_by(User.updated_at, User.id)
+            .limit(limit)
+        ).all()
+        self.apply(rows)
+        if len(rows) == limit:
+            # More to read; the next call continues from here
+            self.watermark = (rows[-1].updated_at, rows[-1].id)
+            return False
+        self.watermark = (started - REFRESH_OVERLAP, 0)
+        self.refreshed_at = time.monotonic()
+        return True
+
+    def _load_with(self, session_factory):
+        try:
+            with self._lock:
+                if self.refreshed_at is None:
+                    with session_factory() as session:
+                        self.load(session)
+        except Exception:
+            logger.exception("Loading the ranking attribute store failed")
+
+    def load_in_background(self, session_factory):
+        """Start loading every user on a thread, unless loaded or already loading."""
+        with self._loader_lock:
+            if self.refreshed_at is not None or (self._loader is not None and self._loader.is_alive()):
+                return
+            self._loader = threading.Thread(target=self._load_with, args=(session_factory,), daemon=True)
+            self._loader.start()
+
+    def ensure_fresh(self, session):
+        """Bring the store up to date as far as one request should.
+
+        Never loads on the caller's thread: before the first load completes
+        this starts it in the background; afterwards it applies at most one
+        REFRESH_BATCH_SIZE batch of changed users, and skips refreshing
+        while another thread is.
+        """
+        if self.refreshed_at is None:
+            self.load_in_background(session_factory_for(session))
+            return
+        if time.monotonic() - self.refreshed_at < REFRESH_SECONDS:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self.refreshed_at >= REFRESH_SECONDS:
+                self.refresh(session)
+        finally:
+            self._lock.release()
+
+
+store = AttributeStore()
+
+
+def session_factory_for(session):
+    """A factory for sessions on `session`'s database, for the background load."""
+    bind = session.get_bind()
+    return lambda: Session(bind=bind)
+
+
+def requester_profile(store, user):
+    """Codes of the requester's attributes, read from the ORM so this request's edits count."""
+    details = user.more_details
+    values = [getattr(details, name) if details is not None else None for name in FIELDS]
+    return {
+        "codes": [store.lookup(field, value) if value else UNKNOWN for field, value in enumerate(values)],
+        "education_level": EDUCATION_LEVELS.get(_normalize(values[EDUCATION]), -1),
+    }
+
+
+def score(store, profile, ids, min_age, max_age):
+    """Compatibility with the requester's `profile` of each candidate in `ids` (an int array).
+
+    Returns (ids, scores) for the ids the store has loaded.
+    """
+    ids = ids[ids < len(store)]
+    # One gather, then contiguous columns
+    columns = np.take(store.rows, ids, axis=0).T.copy()
+    loaded = (columns[FLAGS] & LOADED) != 0
+    if not loaded.all():
+        ids, columns = ids[loaded], columns[:, loaded]
+    scores = np.zeros(len(ids), dtype=np.float32)
+    for name in EXACT_MATCH_FIELDS:
+        field = FIELDS.index(name)
+        code = profile["codes"][field]
+        if code not in (UNKNOWN, OTHER):
+            scores += np.float32(WEIGHTS[name]) * (columns[field] == code)
+
+    level = profile["education_level"]
+    if level >= 0:
+        # Indexed by candidate level + 1, so unknown (-1) scores nothing
+        closeness = WEIGHTS["education"] * (1 - np.abs(_LEVELS - level) / MAX_EDUCATION_GAP)
+        closeness[0] = 0
+        scores += closeness[columns[EDUCATION_LEVEL] + 1]
+
+    scores += _FLAG_SCORES[columns[FLAGS]]
+
+    middle = (min_age + max_age) / 2
+    half_width = max((max_age - min_age) / 2, 1)
+    scores -= (WEIGHTS["age"] / half_width * np.abs(_AGES - middle))[columns[AGE]]
+    return ids, scores
+
+
+def top_k(ids, scores, k):
+    """The `k` best ids, best first; ties go to the lower id."""
+    if len(ids) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[best], scores[best]
+    order = np.lexsort((ids, -scores))
+    return ids[order]
+
+
+def rank(session, user, candidate_ids, min_age, max_age, limit):
+    """The best `limit` of `candidate_ids` for `user`, best first."""
+    if not candidate_ids:
+        return []
+    store.ensure_fresh(session)
+    ids = np.asarray(candidate_ids, dtype=np.int64)
+    known, scores = score(store, requester_profile(store, user), ids, min_age, max_age)
+    ranked = top_k(known, scores, limit).tolist()
+    if len(ranked) < limit and len(known) < len(ids):
+        # Registered after the last refresh: unscored, after the scored ones
+        unloaded = ids[np.isin(ids, known, invert=True)]
+        ranked.extend(unloaded[:limit - len(ranked)].tolist())
+    return ranked
@@ -0,0 +1,70 @@
+"""Token bucket rate limiting."""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take `tokens` if available; returns the seconds to wait otherwise (0 on success)."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then take them."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            self.sleep(wait)
+
+
+class KeyedTokenBuckets:
+    """A TokenBucket per key (e.g. per sender), for the `max_keys` most recently used keys.
+
+    Evicting a key only forgives it if it returns within capacity / rate
+    seconds; after that its bucket would have refilled anyway.
+    """
+
+    def __init__(self, rate, capacity=None, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, clock=self.clock)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def try_acquire(self, key, tokens=1):
+        """Take `tokens` from `key`'s bucket; returns the seconds to wait (0 on success)."""
+        return self.bucket(key).try_acquire(tokens)
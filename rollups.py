@@ -0,0 +1,340 @@
+"""Per-day rollup counters kept in the daily_stats table.
+
+Every flush that creates Messages, Users or Matches bumps the matching
+(day, dimension, bucket) counters with a single upsert, so dashboard
+reads scale with the number of days instead of the number of rows. The
+same flush bumps the all-time counters on the counties and towns
+dimension rows (see locations.py).
+
+Migration 0016 fills an empty daily_stats table from history on
+upgrade; rebuild it by hand with:
+
+    python rollups.py backfill
+"""
+import argparse
+from collections import Counter
+from datetime import datetime, time, timedelta
+from sqlalchemy import event, delete, insert, func, case
+from sqlalchemy.orm.util import identity_key
+from models import User, Message, Match, DailyStat, County, Town
+from database import SessionLocal, engine, get_session
+from commands import classify
+from stats import AGE_RANGES, as_date, analytics_response
+import locations
+
+# Dimensions written to daily_stats
+MESSAGES = "messages"              # bucket: message direction
+COMMAND = "command"                # bucket: command keyword (commands.classify)
+MESSAGE_COUNTY = "message_county"  # bucket: sender county
+USERS_GENDER = "gender"            # bucket: gender of new users
+USERS_COUNTY = "county"            # bucket: county of new users
+USERS_TOWN = "town"                # bucket: "county#town" of new users
+USERS_AGE = "age_band"             # bucket: AGE_RANGES label of new users
+MATCHES = "matches"                # bucket: ''
+
+TOWN_SEPARATOR = "#"
+
+
+def age_band(age):
+    for min_age, max_age, label in AGE_RANGES:
+        if min_age <= age <= max_age:
+            return label
+    return None
+
+
+def town_bucket(county, town):
+    return f"{county}{TOWN_SEPARATOR}{town}"
+
+
+def split_town_bucket(bucket):
+    county, _, town = bucket.partition(TOWN_SEPARATOR)
+    return county, town
+
+
+def _day(created_at):
+    return (created_at or datetime.utcnow()).date()
+
+
+def count_message(counts, created_at, direction, message_text, county):
+    day = _day(created_at)
+    counts[(day, MESSAGES, direction)] += 1
+    counts[(day, COMMAND, classify(message_text))] += 1
+    if county is not None:
+        counts[(day, MESSAGE_COUNTY, county)] += 1
+
+
+def count_user(counts, created_at, gender, county, town, age):
+    day = _day(created_at)
+    counts[(day, USERS_GENDER, gender)] += 1
+    counts[(day, USERS_COUNTY, county)] += 1
+    counts[(day, USERS_TOWN, town_bucket(county, town))] += 1
+    band = age_band(age)
+    if band is not None:
+        counts[(day, USERS_AGE, band)] += 1
+
+
+def _upsert_statement(dialect_name, rows):
+    table = DailyStat.__table__
+    if dialect_name == "mysql":
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(table).values(rows)
+        return stmt.on_duplicate_key_update(total=table.c.total + stmt.inserted["total"])
+    if dialect_name in ("sqlite", "postgresql"):
+        if dialect_name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=["day", "dimension", "bucket"],
+            set_={"total": table.c.total + stmt.excluded["total"]}
+        )
+    raise NotImplementedError(f"daily_stats upsert not supported on {dialect_name}")
+
+
+def apply_counts(connection, counts):
+    """Add a Counter of (day, dimension, bucket) -> n to daily_stats."""
+    rows = [
+        {"day": day, "dimension": dimension, "bucket": bucket, "total": n}
+        for (day, dimension, bucket), n in counts.items() if n
+    ]
+    if rows:
+        connection.execute(_upsert_statement(connection.dialect.name, rows))
+
+
+def user_counties(session, user_ids):
+    """Map user ids to (county, county_id), using the identity map before querying."""
+    counties = {}
+    missing = []
+    for user_id in set(user_ids):
+        user = session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            counties[user_id] = (user.county, user.county_id)
+        else:
+            missing.append(user_id)
+    if missing:
+        counties.update(
+            (user_id, (county, county_id)) for user_id, county, county_id in
+            session.query(User.id, User.county, User.county_id).filter(User.id.in_(missing))
+        )
+    return counties
+
+
+def _count_messages(counts, totals, messages, counties):
+    """`messages` are (user_id, created_at, direction, text) tuples."""
+    for user_id, created_at, direction, text in messages:
+        county, county_id = counties.get(user_id, (None, None))
+        count_message(counts, created_at, direction, text, county)
+        locations.count_message(totals, county_id)
+
+
+def record_message_rows(session, rows):
+    """Bump rollups for Message rows written outside the ORM unit of work.
+
+    `rows` are the mappings passed to a bulk insert (user_id,
+    message_direction, message_text and optionally created_at).
+    """
+    counts = Counter()
+    totals = Counter()
+    counties = user_counties(session, [row["user_id"] for row in rows])
+    _count_messages(counts, totals, [
+        (row["user_id"], row.get("created_at"), row["message_direction"], row["message_text"])
+        for row in rows
+    ], counties)
+    apply_counts(session.connection(), counts)
+    locations.apply_totals(session.connection(), totals)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _record_new_rows(session, flush_context):
+    new_messages = []
+    counts = Counter()
+    totals = Counter()
+    for obj in session.new:
+        if isinstance(obj, Message):
+            new_messages.append(obj)
+        elif isinstance(obj, User):
+            count_user(counts, obj.created_at, obj.gender, obj.county, obj.town, obj.age)
+            locations.count_user(totals, obj.county_id, obj.town_id)
+        elif isinstance(obj, Match):
+            counts[(_day(obj.created_at), MATCHES, "")] += 1
+
+    if new_messages:
+        with session.no_autoflush:
+            counties = user_counties(session, [m.user_id for m in new_messages])
+        _count_messages(counts, totals, [
+            (m.user_id, m.created_at, m.message_direction, m.message_text) for m in new_messages
+        ], counties)
+
+    apply_counts(session.connection(), counts)
+    locations.apply_totals(session.connection(), totals)
+
+
+def backfill(session, chunk_size=10000):
+    """Rebuild daily_stats from the users, messages and matches tables."""
+    counts = Counter()
+
+    for created_at, gender, county, town, age in (
+        session.query(User.created_at, User.gender, User.county, User.town, User.age)
+        .yield_per(chunk_size)
+    ):
+        count_user(counts, created_at, gender, county, town, age)
+
+    for created_at, direction, text, county in (
+        session.query(Message.created_at, Message.message_direction, Message.message_text, User.county)
+        .outerjoin(User, User.id == Message.user_id)
+        .yield_per(chunk_size)
+    ):
+        count_message(counts, created_at, direction, text, county)
+
+    match_day = func.date(Match.created_at)
+    for day, n in session.query(match_day, func.count(Match.id)).group_by(match_day):
+        counts[(as_date(day), MATCHES, "")] += n
+
+    connection = session.connection()
+    connection.execute(delete(DailyStat.__table__))
+    rows = [
+        {"day": day, "dimension": dimension, "bucket": bucket, "total": n}
+        for (day, dimension, bucket), n in counts.items()
+    ]
+    for offset in range(0, len(rows), chunk_size):
+        connection.execute(insert(DailyStat.__table__), rows[offset:offset + chunk_size])
+    return len(rows)
+
+
+def collect(session, today, days):
+    """Collect dashboard counters from daily_stats (see stats.collect_live)."""
+    yesterday = today - timedelta(days=1)
+    window_start = min(today - timedelta(days=days - 1), yesterday)
+
+    daily_users = Counter()
+    daily_messages = Counter()
+    daily_matches = Counter()
+    for day, dimension, bucket, total in (
+        session.query(DailyStat.day, DailyStat.dimension, DailyStat.bucket, DailyStat.total)
+        .filter(DailyStat.day >= window_start,
+                DailyStat.dimension.in_([MESSAGES, COMMAND, USERS_GENDER]))
+    ):
+        day = as_date(day)
+        if dimension == MESSAGES:
+            daily_messages[day] += total
+        elif dimension == USERS_GENDER:
+            daily_users[day] += total
+        elif bucket == "MATCH":
+            daily_matches[day] += total
+
+    totals = {}
+    before_today = {}
+    for dimension, bucket, total, earlier in (
+        session.query(
+            DailyStat.dimension,
+            DailyStat.bucket,
+            func.sum(DailyStat.total),
+            func.sum(case((DailyStat.day < today, DailyStat.total), else_=0))
+        )
+        .filter(DailyStat.dimension.in_([COMMAND, USERS_GENDER, USERS_AGE]))
+        .group_by(DailyStat.dimension, DailyStat.bucket)
+    ):
+        totals[(dimension, bucket)] = int(total or 0)
+        before_today[(dimension, bucket)] = int(earlier or 0)
+
+    genders = [(bucket, n) for (dimension, bucket), n in totals.items() if dimension == USERS_GENDER]
+    return {
+        "daily_users": daily_users,
+        "daily_messages": daily_messages,
+        "daily_matches": daily_matches,
+        "total_users": sum(n for _, n in genders),
+        "users_before_today": sum(
+            n for (dimension, _), n in before_today.items() if dimension == USERS_GENDER
+        ),
+        "age_counts": [totals.get((USERS_AGE, label), 0) for _, _, label in AGE_RANGES],
+        "gender": genders,
+        "total_matches": totals.get((COMMAND, "MATCH"), 0),
+        "total_next": totals.get((COMMAND, "NEXT"), 0),
+    }
+
+
+def day_range(start=None, end=None):
+    """Whole days covered by a [start, end) datetime window, as (first, last) dates."""
+    first = start.date() if start is not None else None
+    last = None
+    if end is not None:
+        last = end.date() if end.time() != time.min else end.date() - timedelta(days=1)
+    return first, last
+
+
+def location_analytics(session, start=None, end=None, limit=10):
+    """County distribution, top counties and popular towns.
+
+    All-time figures come from the counters on the counties and towns
+    rows. With `start`/`end` they are summed from daily_stats instead,
+    which resolves whole days: a window that starts or ends mid-day
+    includes that entire day.
+    """
+    if start is None and end is None:
+        return _location_totals(session, limit)
+
+    first, last = day_range(start, end)
+    totals = {USERS_COUNTY: {}, MESSAGE_COUNTY: {}, USERS_TOWN: {}}
+    query = (
+        session.query(DailyStat.dimension, DailyStat.bucket, func.sum(DailyStat.total))
+        .filter(DailyStat.dimension.in_(list(totals)))
+        .group_by(DailyStat.dimension, DailyStat.bucket)
+    )
+    if first is not None:
+        query = query.filter(DailyStat.day >= first)
+    if last is not None:
+        query = query.filter(DailyStat.day <= last)
+    for dimension, bucket, total in query:
+        totals[dimension][bucket] = int(total or 0)
+
+    user_counts = totals[USERS_COUNTY]
+    top_counties = sorted(user_counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    popular_towns = []
+    for bucket, n in sorted(totals[USERS_TOWN].items(), key=lambda item: (-item[1], item[0]))[:limit]:
+        county, town = split_town_bucket(bucket)
+        popular_towns.append((town, county, n))
+    return analytics_response(
+        sorted(user_counts.items()),
+        [(county, n, totals[MESSAGE_COUNTY].get(county, 0)) for county, n in top_counties],
+        popular_towns
+    )
+
+
+def _location_totals(session, limit):
+    counties = (
+        session.query(County.name, County.user_count, County.message_count)
+        .filter(County.user_count > 0)
+        .order_by(County.name)
+        .all()
+    )
+    top_counties = sorted(counties, key=lambda row: (-row.user_count, row.name))[:limit]
+    popular_towns = (
+        session.query(Town.name, County.name, Town.user_count)
+        .join(County, County.id == Town.county_id)
+        .filter(Town.user_count > 0)
+        .order_by(Town.user_count.desc(), County.name, Town.name)
+        .limit(limit)
+        .all()
+    )
+    return analytics_response(
+        [(name, user_count) for name, user_count, _ in counties],
+        top_counties,
+        popular_towns
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the daily_stats rollup table")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        DailyStat.__table__.create(bind=engine, checkfirst=True)
+        with get_session() as session:
+            written = backfill(session)
+        print(f"Rebuilt daily_stats with {written} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Full-text search over messages and self-descriptions.
+
+Searchable text is copied into search_documents as it is written: one
+row per message (by the flush hook below, or an INSERT ... SELECT over
+the inserted ids for store_rows' bulk inserts) and one per user's current
+self-description. The copy is what carries the full-text index: a FULLTEXT index on MySQL, where the
+partitioned messages table cannot have one, and an FTS5 table on SQLite
+(see models.SQLITE_FTS_DDL).
+
+Results are ranked by relevance (MySQL natural-language MATCH score,
+SQLite -bm25) and continued with an opaque `after` cursor on
+(score, id). The cursor keeps pages stable, not cheap: every page scores
+and sorts all documents matching the terms before filtering on it, so a
+query's cost grows with how common its words are. Each hit
+carries its document id and, for messages, the message id; a
+description hit is resolved by its user_id.
+
+Fill search_documents for existing data with:
+
+    python search.py backfill
+"""
+import argparse
+import base64
+import json
+import re
+from sqlalchemy import event, delete, insert, select, and_, or_, func, literal, literal_column, table, column
+from models import Message, UserSelfDescription, SearchDocument
+from database import SessionLocal, get_session
+
+MESSAGE = "message"
+DESCRIPTION = "description"
+KINDS = (MESSAGE, DESCRIPTION)
+DOCUMENT_COLUMNS = ["kind", "user_id", "message_id", "direction", "body", "created_at"]
+
+MAX_QUERY_LENGTH = 200
+DELETE_CHUNK_SIZE = 10000
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def encode_cursor(score, row_id):
+    raw = json.dumps([score, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode an `after` cursor into (score, id); raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, row_id = json.loads(base64.urlsafe_b64decode(padded).decode())
+        return float(score), int(row_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def parse_query(value):
+    """The search terms in ?q=; raises ValueError when there are none."""
+    terms = _WORD.findall((value or "")[:MAX_QUERY_LENGTH])
+    if not terms:
+        raise ValueError("q must contain at least one word")
+    return terms
+
+
+def parse_kind(value):
+    if value and value not in KINDS:
+        raise ValueError(f"kind must be one of: {', '.join(KINDS)}")
+    return value or None
+
+
+def _score_and_match(dialect_name, terms):
+    """(score, match condition, (FTS table, join condition) or None) for the dialect."""
+    if dialect_name == "mysql":
+        from sqlalchemy.dialects.mysql import match
+        score = match(SearchDocument.body, against=" ".join(terms)).in_natural_language_mode()
+        return score, score, None
+    if dialect_name == "sqlite":
+        # Quoted terms so input cannot use FTS5 query syntax; OR as in MySQL's natural-language mode
+        fts_query = " OR ".join('"' + term + '"' for term in terms)
+        fts = table("search_documents_fts", column("rowid"))
+        fts_name = literal_column("search_documents_fts")
+        return -func.bm25(fts_name), fts_name.op("MATCH")(fts_query), (fts, fts.c.rowid == SearchDocument.id)
+    raise NotImplementedError(f"full-text search not supported on {dialect_name}")
+
+
+def search(session, terms, kind=None, user_id=None, direction=None, start=None, end=None,
+           after=None, limit=100):
+    """One page of documents matching `terms`, best first; returns (items, next_cursor)."""
+    score, condition, fts_join = _score_and_match(session.get_bind().dialect.name, terms)
+    query = select(
+        SearchDocument.id, SearchDocument.kind, SearchDocument.user_id, SearchDocument.message_id,
+        SearchDocument.direction,
+        SearchDocument.body, SearchDocument.created_at, score.label("score")
+    )
+    if fts_join is not None:
+        query = query.join(*fts_join)
+    query = query.where(condition)
+    if kind:
+        query = query.where(SearchDocument.kind == kind)
+    if user_id is not None:
+        query = query.where(SearchDocument.user_id == user_id)
+    if direction:
+        query = query.where(SearchDocument.direction == direction)
+    if start is not None:
+        query = query.where(SearchDocument.created_at >= start)
+    if end is not None:
+        query = query.where(SearchDocument.created_at < end)
+    if after:
+        after_score, after_id = decode_cursor(after)
+        query = query.where(or_(score < after_score, and_(score == after_score, SearchDocument.id < after_id)))
+
+    rows = session.execute(query.order_by(score.desc(), SearchDocument.id.desc()).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(float(rows[-1].score), rows[-1].id)
+    return [row_to_dict(row) for row in rows], next_cursor
+
+
+def row_to_dict(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'user_id': row.user_id,
+        'message_id': row.message_id,
+        'direction': row.direction,
+        'text': row.body,
+        'created_at': row.created_at.isoformat(),
+        'score': round(float(row.score), 6)
+    }
+
+
+def _message_documents():
+    """SELECT of search_documents columns for the messages table, for INSERT ... SELECT."""
+    messages = Message.__table__
+    return select(literal(MESSAGE), messages.c.user_id, messages.c.id, messages.c.message_direction,
+                  messages.c.message_text, func.coalesce(messages.c.created_at, func.now()))
+
+
+def record_messages(session, condition):
+    """Index Message rows written outside the ORM unit of work, selected by `condition` on their id."""
+    session.connection().execute(insert(SearchDocument.__table__).from_select(
+        DOCUMENT_COLUMNS, _message_documents().where(condition)
+    ))
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _index_new_rows(session, flush_context):
+    documents = []
+    described = {}
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Message) and obj in session.new:
+            documents.append({
+                "kind": MESSAGE,
+                "user_id": obj.user_id,
+                "message_id": obj.id,
+                "direction": obj.message_direction,
+                "body": obj.message_text,
+                "created_at": obj.created_at,
+            })
+        elif isinstance(obj, UserSelfDescription):
+            described[obj.user_id] = obj
+    documents_table = SearchDocument.__table__
+    if described:
+        session.connection().execute(delete(documents_table).where(
+            documents_table.c.kind == DESCRIPTION, documents_table.c.user_id.in_(described)
+        ))
+        documents.extend({
+            "kind": DESCRIPTION,
+            "user_id": user_id,
+            "message_id": None,
+            "direction": None,
+            "body": description.description,
+            "created_at": description.created_at,
+        } for user_id, description in described.items())
+    if documents:
+        session.connection().execute(insert(documents_table), documents)
+
+
+def remove_messages(session, start, end):
+    """Drop message documents created in [start, end), e.g. for an archived month."""
+    documents = SearchDocument.__table__
+    while True:
+        ids = [row_id for (row_id,) in session.execute(
+            select(documents.c.id)
+            .where(documents.c.kind == MESSAGE, documents.c.created_at >= start, documents.c.created_at < end)
+            .limit(DELETE_CHUNK_SIZE)
+        )]
+        if not ids:
+            break
+        session.execute(delete(documents).where(documents.c.id.in_(ids)))
+        session.commit()
+
+
+def backfill(connection):
+    """Rebuild search_documents from the messages and userselfdescription tables; returns the row count."""
+    documents = SearchDocument.__table__
+    connection.execute(delete(documents))
+    connection.execute(insert(documents).from_select(DOCUMENT_COLUMNS, _message_documents()))
+    descriptions = UserSelfDescription.__table__
+    connection.execute(insert(documents).from_select(
+        DOCUMENT_COLUMNS,
+        select(literal(DESCRIPTION), descriptions.c.user_id, literal(None), literal(None),
+               descriptions.c.description, func.coalesce(descriptions.c.created_at, func.now()))
+    ))
+    return connection.execute(select(func.count(documents.c.id))).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the full-text search documents")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        with get_session() as session:
+            SearchDocument.__table__.create(bind=session.connection(), checkfirst=True)
+            written = backfill(session.connection())
+        print(f"Indexed {written} search document(s)")
+
+
+if __name__ == "__main__":
+    main()
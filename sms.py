@@ -0,0 +1,480 @@
+"""Inbound SMS command handling.
+
+parse() turns the text into a typed command and HANDLERS dispatches on
+its type. Handlers read and write through the caller's session and
+return the reply text; persisting the Message rows is left to the caller
+so the whole exchange commits in one transaction.
+"""
+from datetime import datetime
+from sqlalchemy import insert, or_
+from sqlalchemy.exc import IntegrityError
+from models import User, Message, Match, MatchRequest, MatchBatch
+import rollups
+import cache
+import matching
+import outbound
+import profiles
+import phones
+import search
+import inbound
+from matching import OPPOSITE_GENDER
+from commands import (
+    parse, ValidationError, Penzi, Start, Details, Myself, MatchCommand,
+    Next, ProfileRequest, Describe, Yes
+)
+
+SHORTCODE = "5001"
+PAGE_SIZE = 3
+MAX_BATCH_SIZE = 500
+INSERT_CHUNK_BYTES = 512 * 1024
+
+# Marks a sender that has not been looked up yet (None means "not registered")
+UNRESOLVED = object()
+
+PLURALS = {"man": "men", "lady": "ladies"}
+
+
+class Conversation:
+    """State for one inbound SMS while it is being handled."""
+
+    def __init__(self, session, phone_number, sender, prefetched=None):
+        self.session = session
+        self.phone_number = phone_number
+        self.sender = sender
+        # Lookups already done by the caller ("target", "batch", "candidates")
+        self.prefetched = prefetched or {}
+        self.command = None
+        self.reply = None
+        # (user_id, text) for messages sent to users other than the sender
+        self.notifications = []
+
+
+def normalize_phone(phone_number):
+    return phones.normalize(phone_number)
+
+
+def find_user_by_phone(session, phone_number):
+    return phones.find_user(session, phone_number)
+
+
+def _not_registered():
+    return (
+        "You are not registered for dating. To register SMS "
+        f"start#name#age#gender#county#town to {SHORTCODE}. "
+        "E.g., start#John Doe#26#Male#Nakuru#Naivasha"
+    )
+
+
+def _pronouns(gender):
+    """(object pronoun, subject pronoun, noun) for a gender."""
+    return ("him", "He", "man") if gender == "Male" else ("her", "She", "lady")
+
+
+def _profile_line(user):
+    return f"{user.name} aged {user.age}, {user.phone_number}."
+
+
+def _penzi(conv, command):
+    if conv.sender is not None:
+        return f"Welcome back {conv.sender.name}! To search for a MPENZI, SMS match#age#town to {SHORTCODE}."
+    return (
+        "Welcome to our dating service with 6000 potential dating partners! "
+        f"To register SMS start#name#age#gender#county#town to {SHORTCODE}. "
+        "E.g., start#John Doe#26#Male#Nakuru#Naivasha"
+    )
+
+
+def _start(conv, command):
+    if conv.sender is not None:
+        return (
+            f"You are already registered {conv.sender.name}. "
+            f"SMS details#levelOfEducation#profession#maritalStatus#religion#ethnicity to {SHORTCODE}."
+        )
+    user = User(
+        name=command.name,
+        phone_number=conv.phone_number,
+        age=command.age,
+        gender=command.gender,
+        county=command.county,
+        town=command.town
+    )
+    try:
+        with conv.session.begin_nested():
+            conv.session.add(user)
+    except IntegrityError:
+        # The same number registered concurrently (uq_users_phone_number)
+        conv.sender = find_user_by_phone(conv.session, conv.phone_number)
+        if conv.sender is None:
+            raise
+        return _start(conv, command)
+    conv.sender = user
+    return (
+        f"Your profile has been created successfully {user.name}. "
+        f"SMS details#levelOfEducation#profession#maritalStatus#religion#ethnicity to {SHORTCODE}. "
+        "E.g. details#diploma#driver#single#christian#mijikenda"
+    )
+
+
+def _details(conv, command):
+    profiles.update_details(conv.session, conv.sender, *command)
+    return (
+        "This is the last stage of registration. "
+        f"SMS a brief description of yourself to {SHORTCODE} starting with the word MYSELF. "
+        "E.g., MYSELF chocolate, lovely, sexy etc."
+    )
+
+
+def _myself(conv, command):
+    profiles.update_description(conv.session, conv.sender, command.description)
+    return (
+        "You are now registered for dating. To search for a MPENZI, "
+        f"SMS match#age#town to {SHORTCODE} and meet the person of your dreams. E.g., match#23-25#Kisumu"
+    )
+
+
+def _format_page(session, candidate_ids):
+    users = {user.id: user for user in session.query(User).filter(User.id.in_(candidate_ids))}
+    return "\n".join(_profile_line(users[user_id]) for user_id in candidate_ids if user_id in users)
+
+
+def _remaining_note(remaining):
+    if remaining <= 0:
+        return ""
+    return f"\nSend NEXT to {SHORTCODE} to receive details of the remaining {remaining}."
+
+
+def _match(conv, command):
+    sender = conv.sender
+    location = command.location
+    candidate_ids = conv.prefetched.get("candidates")
+    if candidate_ids is None:
+        candidate_ids = matching.find_candidates(conv.session, sender, command.min_age, command.max_age, location)
+    else:
+        candidate_ids = matching.rank(conv.session, sender, candidate_ids, command.min_age, command.max_age)
+
+    match_request = MatchRequest(
+        user_id=sender.id,
+        age_range=f"{command.min_age}-{command.max_age}",
+        county=location,
+        status="active" if candidate_ids else "no_matches"
+    )
+    conv.session.add(match_request)
+    conv.session.flush()
+
+    _, _, noun = _pronouns(OPPOSITE_GENDER.get(sender.gender, "Female"))
+    if not candidate_ids:
+        return (
+            f"Sorry, we have no {PLURALS[noun]} aged {command.min_age}-{command.max_age} in {location} right now. "
+            f"Try a different age range or town, e.g. match#23-30#Nairobi"
+        )
+
+    page = candidate_ids[:PAGE_SIZE]
+    matching.create_batch(conv.session, match_request, sender, candidate_ids, shown=len(page))
+    return (
+        f"We have {len(candidate_ids)} {PLURALS[noun]} who match your choice! "
+        f"We will send you details of {len(page)} of them shortly. "
+        f"To get more details about a {noun}, SMS the number e.g., 0722010203 to {SHORTCODE}\n"
+        + _format_page(conv.session, page)
+        + _remaining_note(len(candidate_ids) - len(page))
+    )
+
+
+def _latest_batch(session, user_id):
+    return (
+        session.query(MatchBatch)
+        .filter(MatchBatch.user_id == user_id)
+        .order_by(MatchBatch.id.desc())
+        .with_for_update()
+        .first()
+    )
+
+
+def _next(conv, command):
+    if "batch" in conv.prefetched:
+        # Read outside this transaction; lock it and take the current cursor
+        batch = conv.prefetched["batch"]
+        if batch is not None:
+            batch = matching.lock_batch(conv.session, batch.id)
+    else:
+        batch = _latest_batch(conv.session, conv.sender.id)
+    if batch is None:
+        return f"You have no active match search. SMS match#age#town to {SHORTCODE}, e.g. match#23-25#Kisumu"
+    page = matching.next_page(conv.session, batch, PAGE_SIZE)
+    if not page:
+        return f"You have seen all your matches. SMS match#age#town to {SHORTCODE} to search again."
+    return _format_page(conv.session, page) + _remaining_note(batch.total_matches - batch.matches_shown)
+
+
+def _target(conv, phone_number):
+    if "target" in conv.prefetched:
+        return conv.prefetched["target"]
+    return find_user_by_phone(conv.session, phone_number)
+
+
+def _profile_request(conv, command):
+    target = _target(conv, command.phone_number)
+    if target is None:
+        return f"No user found with phone number {command.phone_number}."
+    details = target.more_details
+    reply = f"{target.name} aged {target.age}, {target.county} County, {target.town} town"
+    if details is not None:
+        reply += (
+            f", {details.level_of_education}, {details.profession}, {details.marital_status}, "
+            f"{details.religion}, {details.ethnicity}"
+        )
+    reply += f". Send DESCRIBE {target.phone_number} to get more details about {target.name}."
+
+    _record_interest(conv, target)
+    him, he, noun = _pronouns(conv.sender.gender)
+    conv.notifications.append((target.id, (
+        f"Hi {target.name}, a {noun} called {conv.sender.name} is interested in you and requested your details. "
+        f"{he} is aged {conv.sender.age} based in {conv.sender.county}. "
+        f"Do you want to know more about {him}? Send YES to {SHORTCODE}"
+    )))
+    return reply
+
+
+def _record_interest(conv, target):
+    """Mark target as displayed on the sender's latest request so YES can find the sender."""
+    match_request = (
+        conv.session.query(MatchRequest)
+        .filter(MatchRequest.user_id == conv.sender.id)
+        .order_by(MatchRequest.id.desc())
+        .first()
+    )
+    if match_request is None:
+        match_request = MatchRequest(
+            user_id=conv.sender.id,
+            age_range=str(target.age),
+            county=target.county,
+            status="direct"
+        )
+        conv.session.add(match_request)
+        conv.session.flush()
+    match = (
+        conv.session.query(Match)
+        .filter(Match.request_id == match_request.id, Match.matched_user_id == target.id)
+        .first()
+    )
+    if match is None:
+        match = Match(request_id=match_request.id, matched_user_id=target.id)
+        conv.session.add(match)
+    match.displayed = 1
+
+
+def _describe(conv, command):
+    target = _target(conv, command.phone_number)
+    if target is None:
+        return f"No user found with phone number {command.phone_number}."
+    if target.self_description is None:
+        return f"{target.name} has not described themselves yet."
+    return f"{target.name} describes themselves as {target.self_description.description}"
+
+
+def _yes(conv, command):
+    interested = (
+        conv.session.query(User)
+        .join(MatchRequest, MatchRequest.user_id == User.id)
+        .join(Match, Match.request_id == MatchRequest.id)
+        .filter(Match.matched_user_id == conv.sender.id, Match.displayed == 1)
+        .order_by(Match.id.desc())
+        .first()
+    )
+    if interested is None:
+        return "Nobody has requested your details yet."
+    return (
+        f"{interested.name} aged {interested.age}, {interested.county} County, {interested.town} town, "
+        f"{interested.phone_number}. Send DESCRIBE {interested.phone_number} to get more details."
+    )
+
+
+# handler, whether the sender must already be registered
+HANDLERS = {
+    Penzi: (_penzi, False),
+    Start: (_start, False),
+    Details: (_details, True),
+    Myself: (_myself, True),
+    MatchCommand: (_match, True),
+    Next: (_next, True),
+    ProfileRequest: (_profile_request, True),
+    Describe: (_describe, True),
+    Yes: (_yes, True),
+}
+
+
+def dispatch(conv, command):
+    handler, needs_registration = HANDLERS[type(command)]
+    if needs_registration and conv.sender is None:
+        return _not_registered()
+    return handler(conv, command)
+
+
+def handle(session, phone_number, message_text, sender=UNRESOLVED, prefetched=None):
+    """Parse and dispatch one inbound SMS, returning its Conversation.
+
+    `sender` may be passed (a User, or None for an unknown number) when
+    the caller already resolved the phone number; otherwise it is looked
+    up here. `prefetched` likewise carries other lookups the handler
+    would make, see Conversation.prefetched.
+    """
+    phone_number = normalize_phone(phone_number)
+    if sender is UNRESOLVED:
+        sender = find_user_by_phone(session, phone_number)
+    conv = Conversation(session, phone_number, sender, prefetched)
+    try:
+        conv.command = parse(message_text)
+    except ValidationError as e:
+        conv.reply = str(e)
+    else:
+        try:
+            conv.reply = dispatch(conv, conv.command)
+        except ValidationError as e:
+            conv.reply = str(e)
+    return conv
+
+
+def find_users_by_phone(session, phone_numbers):
+    """Resolve many phone numbers at once; returns {phone_number: User} (see phones.resolve_users)."""
+    return phones.resolve_users(session, phone_numbers)
+
+
+def message_rows(conv, message_text, created_at):
+    """Message mappings for one handled SMS, in insert order."""
+    rows = []
+    if conv.sender is not None:
+        rows.append({"user_id": conv.sender.id, "message_direction": "incoming",
+                     "message_text": message_text, "created_at": created_at})
+        rows.append({"user_id": conv.sender.id, "message_direction": "outgoing",
+                     "message_text": conv.reply, "created_at": created_at})
+    for user_id, text in conv.notifications:
+        rows.append({"user_id": user_id, "message_direction": "outgoing",
+                     "message_text": text, "created_at": created_at})
+    return rows
+
+
+def outbound_rows(conv):
+    """Outbound queue rows for one handled SMS: the reply, then any notifications."""
+    rows = [{
+        "user_id": conv.sender.id if conv.sender is not None else None,
+        "phone_number": conv.phone_number,
+        "message_text": conv.reply
+    }]
+    for user_id, text in conv.notifications:
+        recipient = conv.session.get(User, user_id)
+        if recipient is not None and recipient.phone_number:
+            rows.append({"user_id": user_id, "phone_number": recipient.phone_number, "message_text": text})
+    return rows
+
+
+def _statement_chunks(rows):
+    """Split rows so each executemany stays one multi-row INSERT on MySQL.
+
+    mysqlclient and PyMySQL cut an executemany longer than about 1MB into
+    several INSERTs, and lastrowid then only covers the last of them.
+    """
+    chunk, size = [], 0
+    for row in rows:
+        # utf8mb4 worst case plus the other columns
+        length = 4 * len(row["message_text"]) + 100
+        if chunk and size + length > INSERT_CHUNK_BYTES:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(row)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def _insert_messages(session, rows):
+    """Bulk insert Message rows; returns a condition selecting their ids."""
+    if session.get_bind().dialect.insert_executemany_returning:
+        ids = session.execute(insert(Message).returning(Message.id), rows).scalars().all()
+        return Message.id.in_(ids)
+    connection = session.connection()
+    ranges = []
+    for chunk in _statement_chunks(rows):
+        first_id = connection.execute(insert(Message.__table__), chunk).lastrowid
+        # MySQL: lastrowid is the first id of a multi-row INSERT, and InnoDB
+        # gives its rows one consecutive AUTO_INCREMENT block
+        ranges.append(Message.id.between(first_id, first_id + len(chunk) - 1))
+    return or_(*ranges)
+
+
+def store_rows(session, rows):
+    """Bulk insert Message rows, keeping rollups, search and the response cache in step."""
+    if rows:
+        inserted = _insert_messages(session, rows)
+        rollups.record_message_rows(session, rows)
+        search.record_messages(session, inserted)
+        cache.mark_written(session, "messages")
+
+
+def handle_batch(session, items):
+    """Handle a burst of inbound SMS in one transaction.
+
+    `items` are dicts with phone_number, message and optionally the
+    gateway's message_id. Senders and receipts of earlier deliveries are
+    resolved with one query each, messages are processed in the order they
+    arrived, and all Message rows and queued replies are written with one
+    bulk insert each. Each message runs in a savepoint, so a failure is
+    reported in its result without aborting the rest of the batch.
+    Retried deliveries get their original reply back and throttled ones an
+    error with retry_after (see inbound.py). Returns one result dict per
+    item, in input order.
+    """
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        phone_number = item.get("phone_number")
+        message_text = item.get("message")
+        if not phone_number or message_text is None:
+            results[index] = {"index": index, "error": "phone_number and message are required"}
+            continue
+        phone_number = normalize_phone(phone_number)
+        key = inbound.idempotency_key(phone_number, message_text, item.get("message_id"))
+        pending.append((index, phone_number, message_text, key))
+
+    senders = find_users_by_phone(session, {phone_number for _, phone_number, _, _ in pending})
+    handled = inbound.find(session, [key for _, _, _, key in pending])
+    rows = []
+    outgoing = []
+    # Arrival order across the batch keeps each sender's commands in order
+    # and lets a later MATCH see users registered earlier in the burst
+    for index, phone_number, message_text, key in pending:
+        if key in handled:
+            results[index] = dict(handled[key], index=index, replayed=True)
+            continue
+        savepoint = session.begin_nested()
+        try:
+            inbound.throttle(phone_number, message_text)
+            receipt = inbound.claim(session, key, phone_number)
+            conv = handle(session, phone_number, message_text, sender=senders.get(phone_number))
+            inbound.record(session, receipt, conv)
+            savepoint.commit()
+        except inbound.Duplicate as e:
+            savepoint.rollback()
+            results[index] = dict(e.response, index=index, replayed=True)
+            continue
+        except inbound.Throttled as e:
+            savepoint.rollback()
+            results[index] = {"index": index, "phone_number": phone_number, "error": str(e),
+                              "retry_after": round(e.retry_after, 1)}
+            continue
+        except Exception as e:
+            savepoint.rollback()
+            results[index] = {"index": index, "phone_number": phone_number, "error": str(e)}
+            continue
+        if conv.sender is not None:
+            senders[phone_number] = conv.sender
+        rows.extend(message_rows(conv, message_text, datetime.utcnow()))
+        outgoing.extend(outbound_rows(conv))
+        results[index] = {
+            "index": index,
+            "phone_number": phone_number,
+            "user_id": conv.sender.id if conv.sender is not None else None,
+            "reply": conv.reply
+        }
+
+    store_rows(session, rows)
+    outbound.enqueue(session, outgoing)
+    return results
@@ -0,0 +1,250 @@
+from datetime import datetime, date, time, timedelta
+from collections import Counter
+from sqlalchemy import func, case
+from models import User, Message, County, Town
+
+# Age buckets used by the dashboard histogram (inclusive bounds)
+AGE_RANGES = [
+    (18, 25, "18-25"),
+    (26, 35, "26-35"),
+    (36, 45, "36-45"),
+    (46, 55, "46-55"),
+    (56, 100, "56+")
+]
+
+DEFAULT_WINDOW_DAYS = 7
+
+
+def as_date(value):
+    """Normalize a DATE() result; MySQL returns a date, SQLite a string."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _day_start(day):
+    return datetime.combine(day, time.min)
+
+
+def collect_live(session, today, days):
+    """Collect dashboard counters straight from the users/messages tables.
+
+    Runs a fixed number of grouped queries regardless of the window length:
+    one GROUP BY day over messages, one over users, one all-time count of
+    MATCH/NEXT commands (off ix_messages_command_created_at), one users
+    aggregate (totals + CASE-bucketed ages) and the gender split.
+    """
+    yesterday = today - timedelta(days=1)
+    window_start = min(today - timedelta(days=days - 1), yesterday)
+    start = _day_start(window_start)
+
+    is_match = Message.command == 'MATCH'
+    message_day = func.date(Message.created_at)
+    daily_messages = {}
+    daily_matches = {}
+    for day, total, matches in (
+        session.query(
+            message_day,
+            func.count(Message.id),
+            func.sum(case((is_match, 1), else_=0))
+        )
+        .filter(Message.created_at >= start)
+        .group_by(message_day)
+    ):
+        day = as_date(day)
+        daily_messages[day] = total
+        daily_matches[day] = int(matches or 0)
+
+    user_day = func.date(User.created_at)
+    daily_users = {
+        as_date(day): count
+        for day, count in (
+            session.query(user_day, func.count(User.id))
+            .filter(User.created_at >= start)
+            .group_by(user_day)
+        )
+    }
+
+    command_totals = dict(
+        session.query(Message.command, func.count(Message.id))
+        .filter(Message.command.in_(('MATCH', 'NEXT')))
+        .group_by(Message.command)
+    )
+
+    age_columns = [
+        func.sum(case((User.age.between(min_age, max_age), 1), else_=0))
+        for min_age, max_age, _ in AGE_RANGES
+    ]
+    users_row = session.query(
+        func.count(User.id),
+        func.sum(case((User.created_at < _day_start(today), 1), else_=0)),
+        *age_columns
+    ).one()
+
+    gender_stats = (
+        session.query(User.gender, func.count(User.id))
+        .group_by(User.gender)
+        .all()
+    )
+
+    return {
+        "daily_users": daily_users,
+        "daily_messages": daily_messages,
+        "daily_matches": daily_matches,
+        "total_users": users_row[0] or 0,
+        "users_before_today": int(users_row[1] or 0),
+        "age_counts": [int(count or 0) for count in users_row[2:]],
+        "gender": [(gender, count) for gender, count in gender_stats],
+        "total_matches": command_totals.get('MATCH', 0),
+        "total_next": command_totals.get('NEXT', 0),
+    }
+
+
+def build_stats(counters, today, days):
+    """Shape collected counters into the /api/penzi/dashboard/stats payload."""
+    yesterday = today - timedelta(days=1)
+    daily_users = counters["daily_users"]
+    daily_messages = counters["daily_messages"]
+    daily_matches = counters["daily_matches"]
+
+    timeline_labels = []
+    timeline_users = []
+    timeline_messages = []
+    timeline_matches = []
+    for i in range(days - 1, -1, -1):  # oldest to newest
+        day = today - timedelta(days=i)
+        timeline_labels.append(day.strftime("%d %b"))
+        timeline_users.append(daily_users.get(day, 0))
+        timeline_messages.append(daily_messages.get(day, 0))
+        timeline_matches.append(daily_matches.get(day, 0))
+
+    total_users = counters["total_users"]
+    users_yesterday = counters["users_before_today"] or 1
+
+    active_matches_today = daily_matches.get(today, 0)
+    active_matches_yesterday = daily_matches.get(yesterday, 0) or 1
+    messages_today = daily_messages.get(today, 0)
+    messages_yesterday = daily_messages.get(yesterday, 0) or 1
+
+    users_change = ((total_users - users_yesterday) / users_yesterday * 100)
+    matches_change = ((active_matches_today - active_matches_yesterday) / active_matches_yesterday * 100)
+    messages_change = ((messages_today - messages_yesterday) / messages_yesterday * 100)
+
+    total_matches = counters["total_matches"] or 1
+    successful_matches = counters["total_next"]
+    success_rate = (successful_matches / total_matches * 100)
+    success_rate_yesterday = ((successful_matches - 1) / total_matches * 100) if successful_matches > 0 else 0
+    success_change = success_rate - success_rate_yesterday
+
+    return {
+        "totalUsers": total_users,
+        "activeMatches": active_matches_today,
+        "messagesToday": messages_today,
+        "successRate": round(success_rate, 1),
+        "dailyChange": {
+            "users": round(users_change, 1),
+            "matches": round(matches_change, 1),
+            "messages": round(messages_change, 1),
+            "success": round(success_change, 1)
+        },
+        "charts": {
+            "timeline": {
+                "labels": timeline_labels,
+                "datasets": {
+                    "users": timeline_users,
+                    "messages": timeline_messages,
+                    "matches": timeline_matches
+                }
+            },
+            "gender": {
+                "labels": [g[0] for g in counters["gender"]],
+                "data": [g[1] for g in counters["gender"]]
+            },
+            "ageDistribution": {
+                "labels": [label for _, _, label in AGE_RANGES],
+                "data": counters["age_counts"]
+            }
+        }
+    }
+
+
+def dashboard_stats(session, days=DEFAULT_WINDOW_DAYS, today=None, collect=collect_live):
+    """Compute the dashboard stats payload for a window of `days` days.
+
+    `collect` gathers the raw counters; pass rollups.collect to read from
+    the daily_stats table instead of scanning users/messages.
+    """
+    if days < 1:
+        raise ValueError("days must be at least 1")
+    today = today or datetime.now().date()
+    return build_stats(collect(session, today, days), today, days)
+
+
+def location_analytics(session, start=None, end=None, limit=10):
+    """County distribution, top counties and popular towns from the users table.
+
+    Groups on the integer county/town keys and counts each county's
+    messages with a plain join, so no DISTINCT over users x messages.
+    `start`/`end` restrict both to rows created in [start, end).
+    """
+    users = session.query(User.county_id, User.town_id, func.count(User.id))
+    messages = session.query(User.county_id, func.count(Message.id)).join(User, User.id == Message.user_id)
+    if start is not None:
+        users = users.filter(User.created_at >= start)
+        messages = messages.filter(Message.created_at >= start)
+    if end is not None:
+        users = users.filter(User.created_at < end)
+        messages = messages.filter(Message.created_at < end)
+
+    county_users = Counter()
+    town_users = Counter()
+    for county_id, town_id, n in users.group_by(User.county_id, User.town_id):
+        county_users[county_id] += n
+        town_users[town_id] += n
+    county_messages = dict(messages.group_by(User.county_id).all())
+
+    counties = [
+        (name, county_users[county_id], county_messages.get(county_id, 0))
+        for county_id, name in session.query(County.id, County.name).filter(County.id.in_(list(county_users)))
+    ]
+    towns = [
+        (town, county, town_users[town_id])
+        for town_id, town, county in
+        session.query(Town.id, Town.name, County.name)
+        .join(County, County.id == Town.county_id)
+        .filter(Town.id.in_(list(town_users)))
+    ]
+    return analytics_response(
+        sorted((county, n) for county, n, _ in counties),
+        sorted(counties, key=lambda row: (-row[1], row[0]))[:limit],
+        sorted(towns, key=lambda row: (-row[2], row[1], row[0]))[:limit]
+    )
+
+
+def analytics_response(county_distribution, top_counties, popular_towns):
+    """The location-analytics JSON from (county, users), (county, users, messages)
+    and (town, county, users) rows."""
+    return {
+        "countyDistribution": [
+            {"county": county, "count": count}
+            for county, count in county_distribution
+        ],
+        "topCounties": [
+            {
+                "county": county,
+                "userCount": user_count,
+                "messageCount": message_count
+            }
+            for county, user_count, message_count in top_counties
+        ],
+        "popularTowns": [
+            {
+                "town": town,
+                "county": county,
+                "count": count
+            }
+            for town, county, count in popular_towns
+        ]
+    }
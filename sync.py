@@ -0,0 +1,232 @@
+"""Incremental sync for the dashboard: ?since= deltas and the events stream.
+
+Messages and match requests are insert-only, so a reader's position in
+them is the last id it has seen. Users change after they register (their
+details and description), so users carry updated_at, bumped on flush
+whenever the user or one of their profile rows changes, and are read in
+(updated_at, id) order.
+
+A position is a dict with any of the keys "message", "match" and "user",
+passed around as an opaque `since` cursor. List endpoints return one for
+the head of their table on the first page, delta requests return the
+position after the rows they include, and every event on
+/api/penzi/events carries the position after it as its SSE id, so a
+reconnecting EventSource resumes where it stopped via Last-Event-ID.
+
+Ids and timestamps are assigned at flush but become visible at commit,
+so a row is only handed out once it is SETTLE_SECONDS old; a transaction
+that stays open longer than that between flush and commit can have its
+rows skipped.
+"""
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event, and_, or_
+from models import User, Message, MatchRequest, UserMoreDetails, UserSelfDescription
+from database import SessionLocal
+import listing
+
+KINDS = ("message", "user", "match")
+
+SETTLE_SECONDS = float(os.environ.get("SYNC_SETTLE_SECONDS", 1))
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 15
+STREAM_SECONDS = 300  # the client reconnects with Last-Event-ID afterwards
+RETRY_MS = 2000
+EVENT_BATCH_SIZE = 500
+MAX_STREAMS = int(os.environ.get("SYNC_MAX_STREAMS", 50))
+
+# Each open stream holds a worker thread; refuse more than MAX_STREAMS
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+def encode_position(position):
+    raw = json.dumps(position, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_position(cursor):
+    """Decode a `since` cursor into a position dict; raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded).decode())
+        if not isinstance(position, dict) or not set(position) <= set(KINDS):
+            raise ValueError
+        for kind in ("message", "match"):
+            if kind in position:
+                position[kind] = int(position[kind])
+        if position.get("user") is not None:
+            updated_at, user_id = position["user"]
+            position["user"] = [datetime.fromisoformat(updated_at).isoformat(), int(user_id)]
+        return position
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError("Invalid since cursor")
+
+
+def parse_kinds(value):
+    """The comma-separated ?types= list, defaulting to every kind; raises ValueError."""
+    if not value:
+        return KINDS
+    kinds = tuple(kind.strip() for kind in value.split(",") if kind.strip())
+    unknown = set(kinds) - set(KINDS)
+    if unknown or not kinds:
+        raise ValueError(f"types must be a comma-separated subset of {', '.join(KINDS)}")
+    return kinds
+
+
+def head(session, kinds=KINDS):
+    """The position of the newest row of each kind."""
+    position = {}
+    if "message" in kinds:
+        position["message"] = session.query(Message.id).order_by(Message.id.desc()).limit(1).scalar() or 0
+    if "match" in kinds:
+        position["match"] = session.query(MatchRequest.id).order_by(MatchRequest.id.desc()).limit(1).scalar() or 0
+    if "user" in kinds:
+        newest = session.query(User.updated_at, User.id).order_by(User.updated_at.desc(), User.id.desc()).first()
+        position["user"] = [newest.updated_at.isoformat(), newest.id] if newest and newest.updated_at else None
+    return position
+
+
+def match_row_to_dict(row):
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'age_range': row.age_range,
+        'county': row.county,
+        'status': row.status,
+        'created_at': row.created_at.isoformat() if row.created_at else None
+    }
+
+
+def _settled(rows, column, cutoff):
+    """The leading rows written before `cutoff`; later ids may still be uncommitted."""
+    settled = []
+    for row in rows:
+        written_at = getattr(row, column)
+        if written_at is not None and written_at > cutoff:
+            break
+        settled.append(row)
+    return settled
+
+
+def _after_id(query, id_column, last_id, limit):
+    return query.filter(id_column > last_id).order_by(id_column).limit(limit).all()
+
+
+def message_changes(session, position, limit, args, cutoff):
+    query = listing.filter_messages(session.query(*listing.MESSAGE_COLUMNS), args)
+    settled = _settled(_after_id(query, Message.id, position["message"], limit), "created_at", cutoff)
+    entries = []
+    for row in settled:
+        position = dict(position, message=row.id)
+        entries.append((listing.message_row_to_dict(row), position))
+    # Unsettled rows are not "more" yet; they are read again once settled
+    return entries, len(settled) == limit
+
+
+def match_changes(session, position, limit, args, cutoff):
+    columns = (MatchRequest.id, MatchRequest.user_id, MatchRequest.age_range,
+               MatchRequest.county, MatchRequest.status, MatchRequest.created_at)
+    settled = _settled(_after_id(session.query(*columns), MatchRequest.id, position["match"], limit),
+                       "created_at", cutoff)
+    entries = []
+    for row in settled:
+        position = dict(position, match=row.id)
+        entries.append((match_row_to_dict(row), position))
+    return entries, len(settled) == limit
+
+
+def user_changes(session, position, limit, args, cutoff):
+    query = listing.filter_users(session.query(*listing.USER_COLUMNS), args)
+    query = query.filter(User.updated_at <= cutoff)
+    if position["user"] is not None:
+        updated_at, user_id = position["user"]
+        updated_at = datetime.fromisoformat(updated_at)
+        query = query.filter(or_(
+            User.updated_at > updated_at,
+            and_(User.updated_at == updated_at, User.id > user_id)
+        ))
+    rows = query.order_by(User.updated_at, User.id).limit(limit).all()
+    entries = []
+    for row in rows:
+        position = dict(position, user=[row.updated_at.isoformat(), row.id])
+        entries.append((listing.user_row_to_dict(row), position))
+    return entries, len(rows) == limit
+
+
+CHANGES = {"message": message_changes, "match": match_changes, "user": user_changes}
+
+
+def changes(session, kind, position, limit, args=None, now=None):
+    """Rows of `kind` written after `position`, oldest first.
+
+    Returns ([(row dict, position after that row), ...], has_more).
+    `args` are the list endpoint's filters.
+    """
+    if kind not in position:
+        raise ValueError(f"since cursor has no {kind} position")
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=SETTLE_SECONDS)
+    return CHANGES[kind](session, position, limit, args or {}, cutoff)
+
+
+def _format_event(kind, item, position):
+    return f"id: {encode_position(position)}\nevent: {kind}\ndata: {json.dumps(item)}\n\n"
+
+
+def event_stream(session_factory, position, kinds, clock=time.monotonic, sleep=time.sleep):
+    """Yield SSE frames for rows written after `position` until STREAM_SECONDS pass.
+
+    Kinds missing from `position` start at the current head.
+    """
+    yield f"retry: {RETRY_MS}\n\n"
+    position = dict(position)
+    missing = [kind for kind in kinds if kind not in position]
+    if missing:
+        with session_factory() as session:
+            position.update(head(session, missing))
+    deadline = clock() + STREAM_SECONDS
+    last_frame = clock()
+    while clock() < deadline:
+        frames = []
+        more = False
+        with session_factory() as session:
+            for kind in kinds:
+                entries, has_more = changes(session, kind, position, EVENT_BATCH_SIZE)
+                more = more or has_more
+                for item, after in entries:
+                    position[kind] = after[kind]
+                    frames.append(_format_event(kind, item, position))
+        if frames:
+            yield "".join(frames)
+            last_frame = clock()
+        elif clock() - last_frame >= HEARTBEAT_SECONDS:
+            yield ": keepalive\n\n"
+            last_frame = clock()
+        # Read on straight away only while there is a backlog to deliver
+        if not (frames and more):
+            sleep(POLL_SECONDS)
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _touch_changed_profiles(session, flush_context, instances):
+    """Bump users.updated_at when a user or their details or description change.
+
+    Done here rather than with onupdate= so that bulk UPDATEs, such as the
+    migrations' backfills, do not touch it.
+    """
+    user_ids = {
+        obj.user_id for obj in list(session.new) + list(session.dirty)
+        if isinstance(obj, (UserMoreDetails, UserSelfDescription)) and obj.user_id is not None
+    }
+    user_ids.update(
+        obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj)
+    )
+    now = datetime.utcnow()
+    with session.no_autoflush:
+        for user_id in user_ids:
+            user = session.get(User, user_id)
+            if user is not None:
+                user.updated_at = now